@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the host-side hot paths, with a JSON history and regression
+# checks against a stored baseline.
+#
+# Every benchmark measures items per second (blocks, frames, hashes, ...): the
+# call is repeated until it has run for --min-time, and the best of --repeats
+# such runs counts, which keeps scheduler noise out of the numbers. Each run
+# is appended to the history file with the commit it was measured on. A
+# benchmark that falls more than its threshold below the baseline is a
+# regression and makes the script exit with 1; the job feed path (midstate,
+# framing, payload packing, building Work) has the tightest thresholds.
+#
+# Baselines are per machine and not committed: record one with --save-baseline
+# on the machine that runs the checks, before the change to be measured. A run
+# without a baseline, or with benchmarks the baseline has no rate for, fails.
+#
+# Usage:
+#   python3 bench.py [NAME...] [--save-baseline] [--history PATH] [--baseline PATH]
+#   python3 bench.py --list
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HISTORY = os.path.join(HERE, "bench_history.json")
+BASELINE = os.path.join(HERE, "bench_baseline.json")
+
+# allowed slowdown against the baseline
+FEED_THRESHOLD = 0.10
+DEFAULT_THRESHOLD = 0.20
+
+GENESIS_HEADER = bytes.fromhex(
+    "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d"
+)
+GENESIS_NONCE = 0x1DAC2B7C
+
+Benchmark = collections.namedtuple("Benchmark", ["name", "unit", "threshold", "setup"])
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, unit, threshold=DEFAULT_THRESHOLD):
+    """Register a setup function that returns (run, items per call of run)."""
+
+    def register(setup):
+        BENCHMARKS[name] = Benchmark(name, unit, threshold, setup)
+        return setup
+
+    return register
+
+
+def measure(run, items, min_time=0.2, repeats=5):
+    """Best items/s of `repeats` runs of at least `min_time` seconds each."""
+    run()
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 4:
+            break
+        calls *= 4
+    calls = max(1, int(calls * min_time / elapsed))
+
+    best = 0.0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(calls):
+            run()
+        best = max(best, calls * items / (time.perf_counter() - start))
+    return best
+
+
+# Job feed
+
+
+@benchmark("midstate", "blocks", FEED_THRESHOLD)
+def bench_midstate():
+    from midstate import calculateMidstate
+    from uart_host import swap_words
+
+    block = swap_words(GENESIS_HEADER[:64])
+    return (lambda: calculateMidstate(block)), 1
+
+
+@benchmark("crc_frame", "frames", FEED_THRESHOLD)
+def bench_crc_frame():
+    from uart_host import MSG_PUSH_JOB, build_frame, job_from_header, pack_job
+
+    payload = pack_job(*job_from_header(GENESIS_HEADER))
+    return (lambda: build_frame(MSG_PUSH_JOB, payload)), 1
+
+
+@benchmark("crc_check", "frames")
+def bench_crc_check():
+    from crc32 import CRC32_FPGA
+    from uart_host import MSG_PUSH_JOB, build_frame, job_from_header, pack_job
+
+    frames = [build_frame(MSG_PUSH_JOB, pack_job(*job_from_header(GENESIS_HEADER), nonce_min=i)) for i in range(256)]
+    return (lambda: CRC32_FPGA.check_frames(frames)), len(frames)
+
+
+@benchmark("pack_job", "payloads", FEED_THRESHOLD)
+def bench_pack_job():
+    from uart_host import job_from_header, pack_job
+
+    midstate, tail = job_from_header(GENESIS_HEADER)
+    return (lambda: pack_job(midstate, tail, 0x1000)), 1
+
+
+@benchmark("pack_batch", "frames", FEED_THRESHOLD)
+def bench_pack_batch():
+    from packer import JobPacker
+    from uart_host import job_from_header
+
+    midstate, tail = job_from_header(GENESIS_HEADER)
+    jobs = [(midstate, tail, i) for i in range(64)]
+    packer = JobPacker(len(jobs))
+    return (lambda: packer.pack(jobs)), len(jobs)
+
+
+@benchmark("parse_nonces", "messages")
+def bench_parse_nonces():
+    from uart_host import MSG_NONCE, FrameParser
+
+    data = b"".join(bytes([8, 0, 0, MSG_NONCE]) + i.to_bytes(4, "big") for i in range(256))
+    parser = FrameParser()
+
+    def run():
+        parser.feed(data)
+        for _ in parser.messages():
+            pass
+
+    return run, 256
+
+
+@benchmark("job_feed", "works", FEED_THRESHOLD)
+def bench_job_feed():
+    from stratum_v1 import StratumJob, build_work
+
+    # a job of a block with ~1000 transactions
+    job = StratumJob("1", "00" * 32, "01" * 60, "02" * 80, ["%064x" % i for i in range(10)], "20000000", "1d00ffff", "495fab29", True, bytes(4), 4, 1 << 224)
+    counter = [0]
+
+    def run():
+        # fresh extranonce2 values, the midstate cache would hide the work otherwise
+        start = counter[0]
+        counter[0] += 8
+        build_work(job, [struct.pack(">I", start + i) for i in range(8)])
+
+    return run, 8
+
+
+@benchmark("merkle_roll", "roots", FEED_THRESHOLD)
+def bench_merkle_roll():
+    from stratum_v1 import StratumJob
+
+    job = StratumJob("1", "00" * 32, "01" * 60, "02" * 80, ["%064x" % i for i in range(10)], "20000000", "1d00ffff", "495fab29", True, bytes(4), 4, 1 << 224)
+    extranonces2 = [struct.pack(">I", i) for i in range(256)]
+    return (lambda: job.engine.roll(extranonces2)), len(extranonces2)
+
+
+# Double SHA-256
+
+
+@benchmark("double_sha_hashlib", "hashes")
+def bench_double_sha_hashlib():
+    from difficulty import hash_value
+
+    header = GENESIS_HEADER + struct.pack("<I", 0)
+    return (lambda: hash_value(header)), 1
+
+
+@benchmark("double_sha_model", "hashes")
+def bench_double_sha_model():
+    import test_hasher
+    from trace_diff import block_data
+
+    midstate = 0x339A90BCF0BF58637DACCC90A8CA591EE9D8C8C3C803014F3687B1961BF91947
+    block = block_data(0x4A5E1E4B495FAB291D00FFFF, GENESIS_NONCE)
+    return (lambda: test_hasher.double_hash(midstate, block)), 1
+
+
+@benchmark("double_sha_sweep", "hashes")
+def bench_double_sha_sweep():
+    import numpy as np
+
+    from sweep import hash_nonces
+    from uart_host import job_from_header
+
+    midstate, tail = job_from_header(GENESIS_HEADER)
+    nonces = np.arange(1 << 14, dtype=np.uint32)
+    return (lambda: hash_nonces(midstate, tail, nonces)), len(nonces)
+
+
+@benchmark("double_sha_job", "hashes")
+def bench_double_sha_job():
+    import numpy as np
+
+    from job import Job
+
+    job = Job.from_header(GENESIS_HEADER)
+    nonces = np.arange(1 << 16, dtype=np.uint32)
+    return (lambda: job.sweep(nonces)), len(nonces)
+
+
+# Noise transport
+
+
+def _cipher_pair():
+    """Transport ciphers of a finished NX handshake, initiator to responder."""
+    from dissononce.dh.x25519.x25519 import X25519DH
+    from dissononce.processing.handshakepatterns.interactive.NX import NXHandshakePattern
+
+    from stratum_v2 import new_handshake_state
+
+    initiator, responder = new_handshake_state(), new_handshake_state()
+    initiator.initialize(NXHandshakePattern(), True, b"")
+    responder.initialize(NXHandshakePattern(), False, b"", s=X25519DH().generate_keypair())
+    message = bytearray()
+    initiator.write_message(b"", message)
+    responder.read_message(bytes(message), bytearray())
+    message = bytearray()
+    responder_ciphers = responder.write_message(b"", message)
+    initiator_ciphers = initiator.read_message(bytes(message), bytearray())
+    return initiator_ciphers[0], responder_ciphers[0]
+
+
+def _job_frame():
+    """A NewMiningJob sized Stratum V2 frame."""
+    from noise_frames import FRAME_HEADER_SIZE
+    from stratum_v2 import CHANNEL_MSG_BIT, NEW_MINING_JOB
+
+    payload = bytes(45)
+    return struct.pack("<HB", CHANNEL_MSG_BIT, NEW_MINING_JOB) + len(payload).to_bytes(FRAME_HEADER_SIZE - 3, "little") + payload
+
+
+@benchmark("noise_encrypt", "frames")
+def bench_noise_encrypt():
+    from noise_frames import MAC_SIZE, TransportCipher
+
+    send, _ = _cipher_pair()
+    cipher = TransportCipher(send)
+    frame = _job_frame()
+    buffer = bytearray(len(frame) + MAC_SIZE)
+    view = memoryview(buffer)
+
+    def run():
+        view[: len(frame)] = frame
+        cipher.encrypt(view, len(frame))
+
+    return run, 1
+
+
+@benchmark("noise_decrypt", "frames")
+def bench_noise_decrypt():
+    from noise_frames import MAC_SIZE, TransportCipher
+
+    send, receive = _cipher_pair()
+    encrypter, decrypter = TransportCipher(send), TransportCipher(receive)
+    frame = _job_frame()
+    count = 64
+    ciphertexts = []
+    for _ in range(count):
+        buffer = bytearray(len(frame) + MAC_SIZE)
+        buffer[: len(frame)] = frame
+        encrypter.encrypt(memoryview(buffer), len(frame))
+        ciphertexts.append(bytes(buffer))
+    buffer = bytearray(len(frame) + MAC_SIZE)
+    view = memoryview(buffer)
+
+    def run():
+        # decrypt the same messages again from nonce 0
+        decrypter.counter = 0
+        receive.set_nonce(0)
+        for ciphertext in ciphertexts:
+            view[:] = ciphertext
+            decrypter.decrypt(view)
+
+    return run, count
+
+
+# History and baseline
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def run_benchmarks(names, min_time=0.2, repeats=5):
+    """{name: items/s}; benchmarks whose dependencies are missing are skipped."""
+    results = {}
+    for name in names:
+        bench = BENCHMARKS[name]
+        try:
+            run, items = bench.setup()
+        except ImportError as error:
+            print("%-20s skipped: %s" % (name, error))
+            continue
+        results[name] = measure(run, items, min_time, repeats)
+    return results
+
+
+def compare(results, baseline, threshold=None):
+    """(name, rate, baseline rate or None, change, regressed) per result."""
+    rows = []
+    for name, rate in results.items():
+        base = baseline.get(name)
+        if base is None:
+            rows.append((name, rate, None, None, False))
+            continue
+        change = rate / base - 1
+        allowed = BENCHMARKS[name].threshold if threshold is None else threshold
+        rows.append((name, rate, base, change, change < -allowed))
+    return rows
+
+
+def report(rows):
+    for name, rate, base, change, regressed in rows:
+        unit = BENCHMARKS[name].unit + "/s"
+        if base is None:
+            print("%-20s %14.0f %-11s (no baseline)" % (name, rate, unit))
+        else:
+            print("%-20s %14.0f %-11s %+6.1f%% against %.0f%s" % (name, rate, unit, 100 * change, base, "  REGRESSION" if regressed else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the host-side hot paths.")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+    parser.add_argument("--history", default=HISTORY, help="JSON file every run is appended to")
+    parser.add_argument("--baseline", default=BASELINE, help="JSON file of the baseline rates")
+    parser.add_argument("--save-baseline", action="store_true", help="make this run the baseline")
+    parser.add_argument("--threshold", type=float, help="allowed slowdown for every benchmark, e.g. 0.1")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per measurement")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.list:
+        for bench in BENCHMARKS.values():
+            print("%-20s %-9s threshold %.0f%%" % (bench.name, bench.unit, 100 * bench.threshold))
+        return
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(unknown))
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        sys.exit("no baseline at %s, record one on this machine with: python3 bench.py --save-baseline" % args.baseline)
+
+    results = run_benchmarks(args.names or list(BENCHMARKS), args.min_time, args.repeats)
+    run = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "machine": platform.node(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    history = load_json(args.history, [])
+    history.append(run)
+    save_json(args.history, history)
+
+    baseline = load_json(args.baseline, {"results": {}})
+    rows = compare(results, baseline["results"], args.threshold)
+    if baseline.get("commit"):
+        print("baseline: commit %s, %s" % (baseline["commit"], baseline["time"]))
+    report(rows)
+
+    if args.save_baseline:
+        # keep the rates of benchmarks that were not run
+        run["results"] = dict(baseline["results"], **results)
+        save_json(args.baseline, run)
+        print("saved as baseline to %s" % args.baseline)
+    elif any(regressed for *_, regressed in rows):
+        sys.exit(1)
+    elif any(base is None for _, _, base, _, _ in rows):
+        sys.exit("no baseline rate for %s, run them with --save-baseline" % ", ".join(name for name, _, base, _, _ in rows if base is None))
+
+
+if __name__ == "__main__":
+    main()
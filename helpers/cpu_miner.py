@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# Mines on the CPU cores behind the same interface as a board's UartHost, so
+# the scheduler can keep a job going while a board is reflashed or off USB,
+# and so there is a calibrated hashes/s baseline to hold the boards against.
+#
+# CpuMiner takes the frames UartHost would write: PING and INFO are answered
+# at once, a PUSH_JOB (midstate + 12 tail bytes + nonce_min, JOB_SIZE bytes as
+# in uart_comm.v) replaces the running job and is ACKed. The nonce range from
+# nonce_min is cut into chunks that a process pool sweeps with job.Job. The
+# workers write their progress and golden nonce into a shared memory block
+# instead of returning them, and look at the job generation in it between
+# batches, so a new job stops the old one within one batch. Like
+# fpgaminer_top.v the miner reports the first golden nonce from nonce_min and
+# then idles: a chunk's nonce is only reported once every chunk before it is
+# done.
+#
+# Usage:
+#   python3 cpu_miner.py [--workers N]             calibrate, then mine the genesis block
+#   python3 cpu_miner.py --scheduler [--workers N] mine next to emulated boards against a mock pool
+
+import argparse
+import asyncio
+import collections
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from job import Job
+from metrics import HostMetrics
+from sweep import FPGA_TARGET
+from uart_host import CRC_SIZE, HEADER_SIZE, MSG_ACK, MSG_BUF_LEN, MSG_INFO, MSG_INVALID, MSG_PUSH_JOB, PING, Message, unpack_job
+
+NONCE_RANGE = 1 << 32
+# shared memory: the job generation, then per slot hashes done and golden nonce (-1: none)
+GENERATION = 0
+SLOT_HASHES = 0
+SLOT_NONCE = 1
+SLOT_FIELDS = 2
+
+_shared = None
+_jobs = {}
+
+
+def _attach(name):
+    global _shared
+    _shared = shared_memory.SharedMemory(name)
+
+
+def _mine_chunk(generation, slot, midstate, tail, start, stop, target, batch_size):
+    """Sweep [start, stop) in a worker until the first golden nonce or a new job."""
+    state = np.ndarray((len(_shared.buf) // 8,), dtype=np.int64, buffer=_shared.buf)
+    base = 1 + slot * SLOT_FIELDS
+    job = _jobs.get((midstate, tail))
+    if job is None:
+        _jobs.clear()
+        job = _jobs[(midstate, tail)] = Job(midstate, tail)
+
+    while start < stop and state[GENERATION] == generation:
+        end = min(start + batch_size, stop)
+        found = job.sweep(np.arange(start, end, dtype=np.uint32), target)
+        if len(found):
+            state[base + SLOT_HASHES] += int(found[0]) - start + 1
+            state[base + SLOT_NONCE] = int(found[0])
+            return
+        state[base + SLOT_HASHES] += end - start
+        start = end
+
+
+class CpuMiner:
+    """A board that mines on `workers` processes; use it where a UartHost goes.
+
+    `chunk_size` nonces are handed to a worker at a time, `batch_size` nonces
+    are hashed between looks at the job generation. `target` is the target a
+    nonce has to meet, FPGA_TARGET like the RTL by default. Counts go to
+    `metrics` like UartHost's.
+    """
+
+    system_info = b"cpuminer"
+
+    def __init__(self, workers=None, chunk_size=1 << 20, batch_size=1 << 14, target=FPGA_TARGET, metrics=None):
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.target = target
+        self.nonces = asyncio.Queue()
+        # same statistics as UartHost
+        self.round_trips = collections.deque(maxlen=1024)
+        self.retransmits = 0
+        self.hashes = 0
+        self.metrics = metrics if metrics is not None else HostMetrics(target=target)
+
+        slots = 2 * self.workers
+        self._shared = shared_memory.SharedMemory(create=True, size=8 * (1 + slots * SLOT_FIELDS))
+        self._state = np.ndarray((1 + slots * SLOT_FIELDS,), dtype=np.int64, buffer=self._shared.buf)
+        self._state[:] = 0
+        self._free_slots = list(range(slots))
+        self._executor = ProcessPoolExecutor(self.workers, initializer=_attach, initargs=(self._shared.name,))
+        self._loop = asyncio.get_running_loop()
+        self._job = None
+        self._next_start = NONCE_RANGE
+        # nonce_max + 1 of the running job
+        self._end = NONCE_RANGE
+        # chunks of the running job in nonce order: (slot, future)
+        self._chunks = collections.deque()
+
+    def close(self):
+        self._stop()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._state = None
+        self._shared.close()
+        self._shared.unlink()
+
+    # Requests
+
+    def submit(self, frame, priority=False):
+        """Answer a frame like uart_comm.v, returns a future for the answer.
+        Frames are answered right away, so `priority` (see UartHost.submit)
+        has nothing to go ahead of."""
+        start = time.monotonic()
+        future = self._loop.create_future()
+        if frame == PING:
+            future.set_result(Message(MSG_ACK, b""))
+        elif frame[3] == MSG_INFO:
+            future.set_result(Message(MSG_INFO, self.system_info + bytes(4)))
+        elif frame[3] == MSG_PUSH_JOB and len(frame) == MSG_BUF_LEN:
+            self.metrics.jobs_pushed.inc()
+            self.start_job(*unpack_job(frame[HEADER_SIZE:-CRC_SIZE]))
+            self.metrics.jobs_acked.inc()
+            future.set_result(Message(MSG_ACK, b""))
+        else:
+            self.metrics.invalid.inc()
+            future.set_result(Message(MSG_INVALID, bytes(4)))
+        self.round_trips.append(time.monotonic() - start)
+        self.metrics.round_trip.observe(self.round_trips[-1])
+        return future
+
+    async def ping(self):
+        await self.submit(PING)
+
+    def start_job(self, midstate, tail, nonce_min=0, nonce_max=NONCE_RANGE - 1):
+        """Replace the running job; like the RTL, it ends at the first golden
+        nonce or once nonce_max is hashed."""
+        self._stop()
+        self._job = (bytes(midstate), bytes(tail))
+        self._next_start = nonce_min
+        self._end = nonce_max + 1
+        self._fill()
+
+    # Chunks
+
+    def _stop(self):
+        if self._state is None:
+            return
+        self._state[GENERATION] += 1
+        while self._chunks:
+            slot, future = self._chunks.popleft()
+            self._release(slot, future)
+        self._job = None
+
+    def _release(self, slot, future):
+        """Free a slot once its worker is done with it."""
+        if future.done():
+            self._free_slots.append(slot)
+        else:
+            future.add_done_callback(lambda _: self._free_slots.append(slot))
+
+    def _fill(self):
+        while self._job is not None and self._free_slots and self._next_start < self._end:
+            slot = self._free_slots.pop()
+            base = 1 + slot * SLOT_FIELDS
+            self._state[base + SLOT_HASHES] = 0
+            self._state[base + SLOT_NONCE] = -1
+            stop = min(self._next_start + self.chunk_size, self._end)
+            future = asyncio.wrap_future(
+                self._executor.submit(_mine_chunk, int(self._state[GENERATION]), slot, *self._job, self._next_start, stop, self.target, self.batch_size)
+            )
+            future.add_done_callback(self._collect)
+            self._chunks.append((slot, future))
+            self._next_start = stop
+
+    def _collect(self, _):
+        while self._chunks and self._chunks[0][1].done():
+            slot, future = self._chunks.popleft()
+            if future.cancelled():
+                continue
+            future.result()
+            base = 1 + slot * SLOT_FIELDS
+            self.hashes += int(self._state[base + SLOT_HASHES])
+            nonce = int(self._state[base + SLOT_NONCE])
+            self._free_slots.append(slot)
+            if nonce >= 0:
+                # the first golden nonce ends the job, like fpgaminer_top.v
+                self.metrics.nonce()
+                self.nonces.put_nowait(nonce)
+                self._stop()
+                return
+        self._fill()
+
+
+async def calibrate(miner, seconds=2.0):
+    """Hashes/s of a miner, measured on a job without golden nonces."""
+    target = miner.target
+    # no hash meets a zero target, so the job runs for the whole measurement
+    miner.target = 0
+    hashes = miner.hashes
+    start = time.monotonic()
+    miner.start_job(bytes(32), bytes(12))
+    await asyncio.sleep(seconds)
+    # count the chunks in flight as well
+    progress = sum(int(miner._state[1 + slot * SLOT_FIELDS + SLOT_HASHES]) for slot, _ in miner._chunks)
+    rate = (miner.hashes - hashes + progress) / (time.monotonic() - start)
+    miner._stop()
+    miner.target = target
+    return rate
+
+
+async def run_genesis(args):
+    miner = CpuMiner(args.workers)
+    try:
+        rate = await calibrate(miner)
+        print("%d workers: %.0f hashes/s (one fpgaminer_top.v at LOOP_LOG2=5 does %.0f)" % (miner.workers, rate, 100.5e6 / 32))
+
+        from fpga_emulator import GENESIS_MIDSTATE, GENESIS_NONCE, GENESIS_TAIL
+        from uart_host import build_frame, pack_job
+
+        nonce_min = GENESIS_NONCE - 4 * miner.chunk_size
+        start = time.monotonic()
+        await miner.submit(build_frame(MSG_PUSH_JOB, pack_job(GENESIS_MIDSTATE, GENESIS_TAIL, nonce_min)))
+        nonce = await miner.nonces.get()
+        print("genesis nonce %08x after %.2f s, %d nonces swept" % (nonce, time.monotonic() - start, nonce - nonce_min + 1))
+        assert nonce == GENESIS_NONCE
+
+        # a range ending one short of the golden nonce ends without one
+        hashes = miner.hashes
+        await miner.submit(build_frame(MSG_PUSH_JOB, pack_job(GENESIS_MIDSTATE, GENESIS_TAIL, GENESIS_NONCE - miner.chunk_size, GENESIS_NONCE - 1)))
+        while miner._chunks:
+            await asyncio.sleep(0.01)
+        assert miner.nonces.empty() and miner.hashes - hashes == miner.chunk_size
+        print("nonce_max %08x: %d nonces swept, no golden nonce" % (GENESIS_NONCE - 1, miner.hashes - hashes))
+    finally:
+        miner.close()
+
+
+async def run_scheduler(args):
+    from difficulty import difficulty_target
+    from fpga_emulator import FpgaEmulator
+    from scheduler import Scheduler, print_stats
+    from stratum_v1 import MockStratumServer, StratumV1Client
+    from uart_host import UartHost
+
+    # a share every ~16k hashes, long enough that the job switches do not dominate
+    difficulty = 2**-18
+    target = difficulty_target(difficulty)
+    server = await MockStratumServer(difficulty=difficulty).start()
+    source = StratumV1Client("127.0.0.1", server.port, "worker")
+    await source.connect()
+
+    miner = CpuMiner(args.workers, chunk_size=1 << 16, batch_size=1 << 12, target=target)
+    rate = await calibrate(miner, 1.0)
+    emulator = FpgaEmulator(baud_rate=115200, hashrate=rate / 4, batch_size=4096, target=target)
+
+    scheduler = Scheduler(source, heartbeat=0.5)
+    scheduler.add_board("cpu", miner, nominal_hashrate=rate)
+    scheduler.add_board(emulator.port, await UartHost.open(emulator.port, baud=115200, timeout=0.2, retries=1), nominal_hashrate=rate / 4)
+    scheduler.start()
+    try:
+        await asyncio.sleep(args.duration)
+        print("calibrated CPU baseline %.0f hashes/s" % rate)
+        print_stats(scheduler, source)
+        for stats in scheduler.stats():
+            print("  %-14s %.2fx the CPU baseline" % (stats["board"], stats["hashrate"] / rate))
+    finally:
+        stopped = scheduler.close()
+        for board in scheduler.boards:
+            board.host.close()
+        await stopped
+        source.close()
+        emulator.close()
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mine on the CPU behind the board interface.")
+    parser.add_argument("--workers", type=int, help="worker processes, one per core by default")
+    parser.add_argument("--scheduler", action="store_true", help="run under scheduler.py next to an emulated board")
+    parser.add_argument("--duration", type=float, default=6.0)
+    args = parser.parse_args()
+    asyncio.run(run_scheduler(args) if args.scheduler else run_genesis(args))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# Exact target and difficulty math, and verification of the FPGA's nonces.
+#
+# difficulty.cpp approximates the difficulty with a float fast_log; here
+# targets are integers: the block target decoded from nBits, the share target
+# from the pool difficulty (difficulty 1 = 0xFFFF << 208). Comparing the whole
+# 256-bit hash with a target also sidesteps counting leading zeroes in the
+# word-swapped byte order the miner works in.
+#
+# ShareVerifier double-SHA256s every nonce the FPGA reports with hashlib, on
+# the header with the nonce in header byte order, and sorts it into:
+#   block  - meets the block target, submit immediately
+#   share  - meets the pool's share target
+#   low    - meets the FPGA's own target (H7 == 0) but not the pool's, drop it
+#   bogus  - does not even meet the FPGA's target: a board fault or a nonce
+#            credited to the wrong job
+#
+# Usage: python3 difficulty.py [nbits in hex]
+
+import collections
+import functools
+import hashlib
+import struct
+from fractions import Fraction
+
+# the target of a difficulty 1 share (and of nBits 0x1d00ffff)
+DIFF1_TARGET = 0xFFFF << 208
+# fpgaminer_top.v reports a nonce when the last word of the hash is zero
+FPGA_TARGET = (1 << 224) - 1
+
+BLOCK = "block"
+SHARE = "share"
+LOW = "low"
+BOGUS = "bogus"
+
+Verdict = collections.namedtuple("Verdict", ["work", "nonce", "kind", "hash"])
+
+
+@functools.lru_cache(maxsize=1024)
+def bits_to_target(nbits):
+    """The target encoded in a compact nBits value."""
+    exponent, mantissa = nbits >> 24, nbits & 0x007FFFFF
+    if nbits & 0x00800000 and mantissa:
+        raise ValueError("negative target in nBits %08x" % nbits)
+    if exponent <= 3:
+        return mantissa >> 8 * (3 - exponent)
+    return mantissa << 8 * (exponent - 3)
+
+
+def target_to_bits(target):
+    """The compact nBits encoding of a target (rounded down, like Bitcoin Core)."""
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << 8 * (3 - size)
+    else:
+        mantissa = target >> 8 * (size - 3)
+    # the mantissa's top bit is the sign bit
+    if mantissa & 0x00800000:
+        mantissa >>= 8
+        size += 1
+    return size << 24 | mantissa
+
+
+@functools.lru_cache(maxsize=1024)
+def difficulty_target(difficulty):
+    """The share target for a pool difficulty, int, float or Fraction."""
+    return int(DIFF1_TARGET / Fraction(difficulty))
+
+
+def target_difficulty(target):
+    """The exact difficulty of a target, as a Fraction."""
+    return Fraction(DIFF1_TARGET, target)
+
+
+def difficulty(nbits):
+    """The exact difficulty of nBits, as a Fraction."""
+    return target_difficulty(bits_to_target(nbits))
+
+
+def double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash_value(header):
+    """The block hash of an 80 byte header as the integer it is compared to the target as."""
+    return int.from_bytes(double_sha256(header), "little")
+
+
+class ShareVerifier:
+    """Classifies nonces from the FPGA before they are submitted.
+
+    Targets are cached per job; the SHA-256 state after the first 64 header
+    bytes is kept for the last `cache_size` headers, so each nonce costs one
+    compression plus the second hash.
+    """
+
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self.counts = collections.Counter()
+        self._targets = {}
+        self._prefixes = collections.OrderedDict()
+
+    def targets(self, job):
+        """(block target, share target) of a job with `nbits` and `target` attributes."""
+        key = (job.nbits, job.target)
+        targets = self._targets.get(key)
+        if targets is None:
+            targets = self._targets[key] = (bits_to_target(job.nbits), job.target)
+        return targets
+
+    def _first_block(self, header):
+        prefix = header[:64]
+        sha = self._prefixes.get(prefix)
+        if sha is None:
+            sha = self._prefixes[prefix] = hashlib.sha256(prefix)
+            if len(self._prefixes) > self.cache_size:
+                self._prefixes.popitem(last=False)
+        else:
+            self._prefixes.move_to_end(prefix)
+        return sha.copy()
+
+    def classify(self, work, nonce):
+        """The Verdict for one golden nonce as reported by MSG_NONCE, for work
+        with a 76 byte `header` and a `job`."""
+        return self.verify([(work, nonce)])[0]
+
+    def verify(self, batch):
+        """Verdicts for a batch of (work, nonce) pairs."""
+        # uart_host imports metrics, which takes FPGA_TARGET from here
+        from uart_host import header_nonce
+
+        verdicts = []
+        for work, nonce in batch:
+            sha = self._first_block(work.header)
+            sha.update(work.header[64:76] + struct.pack("<I", header_nonce(nonce)))
+            value = int.from_bytes(hashlib.sha256(sha.digest()).digest(), "little")
+
+            block_target, share_target = self.targets(work.job)
+            if value <= block_target:
+                kind = BLOCK
+            elif value <= share_target:
+                kind = SHARE
+            elif value <= FPGA_TARGET:
+                kind = LOW
+            else:
+                kind = BOGUS
+            self.counts[kind] += 1
+            verdicts.append(Verdict(work, nonce, kind, value))
+        return verdicts
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    if len(sys.argv) > 1:
+        nbits = int(sys.argv[1], 16)
+        print("target %064x" % bits_to_target(nbits))
+        print("difficulty %s (%.6f)" % (difficulty(nbits), difficulty(nbits)))
+        sys.exit()
+
+    assert bits_to_target(0x1D00FFFF) == DIFF1_TARGET
+    assert target_to_bits(DIFF1_TARGET) == 0x1D00FFFF
+    assert difficulty(0x1D00FFFF) == 1
+    # block 100000
+    assert bits_to_target(0x1B04864C) == 0x04864C << 8 * 24
+    assert target_to_bits(bits_to_target(0x1B04864C)) == 0x1B04864C
+    assert difficulty_target(1) == DIFF1_TARGET
+    assert difficulty_target(0.5) == DIFF1_TARGET * 2
+    assert difficulty(0x1B04864C) == Fraction(0xFFFF << 208, 0x04864C << 192)
+    # the example in difficulty.cpp has the sign bit set, it is no valid target
+    try:
+        bits_to_target(0x2194261A)
+    except ValueError as error:
+        print(error)
+
+    # the genesis block, as Work with a job at pool difficulty 1
+    Job = collections.namedtuple("Job", ["nbits", "target"])
+    Work = collections.namedtuple("Work", ["job", "header"])
+    genesis = bytes.fromhex(
+        "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d"
+    )
+    work = Work(Job(0x1D00FFFF, difficulty_target(1)), genesis)
+    verifier = ShareVerifier()
+    print("genesis nonce:", verifier.classify(work, 0x1DAC2B7C).kind)
+    print("neighbouring nonce:", verifier.classify(work, 0x1DAC2B7D).kind)
+
+    # the same nonce against a recent mainnet nBits is only a share
+    hard = Work(Job(0x17034219, difficulty_target(1)), genesis)
+    assert verifier.classify(hard, 0x1DAC2B7C).kind == SHARE
+
+    batch = [(work, nonce) for nonce in range(100000)]
+    start = time.perf_counter()
+    verdicts = verifier.verify(batch)
+    print("%.0f nonces/s verified" % (len(batch) / (time.perf_counter() - start)))
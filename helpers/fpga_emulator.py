@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Emulates top.v (uart_comm.v + fpgaminer_top.v) behind a pseudo-terminal, to
+# load-test the host stack without a board.
+#
+# Bytes in both directions take 10 bits each at the configured baud rate (the
+# Verilog default is 9600). A PUSH_JOB is ACKed, then the emulator "mines" the
+# job by sweeping nonces from nonce_min with the vectorized software hasher
+# (sweep.py), paced to the simulated hashrate, and reports the first golden
+# nonce in a NONCE frame like fpgaminer_top.v does. A pushed job replaces the
+# running one; queued jobs start when the running one ends, at its golden
+# nonce or nonce_max. Frames can be corrupted on the way in to trigger RESEND, and
+# reset() makes the board drop its job and ignore the line while it boots.
+#
+# Usage:
+#   python3 fpga_emulator.py                    serve on a pty until interrupted
+#   python3 fpga_emulator.py --scenario genesis the genesis block exchange from the README
+#   python3 fpga_emulator.py --scenario load    job-switch latency and host throughput
+#   python3 fpga_emulator.py --scenario queue   a queued job takes over when the pushed range ends
+
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import numpy as np
+
+import sweep
+from uart_host import PtyStandIn, UartHost
+
+# fpgaminer_top.v with LOOP_LOG2=5 computes one double hash every 32 cycles of the 100.5MHz hash clock
+DEFAULT_HASHRATE = 100.5e6 / 32
+
+GENESIS_MIDSTATE = bytes.fromhex("339a90bcf0bf58637daccc90a8ca591ee9d8c8c3c803014f3687b1961bf91947")
+GENESIS_TAIL = bytes.fromhex("4a5e1e4b495fab291d00ffff")
+GENESIS_NONCE = 0x1DAC2B7C
+
+
+class FpgaEmulator(PtyStandIn):
+    """uart_comm.v and the miner core behind a pty.
+
+    `corrupt_rate` is the probability that a received frame gets a bit flipped
+    on the line; `corrupt_next` forces that for the next n frames.
+    """
+
+    def __init__(self, baud_rate=9600, hashrate=DEFAULT_HASHRATE, corrupt_rate=0.0, batch_size=1 << 14, target=sweep.FPGA_TARGET):
+        super().__init__()
+        self.byte_time = 10 / baud_rate
+        self.hashrate = hashrate
+        self.corrupt_rate = corrupt_rate
+        self.batch_size = batch_size
+        self.target = target
+        self.hashes = 0
+        self.corrupted = 0
+        self._corrupt_pending = 0
+        self._mining = None
+        self._down_until = 0.0
+        self._closed = False
+        # time at which the line will be free in each direction
+        self._rx_free = 0.0
+        self._tx_free = 0.0
+
+    def close(self):
+        if self._mining is not None:
+            self._mining.cancel()
+        self._closed = True
+        super().close()
+
+    def corrupt_next(self, n=1):
+        self._corrupt_pending += n
+
+    def reset(self, downtime=1.0):
+        """Lose the current job and stay deaf for `downtime` seconds, like a board reset."""
+        if self._mining is not None:
+            self._mining.cancel()
+        self.received.clear()
+        self.queue.clear()
+        self.idle = True
+        self._down_until = self._loop.time() + downtime
+
+    # UART timing
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            return
+        now = self._loop.time()
+        self._rx_free = max(self._rx_free, now) + len(data) * self.byte_time
+        self._loop.call_at(self._rx_free, self.receive, data)
+
+    def receive(self, data):
+        if not self._closed and self._loop.time() >= self._down_until:
+            super().receive(data)
+
+    def send(self, data):
+        now = self._loop.time()
+        start = max(self._tx_free, now)
+        self._tx_free = start + len(data) * self.byte_time
+        self._loop.call_at(self._tx_free, self._transmit, data)
+
+    def _transmit(self, data):
+        # bytes still on the line when the emulator is closed are lost
+        if not self._closed:
+            super().send(data)
+
+    # Messages
+
+    def on_frame(self, frame):
+        if self._corrupt_pending or random.random() < self.corrupt_rate:
+            self._corrupt_pending = max(0, self._corrupt_pending - 1)
+            self.corrupted += 1
+            frame = bytearray(frame)
+            frame[random.randrange(len(frame))] ^= 1 << random.randrange(8)
+            frame = bytes(frame)
+
+        super().on_frame(frame)
+
+    def on_job(self, midstate, tail, nonce_min, nonce_max):
+        # a new job resets the miner, like new_work does in fpgaminer_top.v
+        if self._mining is not None:
+            self._mining.cancel()
+        self._mining = self._loop.create_task(self._mine(midstate, tail, nonce_min, nonce_max))
+
+    async def _mine(self, midstate, tail, nonce_min, nonce_max):
+        nonce = nonce_min
+        started = self._loop.time()
+        done = 0
+        while nonce <= nonce_max:
+            stop = min(nonce + self.batch_size, nonce_max + 1)
+            # hash off the event loop so the UART side keeps answering while mining
+            nonces = np.arange(nonce, stop, dtype=np.uint32)
+            found = await self._loop.run_in_executor(None, sweep.sweep, midstate, tail, nonces, self.target)
+            if len(found):
+                stop = int(found[0]) + 1
+
+            # wait until the simulated hardware would have got this far
+            done += stop - nonce
+            self.hashes += stop - nonce
+            await asyncio.sleep(max(0.0, started + done / self.hashrate - self._loop.time()))
+
+            if len(found):
+                self.send_nonce(int(found[0]))
+                break  # the miner waits for new work after a golden nonce
+            nonce = stop
+        self._mining = None
+        self.job_done()
+
+
+async def scenario_genesis(emulator, host):
+    """The exchange documented in the README: ACK, then nonce 1dac2b7c."""
+    start = time.monotonic()
+    await host.push_job(GENESIS_MIDSTATE, GENESIS_TAIL, nonce_min=GENESIS_NONCE - 1)
+    acked = time.monotonic()
+    nonce = await host.nonces.get()
+    print("ACK after %.1f ms, NONCE %08x after %.1f ms" % ((acked - start) * 1000, nonce, (time.monotonic() - start) * 1000))
+    assert nonce == GENESIS_NONCE, "expected nonce %08x" % GENESIS_NONCE
+
+
+async def scenario_load(emulator, host, jobs=50):
+    """Push random jobs back to back, report ack latency and throughput."""
+    latencies = []
+    start = time.monotonic()
+    for _ in range(jobs):
+        sent = time.monotonic()
+        await host.push_job(random.randbytes(32), random.randbytes(12))
+        latencies.append(time.monotonic() - sent)
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    print(
+        "%d jobs in %.2f s (%.1f jobs/s), job switch latency p50 %.1f ms, p99 %.1f ms, %d retransmits of %d corrupted frames"
+        % (jobs, elapsed, jobs / elapsed, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, host.retransmits, emulator.corrupted)
+    )
+
+
+async def scenario_queue(emulator, host):
+    """Push a range that ends right before the golden nonce and queue the rest:
+    the nonce comes from the queued job without another push."""
+    start = time.monotonic()
+    await host.push_job(GENESIS_MIDSTATE, GENESIS_TAIL, nonce_min=GENESIS_NONCE - (1 << 20), nonce_max=GENESIS_NONCE - 1)
+    await host.queue_job(GENESIS_MIDSTATE, GENESIS_TAIL, nonce_min=GENESIS_NONCE - 1)
+    queued = time.monotonic()
+    nonce = await host.nonces.get()
+    print("queued after %.1f ms, NONCE %08x after %.1f ms, %d jobs started" % ((queued - start) * 1000, nonce, (time.monotonic() - start) * 1000, len(emulator.jobs)))
+    assert nonce == GENESIS_NONCE and len(emulator.jobs) == 2
+
+
+SCENARIOS = {"genesis": scenario_genesis, "load": scenario_load, "queue": scenario_queue}
+
+
+async def main(args):
+    emulator = FpgaEmulator(baud_rate=args.baud_rate, hashrate=args.hashrate, corrupt_rate=args.corrupt_rate)
+    print("emulating the FPGA on", emulator.port)
+
+    if args.scenario is None:
+        try:
+            await asyncio.Event().wait()
+        finally:
+            emulator.close()
+        return
+
+    host = await UartHost.open(emulator.port, timeout=max(1.0, 200 * emulator.byte_time))
+    try:
+        await SCENARIOS[args.scenario](emulator, host)
+    finally:
+        host.close()
+        emulator.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulate the FPGA miner behind a pseudo-terminal.")
+    parser.add_argument("--baud-rate", type=int, default=9600)
+    parser.add_argument("--hashrate", type=float, default=DEFAULT_HASHRATE, help="simulated hashes per second")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="probability of corrupting a received frame")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS))
+    asyncio.run(main(parser.parse_args()))
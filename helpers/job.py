@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Per-job precomputation for sweeping nonces in software.
+#
+# Within a job only W3 of the second header block, the nonce, changes. Job
+# does everything that does not depend on it once:
+#   - rounds 0..2 of the inner hash (calculateMidstate with rounds=3), and the
+#     nonce-free part of round 3, which then only adds the nonce to a and e
+#   - the message schedule terms built from constant words only: W16 and W17
+#     of the inner hash are fully constant, later words only add the terms
+#     that depend on the nonce (and for the outer hash, on hash1)
+#   - the nonce-free part of round 0 of the outer hash, whose state is the
+#     SHA-256 initial state
+# and the outer hash stops after round 60: H7 = h after round 63 + H0 =
+# e after round 60 + H0, so rounds 61..63 and W61..W63 are never computed.
+# H7 decides a golden nonce for the FPGA's target; for other targets the few
+# nonces whose H7 qualifies are rehashed in full with sweep.hash_nonces.
+#
+# The lanes are numpy uint32 arrays like in sweep.py. Run this file for a
+# benchmark against calculateMidstate + test_hasher.hash per nonce and against
+# sweep.sweep. Against sweep.sweep the precomputation gains little, 0.96x to
+# 1.2x from run to run (numpy already does the scalar early rounds cheaply and
+# the shortened outer hash saves 3 of 128 rounds); what counts more is
+# the batch size: sweep_range's batches of 1 << 14 nonces keep each lane
+# array (64 KiB) in cache, about twice as fast as batches of 1 << 18 for either.
+#
+# Usage: python3 job.py
+
+import struct
+
+import numpy as np
+
+from midstate import K, calculateMidstate
+from sweep import BLOCK2_PADDING, FPGA_TARGET, HASH2_PADDING, INITIAL_STATE, hash_nonces, meets_target, rotr
+from uart_host import swap_words
+
+MASK = 0xFFFFFFFF
+NONCE_RANGE = 1 << 32
+
+
+def _s0(x):
+    return rotr(x, 7) ^ rotr(x, 18) ^ (x >> 3)
+
+
+def _s1(x):
+    return rotr(x, 17) ^ rotr(x, 19) ^ (x >> 10)
+
+
+def _schedule(words, rounds):
+    """Plan the message schedule up to W[rounds - 1] for a block whose words are
+    known ints or None (varying). Returns (known words, plan) where the plan
+    lists (t, constant, [(function, index)]) for every varying word t >= 16:
+    W[t] = constant + sum(function(W[index]))."""
+    known = list(words) + [None] * (rounds - 16)
+    plan = []
+    for t in range(16, rounds):
+        constant, varying = 0, []
+        for function, i in ((_s1, t - 2), (None, t - 7), (_s0, t - 15), (None, t - 16)):
+            if known[i] is None:
+                varying.append((function, i))
+            elif function is None:
+                constant += known[i]
+            else:
+                constant += int(function(np.uint32(known[i])))
+        if varying:
+            plan.append((t, constant & MASK, varying))
+        else:
+            known[t] = constant & MASK
+    return known, plan
+
+
+def _expand(known, plan, w):
+    """Fill the varying words of `w` (a list starting with `known`) following the plan."""
+    for t, constant, varying in plan:
+        value = np.uint32(constant)
+        for function, i in varying:
+            value = value + (w[i] if function is None else function(w[i]))
+        w[t] = value
+
+
+def _t1(state, kw):
+    _, _, _, _, e, f, g, h = state
+    # Ch(e, f, g) with one operation less
+    return h + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + (g ^ (e & (f ^ g))) + kw
+
+
+def _round(state, kw):
+    """One round; `kw` is K[t] + W[t], folded into one scalar where W[t] is constant."""
+    a, b, c, d, e, f, g, _ = state
+    t1 = _t1(state, kw)
+    # Maj(a, b, c) with one operation less
+    t2 = (rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) | (c & (a | b)))
+    return (t1 + t2, a, b, c, d + t1, e, f, g)
+
+
+def _e_round(state, kw):
+    """A round of which only e is still needed: a, and so t2, is never read again."""
+    a, b, c, d, e, f, g, _ = state
+    return (None, a, b, c, d + _t1(state, kw), e, f, g)
+
+
+def _fold(known):
+    """K[t] + W[t] for every known word, None where W[t] varies."""
+    return [None if w is None else np.uint32((k + w) & MASK) for k, w in zip(K, known)]
+
+
+def _partial_round(state, k):
+    """(t1 without W, t2) of one round over a known state, as ints."""
+    a, b, c, d, e, f, g, h = (np.uint32(x) for x in state)
+    with np.errstate(over="ignore"):
+        t1 = h + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + np.uint32(k)
+        t2 = (rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))
+    return int(t1), int(t2)
+
+
+class Job:
+    """Nonce-invariant state of one job: `midstate` (32 bytes) and `tail` (12
+    bytes) as in the PUSH_JOB payload."""
+
+    def __init__(self, midstate, tail):
+        if len(midstate) != 32:
+            raise ValueError("midstate must be 32 bytes long")
+        if len(tail) != 12:
+            raise ValueError("tail must be 12 bytes long")
+        self.midstate = bytes(midstate)
+        self.tail = bytes(tail)
+        self._midstate_words = struct.unpack("<8I", midstate)
+
+        # inner hash: rounds 0..2 only see W0..W2
+        block = list(struct.unpack("<3I", tail)) + [0] + list(BLOCK2_PADDING)
+        state = struct.unpack("<8I", calculateMidstate(struct.pack("<16I", *block), midstate, rounds=3))
+        t1, t2 = _partial_round(state, K[3])
+        a, b, c, d, e, f, g, h = state
+        # round 3 is a = t1 + t2 + W3, e = d + t1 + W3
+        self._round3 = ((t1 + t2) & MASK, (d + t1) & MASK, (a, b, c, e, f, g))
+        block[3] = None
+        self._inner_known, self._inner_plan = _schedule(block, 64)
+        self._inner_kw = _fold(self._inner_known)
+
+        # outer hash: W0..W7 are hash1, round 0 starts from the initial state
+        self._outer_known, self._outer_plan = _schedule([None] * 8 + list(HASH2_PADDING), 61)
+        self._outer_kw = _fold(self._outer_known)
+        self._outer_t1, self._outer_t2 = _partial_round(INITIAL_STATE, K[0])
+
+    @classmethod
+    def from_header(cls, header):
+        """A Job for the first 76 bytes of a block header."""
+        return cls(calculateMidstate(swap_words(header[:64])), swap_words(header[64:76]))
+
+    def h7(self, nonces):
+        """H7 of the second hash (hash2[255:224]) for every nonce."""
+        nonces = np.asarray(nonces, dtype=np.uint32)
+        with np.errstate(over="ignore"):
+            a3, e3, (b, c, d, f, g, h) = self._round3
+            state = (np.uint32(a3) + nonces, np.uint32(b), np.uint32(c), np.uint32(d), np.uint32(e3) + nonces, np.uint32(f), np.uint32(g), np.uint32(h))
+            w = list(self._inner_known)
+            w[3] = nonces
+            _expand(self._inner_known, self._inner_plan, w)
+            for t in range(4, 64):
+                kw = self._inner_kw[t]
+                state = _round(state, kw if kw is not None else w[t] + np.uint32(K[t]))
+            hash1 = [x + np.uint32(s) for x, s in zip(state, self._midstate_words)]
+
+            w = hash1 + self._outer_known[8:]
+            _expand(self._outer_known, self._outer_plan, w)
+            t1 = np.uint32(self._outer_t1) + w[0]
+            a, b, c, d, e, f, g, h = (np.uint32(x) for x in INITIAL_STATE)
+            state = (t1 + np.uint32(self._outer_t2), a, b, c, d + t1, e, f, g)
+            for t in range(1, 61):
+                kw = self._outer_kw[t]
+                kw = kw if kw is not None else w[t] + np.uint32(K[t])
+                # H7 = h after round 63 + H0 = e after round 60 + H0, and e after
+                # round 60 needs a no later than after round 56
+                state = _round(state, kw) if t <= 56 else _e_round(state, kw)
+            return state[4] + np.uint32(INITIAL_STATE[7])
+
+    def sweep(self, nonces, target=FPGA_TARGET):
+        """The nonces (in the given order) whose double hash meets the target."""
+        nonces = np.asarray(nonces, dtype=np.uint32)
+        # the most significant word of the hash is H7 byteswapped
+        candidates = nonces[self.h7(nonces).byteswap() <= np.uint32(min(target >> 224, MASK))]
+        # the top word decides alone when all bits below it are set in the target
+        if (target + 1) % (1 << 224) == 0 or not len(candidates):
+            return candidates
+        _, hash2 = hash_nonces(self.midstate, self.tail, candidates)
+        return candidates[meets_target(hash2, target)]
+
+    def sweep_range(self, nonce_min=0, nonce_max=NONCE_RANGE - 1, target=FPGA_TARGET, batch_size=1 << 14):
+        """Sweep [nonce_min, nonce_max] in batches, yielding each nonce that meets the target."""
+        start = nonce_min
+        while start <= nonce_max:
+            stop = min(start + batch_size, nonce_max + 1)
+            for nonce in self.sweep(np.arange(start, stop, dtype=np.uint32), target):
+                yield int(nonce)
+            start = stop
+
+
+if __name__ == "__main__":
+    import time
+
+    import sweep
+    import test_hasher
+    from difficulty import hash_value
+    from trace_diff import block_data
+    from uart_host import header_nonce
+
+    genesis = bytes.fromhex(
+        "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d"
+    )
+    golden = 0x1DAC2B7C
+    job = Job.from_header(genesis)
+    assert job.midstate.hex() == "339a90bcf0bf58637daccc90a8ca591ee9d8c8c3c803014f3687b1961bf91947"
+
+    # H7 against the full hash, also for an easy target that needs the rehash
+    nonces = np.arange(golden - 5000, golden + 5000, dtype=np.uint32)
+    _, hash2 = sweep.hash_nonces(job.midstate, job.tail, nonces)
+    assert (job.h7(nonces) == hash2[7]).all()
+    easy = (1 << 248) - 1
+    assert list(job.sweep(nonces, easy)) == list(sweep.sweep(job.midstate, job.tail, nonces, easy))
+    assert list(job.sweep(nonces)) == [golden]
+
+    def per_nonce(header, nonce):
+        # what the helpers do per nonce without a Job: midstate of the first block, both hashes
+        midstate = int.from_bytes(calculateMidstate(swap_words(header[:64])), "little")
+        _, hash2 = test_hasher.double_hash(midstate, block_data(int.from_bytes(swap_words(header[64:76]), "little"), nonce))
+        return hash2 >> 224 == 0
+
+    count = 2000
+    start = time.perf_counter()
+    found = [n for n in range(golden - count + 1, golden + 1) if per_nonce(genesis, n)]
+    baseline = count / (time.perf_counter() - start)
+    assert found == [golden]
+    assert hash_value(genesis + struct.pack("<I", header_nonce(golden))) <= FPGA_TARGET
+
+    def rate(f, count, repeats=3):
+        best = 0
+        for _ in range(repeats):
+            start = time.perf_counter()
+            f()
+            best = max(best, count / (time.perf_counter() - start))
+        return best
+
+    # the same batch size for both, so only the precomputation differs
+    count = 1 << 20
+    vectorized = rate(lambda: list(sweep.sweep_range(job.midstate, job.tail, golden - count + 1, golden, batch_size=1 << 14)), count)
+    precomputed = rate(lambda: list(job.sweep_range(golden - count + 1, golden)), count)
+    assert list(job.sweep_range(golden - count + 1, golden)) == [golden]
+
+    print("calculateMidstate + test_hasher.hash: %10.0f nonces/s" % baseline)
+    print("sweep.sweep:                          %10.0f nonces/s (%.0fx)" % (vectorized, vectorized / baseline))
+    print("Job.sweep:                            %10.0f nonces/s (%.0fx, %.2fx sweep.sweep)" % (precomputed, precomputed / baseline, precomputed / vectorized))
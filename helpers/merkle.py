@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Incremental coinbase and merkle root computation for extranonce2 rolling.
+#
+# For a Stratum V1 job the coinbase is coinb1 + extranonce1 + extranonce2 +
+# coinb2 and the merkle root is its double SHA-256 folded with the merkle
+# branch. MerkleEngine hashes coinb1 + extranonce1 once per job and keeps the
+# hashlib state, so a roll only hashes extranonce2 + coinb2 on a copy of it,
+# the second SHA-256 and the branch. The version and previous block hash, the
+# first 36 bytes of the header, are packed once as well.
+#
+# Per extranonce2 the copy saves little: coinb1 is short next to the dozen
+# hashes of the branch, so a roll costs about as much as a merkle root from
+# scratch. roll_many spreads batches over a process pool (as
+# midstate.calculateMidstates does), in chunks: hashlib only gives up the GIL
+# for inputs of about 2 KiB and up, so threads do not run these in parallel.
+# An engine is pickled as its job fields and rebuilt in the worker, hashlib
+# states cannot be pickled.
+#
+# Usage: python3 merkle.py
+# Checks the engine against StratumJob.merkle_root and prints the throughput.
+
+import hashlib
+import struct
+
+
+class MerkleEngine:
+    """Merkle roots and first header blocks for one job, extranonce2 after extranonce2."""
+
+    def __init__(self, coinb1, extranonce1, coinb2, merkle_branch, version, prev_hash):
+        self._args = (bytes(coinb1), bytes(extranonce1), bytes(coinb2), [bytes(branch) for branch in merkle_branch], version, bytes(prev_hash))
+        self.coinb2 = self._args[2]
+        self.merkle_branch = self._args[3]
+        self._coinbase = hashlib.sha256(self._args[0] + self._args[1])
+        # version and previous block hash, as they go into the header
+        self._prefix = struct.pack("<I", version) + self._args[5]
+
+    def __reduce__(self):
+        return MerkleEngine, self._args
+
+    def merkle_root(self, extranonce2):
+        sha = self._coinbase.copy()
+        sha.update(extranonce2 + self.coinb2)
+        root = hashlib.sha256(sha.digest()).digest()
+        for branch in self.merkle_branch:
+            root = hashlib.sha256(hashlib.sha256(root + branch).digest()).digest()
+        return root
+
+    def roll(self, extranonces2):
+        """(merkle root, first 64 bytes of the header) for each extranonce2.
+        The header goes on with root[28:], ntime and nbits."""
+        prefix = self._prefix
+        result = []
+        for extranonce2 in extranonces2:
+            root = self.merkle_root(extranonce2)
+            result.append((root, prefix + root[:28]))
+        return result
+
+    def roll_many(self, extranonces2, executor=None, chunk=1024):
+        """roll over `executor` (a concurrent.futures.ProcessPoolExecutor), `chunk`
+        extranonce2 values per task, results in order."""
+        extranonces2 = list(extranonces2)
+        if executor is None or len(extranonces2) <= chunk:
+            return self.roll(extranonces2)
+        chunks = [extranonces2[i : i + chunk] for i in range(0, len(extranonces2), chunk)]
+        return [pair for pairs in executor.map(self.roll, chunks) for pair in pairs]
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    from difficulty import double_sha256
+    from stratum_v1 import StratumJob
+
+    def merkle_root(job, extranonce2):
+        root = double_sha256(job.coinb1 + job.extranonce1 + extranonce2 + job.coinb2)
+        for branch in job.merkle_branch:
+            root = double_sha256(root + branch)
+        return root
+
+    # a job with a 12 step merkle branch (~4000 transactions)
+    branch = [os.urandom(32).hex() for _ in range(12)]
+    job = StratumJob(
+        "1", os.urandom(32).hex(), os.urandom(60).hex(), os.urandom(120).hex(), branch, "20000000", "1703a30c", "6551c4e8", True, os.urandom(4), 4, 1
+    )
+    engine = job.engine
+
+    extranonces2 = [struct.pack(">I", i) for i in range(1 << 15)]
+    executor = ProcessPoolExecutor()
+    pairs = engine.roll_many(extranonces2, executor)
+    for extranonce2, (root, block) in zip(extranonces2[::97], pairs[::97]):
+        assert root == merkle_root(job, extranonce2)
+        assert block == struct.pack("<I", job.version) + job.prev_hash + root[:28]
+        assert job.header(extranonce2) == block + root[28:] + struct.pack("<II", job.ntime, job.nbits)
+
+    def rate(f, count):
+        start = time.perf_counter()
+        f()
+        return count / (time.perf_counter() - start)
+
+    plain = rate(lambda: [merkle_root(job, extranonce2) for extranonce2 in extranonces2], len(extranonces2))
+    cached = rate(lambda: engine.roll(extranonces2), len(extranonces2))
+    pooled = rate(lambda: engine.roll_many(extranonces2, executor), len(extranonces2))
+    executor.shutdown()
+    print("merkle roots: %.0f/s from scratch, %.0f/s incremental (%.2fx)" % (plain, cached, cached / plain))
+    print("roll_many on %d processes: %.0f/s (%.1fx)" % (executor._max_workers, pooled, pooled / plain))
+    print("OK")
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+# Counters and histograms of the miner host, served as Prometheus text and as
+# a JSON snapshot over HTTP.
+#
+# UartHost, CpuMiner and StratumV1Client take a HostMetrics / PoolMetrics and
+# count into it; without one they count into a private registry nobody reads.
+# Per board (label `board`):
+#   miner_uart_crc_failures_total   frames the board rejected for their CRC (MSG_RESEND)
+#   miner_uart_retransmits_total    frames sent again, on MSG_RESEND or a timeout
+#   miner_uart_invalid_total        MSG_INVALID answers
+#   miner_jobs_pushed_total         PUSH_JOB frames submitted
+#   miner_jobs_acked_total          PUSH_JOB frames ACKed
+#   miner_nonces_total              golden nonces received
+#   miner_uart_round_trip_seconds   request to answer
+#   miner_job_switch_seconds        pool notify to the board ACKing work of that job
+#   miner_effective_hashrate        hashes/s the nonces stand for at the board's target
+# Per pool (label `pool`):
+#   miner_shares_total              submitted shares by result
+#   miner_share_submit_seconds      mining.submit to the pool's answer
+#   miner_pool_effective_hashrate   hashes/s the accepted shares stand for
+#
+# A nonce that meets target T stands for 2**256 / (T + 1) hashes on average,
+# 2**32 at the FPGA's target, so the effective hashrate is the work of the
+# nonces in the last `window` seconds over that time. A board that loses
+# hashes (a bad link, a miscounting core) falls behind its nominal rate here.
+#
+# Usage: python3 metrics.py [--port PORT]    serves the metrics of a demo board and pool
+
+import asyncio
+import bisect
+import collections
+import json
+import time
+
+from difficulty import FPGA_TARGET
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# of miner_pool_reconnect_seconds
+RECONNECT_PHASES = ("tcp", "handshake", "setup", "first_job", "total")
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from `function()` whenever the metrics are collected."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram:
+    """Cumulative-bucket histogram like Prometheus'."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q-quantile falls into (inf past the last bucket)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Family:
+    """A metric and its children, one per combination of label values."""
+
+    def __init__(self, name, help, kind, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self._factory = factory
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self._factory()
+        return child
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs)
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.families = collections.OrderedDict()
+
+    def _family(self, name, help, kind, labelnames, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, help, kind, labelnames, factory)
+        elif family.kind != kind or family.labelnames != tuple(labelnames):
+            raise ValueError("metric %s is already registered differently" % name)
+        return family
+
+    def counter(self, name, help, labelnames=()):
+        return self._family(name, help, "counter", labelnames, Counter)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._family(name, help, "gauge", labelnames, Gauge)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._family(name, help, "histogram", labelnames, lambda: Histogram(buckets))
+
+    def prometheus_text(self):
+        """The text exposition format, version 0.0.4."""
+        lines = []
+        for family in self.families.values():
+            lines.append("# HELP %s %s" % (family.name, family.help))
+            lines.append("# TYPE %s %s" % (family.name, family.kind))
+            for values, child in family.children.items():
+                labels = _label_text(family.labelnames, values)
+                if family.kind == "counter":
+                    lines.append("%s%s %s" % (family.name, labels, _number(child.value)))
+                elif family.kind == "gauge":
+                    lines.append("%s%s %s" % (family.name, labels, _number(child.get())))
+                else:
+                    cumulative = 0
+                    for bound, n in zip(child.buckets + (float("inf"),), child.counts):
+                        cumulative += n
+                        lines.append("%s_bucket%s %d" % (family.name, _label_text(family.labelnames, values, [("le", _number(bound))]), cumulative))
+                    lines.append("%s_sum%s %s" % (family.name, labels, _number(child.sum)))
+                    lines.append("%s_count%s %d" % (family.name, labels, child.count))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Every metric as plain data, for JSON."""
+        snapshot = {}
+        for family in self.families.values():
+            samples = []
+            for values, child in family.children.items():
+                sample = {"labels": dict(zip(family.labelnames, values))}
+                if family.kind == "counter":
+                    sample["value"] = child.value
+                elif family.kind == "gauge":
+                    sample["value"] = child.get()
+                else:
+                    sample.update(count=child.count, sum=child.sum, buckets=dict(zip([_number(b) for b in child.buckets + (float("inf"),)], child.counts)))
+                    sample.update(p50=child.quantile(0.5), p90=child.quantile(0.9), p99=child.quantile(0.99))
+                samples.append(sample)
+            snapshot[family.name] = {"type": family.kind, "help": family.help, "samples": samples}
+        return snapshot
+
+
+class HashrateEstimator:
+    """Hashes/s from the targets of the nonces found in the last `window` seconds."""
+
+    def __init__(self, window=600.0):
+        self.window = window
+        self.started = time.monotonic()
+        self._found = collections.deque()
+        self._work = 0
+
+    def observe(self, target, now=None):
+        now = time.monotonic() if now is None else now
+        work = (1 << 256) // (target + 1)
+        self._found.append((now, work))
+        self._work += work
+        self._expire(now)
+
+    def _expire(self, now):
+        while self._found and self._found[0][0] < now - self.window:
+            self._work -= self._found.popleft()[1]
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        elapsed = min(self.window, now - self.started)
+        return self._work / elapsed if elapsed > 0 else 0.0
+
+
+class HostMetrics:
+    """The metrics of one board; `target` is what its nonces meet."""
+
+    def __init__(self, registry=None, board="", target=FPGA_TARGET):
+        registry = registry if registry is not None else Registry()
+        labels = {"board": board}
+        self.target = target
+        self.crc_failures = registry.counter("miner_uart_crc_failures_total", "Frames the board rejected for their CRC (MSG_RESEND).", ["board"]).labels(**labels)
+        self.retransmits = registry.counter("miner_uart_retransmits_total", "Frames sent again after MSG_RESEND or a timeout.", ["board"]).labels(**labels)
+        self.invalid = registry.counter("miner_uart_invalid_total", "MSG_INVALID answers.", ["board"]).labels(**labels)
+        self.jobs_pushed = registry.counter("miner_jobs_pushed_total", "PUSH_JOB frames submitted.", ["board"]).labels(**labels)
+        self.jobs_acked = registry.counter("miner_jobs_acked_total", "PUSH_JOB frames ACKed.", ["board"]).labels(**labels)
+        self.nonces = registry.counter("miner_nonces_total", "Golden nonces received.", ["board"]).labels(**labels)
+        self.stale_nonces = registry.counter("miner_stale_nonces_total", "Golden nonces of stale work, dropped before verification.", ["board"]).labels(**labels)
+        self.preempted = registry.counter("miner_jobs_preempted_total", "Job frames dropped for work of a clean job before they reached the board.", ["board"]).labels(**labels)
+        self.round_trip = registry.histogram("miner_uart_round_trip_seconds", "Request to answer on the serial link.", ["board"]).labels(**labels)
+        self.job_switch = registry.histogram("miner_job_switch_seconds", "Pool notify to the board ACKing work of that job.", ["board"]).labels(**labels)
+        self.hashrate = HashrateEstimator()
+        registry.gauge("miner_effective_hashrate", "Hashes/s the board's nonces stand for.", ["board"]).labels(**labels).set_function(self.hashrate.rate)
+
+    def nonce(self):
+        self.nonces.inc()
+        self.hashrate.observe(self.target)
+
+
+class PoolMetrics:
+    """The metrics of one pool session."""
+
+    def __init__(self, registry=None, pool=""):
+        registry = registry if registry is not None else Registry()
+        shares = registry.counter("miner_shares_total", "Shares submitted, by result.", ["pool", "result"])
+        self.accepted = shares.labels(pool=pool, result="accepted")
+        self.rejected = shares.labels(pool=pool, result="rejected")
+        self.submit = registry.histogram("miner_share_submit_seconds", "mining.submit to the pool's answer.", ["pool"]).labels(pool=pool)
+        self.hashrate = HashrateEstimator()
+        registry.gauge("miner_pool_effective_hashrate", "Hashes/s the accepted shares stand for.", ["pool"]).labels(pool=pool).set_function(self.hashrate.rate)
+        reconnect = registry.histogram("miner_pool_reconnect_seconds", "Time to (re)connect by phase: TCP, Noise handshake, channel setup, first job and all of it.", ["pool", "phase"], (0.00025, 0.0005) + LATENCY_BUCKETS)
+        self.reconnect = {phase: reconnect.labels(pool=pool, phase=phase) for phase in RECONNECT_PHASES}
+
+    def share(self, accepted, target, seconds):
+        self.submit.observe(seconds)
+        if accepted:
+            self.accepted.inc()
+            self.hashrate.observe(target)
+        else:
+            self.rejected.inc()
+
+
+class MetricsServer:
+    """GET /metrics (Prometheus text) and /metrics.json (snapshot) over HTTP/1.0."""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.server = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # skip the request headers
+            while (await reader.readline()).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.registry.prometheus_text()
+            elif path == "/metrics.json":
+                status, content_type, body = "200 OK", "application/json", json.dumps(self.registry.snapshot())
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            body = body.encode()
+            writer.write(("HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n" % (status, content_type, len(body))).encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def fetch(port, path, host="127.0.0.1"):
+    """The body of GET `path` from a MetricsServer."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(("GET %s HTTP/1.0\r\n\r\n" % path).encode())
+    response = await reader.read()
+    writer.close()
+    return response.split(b"\r\n\r\n", 1)[1].decode()
+
+
+async def main(port):
+    import random
+
+    registry = Registry()
+    board = HostMetrics(registry, "demo", target=FPGA_TARGET >> 20)
+    pool = PoolMetrics(registry, "mock")
+    for _ in range(200):
+        board.round_trip.observe(random.uniform(0.004, 0.02))
+        board.jobs_pushed.inc()
+        board.jobs_acked.inc()
+        board.nonce()
+    board.crc_failures.inc()
+    board.retransmits.inc()
+    pool.share(True, FPGA_TARGET >> 20, 0.05)
+
+    server = await MetricsServer(registry).start(port=port)
+    print("serving on http://127.0.0.1:%d/metrics and /metrics.json" % server.port)
+    if port:
+        await asyncio.Event().wait()
+    print(await fetch(server.port, "/metrics"))
+    print(json.dumps(json.loads(await fetch(server.port, "/metrics.json"))["miner_uart_round_trip_seconds"]["samples"][0], indent=1))
+    await server.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve demo metrics.")
+    parser.add_argument("--port", type=int, default=0, help="serve until interrupted on this port; without it, print one scrape")
+    asyncio.run(main(parser.parse_args().port))
@@ -26,6 +26,7 @@
 ### Where the hex data is the first 511 bits of the block header
 
 import struct
+from collections import OrderedDict
 
 # Some SHA-256 constants...
 K = [
@@ -57,7 +58,7 @@ def rotateright(i,p):
     return i>>p | ((i<<(32-p)) & 0xFFFFFFFF)
 
 def addu32(*i):
-    return sum(list(i))&0xFFFFFFFF
+    return sum(i)&0xFFFFFFFF
 
 def calculateMidstate(data, state=None, rounds=None):
     """Given a 512-bit (64-byte) block of (little-endian byteswapped) data,
@@ -90,15 +91,15 @@ def calculateMidstate(data, state=None, rounds=None):
         ma = (a&b) ^ (a&c) ^ (b&c)
         ch = (e&f) ^ ((~e)&g)
 
-        h = addu32(h,w[0],k,ch,s1)
-        d = addu32(d,h)
-        h = addu32(h,ma,s0)
+        t1 = h + w[0] + k + ch + s1
+        d = (d + t1) & 0xFFFFFFFF
+        h = (t1 + ma + s0) & 0xFFFFFFFF
 
         a,b,c,d,e,f,g,h = h,a,b,c,d,e,f,g
 
         s0 = rotateright(w[1],7) ^ rotateright(w[1],18) ^ (w[1] >> 3)
         s1 = rotateright(w[14],17) ^ rotateright(w[14],19) ^ (w[14] >> 10)
-        w.append(addu32(w[0], s0, w[9], s1))
+        w.append((w[0] + s0 + w[9] + s1) & 0xFFFFFFFF)
         w.pop(0)
 
     if rounds is None:
@@ -111,4 +112,51 @@ def calculateMidstate(data, state=None, rounds=None):
         g = addu32(g, G0)
         h = addu32(h, H0)
 
-    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
\ No newline at end of file
+    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
+
+# Midstates of recently seen blocks, most recently used last. Rolling ntime,
+# version or extranonce2 tends to revisit the same 64-byte blocks, so they are
+# looked up here before being hashed again.
+CACHE_SIZE = 4096
+_cache = OrderedDict()
+
+def _calculateKey(key):
+    data, state, rounds = key
+    return calculateMidstate(data, state, rounds)
+
+def calculateMidstates(blocks, state=None, rounds=None, executor=None):
+    """Calculate the midstates of many 64-byte blocks (header prefixes),
+    returned in the same order as the blocks.
+
+    Results are kept in an LRU cache keyed on the block and the state/rounds
+    arguments. Blocks that are not cached are hashed in this process, or
+    fanned out over `executor` (e.g. a concurrent.futures.ProcessPoolExecutor)
+    if one is given.
+    """
+    state = None if state is None else bytes(state)
+    keys = [(bytes(data), state, rounds) for data in blocks]
+
+    found = {}
+    for key in keys:
+        if key in _cache and key not in found:
+            _cache.move_to_end(key)
+            found[key] = _cache[key]
+
+    missing = [key for key in dict.fromkeys(keys) if key not in found]
+    if executor is not None and len(missing) > 1:
+        chunksize = max(1, len(missing) // 64)
+        results = executor.map(_calculateKey, missing, chunksize=chunksize)
+    else:
+        results = map(_calculateKey, missing)
+
+    for key, midstate in zip(missing, results):
+        found[key] = midstate
+        _cache[key] = midstate
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return [found[key] for key in keys]
+
+def cachedMidstate(data, state=None, rounds=None):
+    """calculateMidstate backed by the same LRU cache as calculateMidstates."""
+    return calculateMidstates([data], state, rounds)[0]
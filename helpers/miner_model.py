@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# Cycle-level timing model of fpgaminer_top.v / sha256_transform.v, to pick
+# LOOP_LOG2 and the hash clock without synthesizing every candidate.
+#
+# MinerModel predicts, for a LOOP_LOG2 and a hash clock:
+#   - hashes per second (one double hash every LOOP cycles)
+#   - latency from reset to the first valid second hash
+#   - delay from reset until new_golden_nonce for a golden nonce d nonces
+#     after nonce_min
+#
+# new_golden_nonce goes high PIPELINE_EDGES + LOOP * d + phase edges after the
+# reset edge: two transforms of 64 pipelined rounds plus their tx_hash
+# registers (130), golden_nonce_found and new_golden_nonce (2). cnt is not
+# reset, so where it stands on the reset edge adds phase = (LOOP - 2 - cnt) mod
+# LOOP edges. nonce_min itself is hashed with the data_buf of before the reset
+# (and, with LOOP > 1, only if cnt wraps on the reset edge), so the first nonce
+# that counts is nonce_min + 1 (d >= 1).
+#
+# RtlSimulation is a Python re-implementation of the registers of
+# fpgaminer_top.v and both sha256_transform instances, stepped edge by edge
+# (the digester pipeline, the feedback muxes, the nonce/cnt control and the
+# golden nonce check). The model's formulas are checked against it, not
+# against the Verilog: both are written from the same reading of the RTL, so
+# a misreading shows up in neither. run_testbench() drives it like
+# testbenches/test_fpgaminer_top.v (genesis block, 10 ns clock, reset held over
+# the first edge at 105 ns) and predicts the simulation time of the "Finished
+# tests" line, which the testbench does not print.
+#
+# Usage: python3 miner_model.py [--clock MHz ...]    checks the model against RtlSimulation, prints the planning table
+
+import argparse
+
+from midstate import K
+
+MASK = 0xFFFFFFFF
+NONCE_RANGE = 1 << 32
+
+# second block padding words 4..15 (640 bit message) and the outer hash's words 8..15 (256 bit message)
+BLOCK2_PADDING = [0x80000000] + [0] * 10 + [0x00000280]
+HASH2_PADDING = [0x80000000] + [0] * 6 + [0x00000100]
+# rx_state of the second transform
+INITIAL_STATE = [0x6A09E667, 0xBB67AE85, 0x3C6EF372, 0xA54FF53A, 0x510E527F, 0x9B05688C, 0x1F83D9AB, 0x5BE0CD19]
+
+# the genesis block as test_fpgaminer_top.v feeds it
+GENESIS_MIDSTATE = 0x4719F91B96B187364F0103C8C3C8D8E91E59CAA890CCAC7D6358BFF0BC909A33
+GENESIS_WORK_DATA = 0xFFFF001D29AB5F494B1E5E4A
+GENESIS_NONCE = 0x1DAC2B7C
+
+# two transforms of 64 rounds + tx_hash, golden_nonce_found, new_golden_nonce
+PIPELINE_EDGES = 2 * (64 + 1) + 2
+
+# README: LUT4s used at LOOP_LOG2 = 3, the design roughly doubles with every step down
+LUTS_AT_LOOP_LOG2_3 = 32001
+ECP5_85F_LUTS = 83640
+# the hash clock top.v gets from its PLL
+DEFAULT_CLOCK = 100.5e6
+
+
+def rotr(x, n):
+    return (x >> n | x << (32 - n)) & MASK
+
+
+def words(value, n):
+    """Split a Verilog vector into n 32-bit words, word 0 = bits 31:0 (`IDX(0))."""
+    return [(value >> 32 * i) & MASK for i in range(n)]
+
+
+def digest(k, w, state):
+    """One sha256_digester: (tx_w, tx_state) from rx_w, rx_state."""
+    s0 = rotr(w[1], 7) ^ rotr(w[1], 18) ^ (w[1] >> 3)
+    s1 = rotr(w[14], 17) ^ rotr(w[14], 19) ^ (w[14] >> 10)
+    new_w = (s1 + w[9] + s0 + w[0]) & MASK
+
+    a, b, c, d, e, f, g, h = state
+    e0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
+    e1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
+    ch = (e & f) ^ (~e & g)
+    maj = (a & b) ^ (a & c) ^ (b & c)
+    t1 = (h + e1 + ch + w[0] + k) & MASK
+    t2 = e0 + maj
+    return w[1:] + [new_w], [(t1 + t2) & MASK, a, b, c, (d + t1) & MASK, e, f, g]
+
+
+class Transform:
+    """The registers of one sha256_transform: 64/LOOP digesters and tx_hash."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.w = [[0] * 16 for _ in range(64 // loop)]
+        self.state = [[0] * 8 for _ in range(64 // loop)]
+        self.tx_hash = [MASK] * 8
+
+    def next(self, feedback, cnt, rx_state, rx_input):
+        """Register values after the next edge, computed from the current ones."""
+        w, state = [], []
+        for i in range(len(self.w)):
+            if feedback:
+                rx_w, rx_s = self.w[i], self.state[i]
+            elif i > 0:
+                rx_w, rx_s = self.w[i - 1], self.state[i - 1]
+            else:
+                rx_w, rx_s = rx_input, rx_state
+            tx_w, tx_s = digest(K[self.loop * i + cnt], rx_w, rx_s)
+            w.append(tx_w)
+            state.append(tx_s)
+        tx_hash = self.tx_hash
+        if not feedback:
+            tx_hash = [(x + y) & MASK for x, y in zip(rx_state, self.state[-1])]
+        return w, state, tx_hash
+
+    def update(self, registers):
+        self.w, self.state, self.tx_hash = registers
+
+
+class RtlSimulation:
+    """fpgaminer_top.v, one posedge of hash_clk per step()."""
+
+    def __init__(self, loop_log2, midstate, work_data, nonce_min, golden_mask=MASK, nonce_max=MASK):
+        self.loop = 1 << loop_log2
+        self.golden_mask = golden_mask
+        self.midstate = words(midstate, 8)
+        self.work_data = words(work_data, 3)
+        self.nonce_min = nonce_min
+        self.nonce_max = nonce_max
+        if self.loop == 1:
+            self.golden_nonce_offset = 131
+        elif self.loop == 2:
+            self.golden_nonce_offset = 66
+        else:
+            self.golden_nonce_offset = (1 << (7 - loop_log2)) + 1
+
+        self.data = [0] * 16
+        self.nonce = 0
+        self.cnt = 0
+        self.wait_for_work = 1
+        self.midstate_buf = [0] * 8
+        self.data_buf = [0] * 3
+        self.feedback_d1 = 0
+        self.golden_nonce_found = 0
+        self.new_golden_nonce = 0
+        self.golden_nonce = 0
+        self.uut = Transform(self.loop)
+        self.uut2 = Transform(self.loop)
+        self.cycle = 0
+        # (edge, hash2) of every second hash the golden check looks at
+        self.checked = []
+
+    def step(self, reset=False):
+        loop = self.loop
+        feedback = self.cnt != 0
+        cnt_next = 0 if loop == 1 else (self.cnt + 1) & (loop - 1)
+        feedback_next = cnt_next != 0
+        if reset:
+            nonce_next = self.nonce_min
+        else:
+            nonce_next = self.nonce if feedback_next else (self.nonce + 1) & MASK
+
+        uut = self.uut.next(feedback, self.cnt, self.midstate_buf, self.data)
+        uut2 = self.uut2.next(feedback, self.cnt, INITIAL_STATE, self.uut.tx_hash + HASH2_PADDING)
+        hash2 = self.uut2.tx_hash
+
+        if not self.feedback_d1 and not self.wait_for_work:
+            self.checked.append((self.cycle, hash2))
+
+        # non-blocking assignments, in the order of the always block: the reset
+        # branch only keeps wait_for_work, the later assignments override the rest
+        wait_for_work = 0 if reset else self.wait_for_work
+        if not reset and not self.feedback_d1 and not self.wait_for_work and (nonce_next - self.golden_nonce_offset) & MASK == self.nonce_max:
+            wait_for_work = 1
+        golden_nonce = self.golden_nonce
+        if self.golden_nonce_found:
+            wait_for_work = 1
+            golden_nonce = (self.nonce - self.golden_nonce_offset) & MASK
+
+        self.new_golden_nonce = self.golden_nonce_found
+        self.golden_nonce_found = int(hash2[7] & self.golden_mask == 0 and not self.feedback_d1 and not self.wait_for_work)
+        self.feedback_d1 = int(feedback)
+        self.cnt = cnt_next
+        self.data = self.data_buf + [nonce_next] + BLOCK2_PADDING
+        self.nonce = nonce_next
+        self.midstate_buf = self.midstate
+        self.data_buf = self.work_data
+        self.wait_for_work = wait_for_work
+        self.golden_nonce = golden_nonce
+        self.uut.update(uut)
+        self.uut2.update(uut2)
+        self.cycle += 1
+
+
+def compress(state, block):
+    out = state
+    for k in K:
+        block, out = digest(k, block, out)
+    return [(x + y) & MASK for x, y in zip(state, out)]
+
+
+def double_hash(midstate, work_data, nonce):
+    """hash2 of fpgaminer_top for a nonce, as 8 words (word 7 = hash2[255:224])."""
+    hash1 = compress(words(midstate, 8), words(work_data, 3) + [nonce] + BLOCK2_PADDING)
+    return compress(INITIAL_STATE, hash1 + HASH2_PADDING)
+
+
+class MinerModel:
+    """Timing of fpgaminer_top at a LOOP_LOG2 and hash clock (Hz)."""
+
+    def __init__(self, loop_log2=5, clock=DEFAULT_CLOCK):
+        if not 0 <= loop_log2 <= 5:
+            raise ValueError("LOOP_LOG2 must be in [0, 5]")
+        self.loop_log2 = loop_log2
+        self.loop = 1 << loop_log2
+        self.clock = clock
+
+    @property
+    def hashrate(self):
+        return self.clock / self.loop
+
+    def phase(self, cnt_at_reset=0):
+        return (self.loop - 2 - cnt_at_reset) % self.loop
+
+    def golden_edge(self, d, cnt_at_reset=0):
+        """Edges after the reset edge until new_golden_nonce is high, for a
+        golden nonce nonce_min + d."""
+        if d < 1:
+            raise ValueError("the first nonce that is hashed for sure is nonce_min + 1")
+        return PIPELINE_EDGES + self.loop * d + self.phase(cnt_at_reset)
+
+    def first_hash_edge(self, cnt_at_reset=0):
+        """Edges after the reset edge until hash2 of nonce_min + 1 is checked."""
+        return self.golden_edge(1, cnt_at_reset) - 1
+
+    def _seconds(self, edges, cnt_at_reset):
+        if cnt_at_reset is None:
+            # cnt runs freely, so on average it is anywhere in the loop
+            edges = sum(edges(cnt) for cnt in range(self.loop)) / self.loop
+        else:
+            edges = edges(cnt_at_reset)
+        return edges / self.clock
+
+    def first_hash_latency(self, cnt_at_reset=None):
+        return self._seconds(self.first_hash_edge, cnt_at_reset)
+
+    def golden_delay(self, d, cnt_at_reset=None):
+        """Seconds from the reset edge to new_golden_nonce."""
+        return self._seconds(lambda cnt: self.golden_edge(d, cnt), cnt_at_reset)
+
+    def seconds_per_golden_nonce(self, target=(1 << 224) - 1):
+        """Expected time between golden nonces (H7 == 0 by default)."""
+        return (1 << 256) / (target + 1) / self.hashrate
+
+    def luts(self):
+        """LUT4 estimate, scaled from the README's LOOP_LOG2 = 3 build."""
+        return LUTS_AT_LOOP_LOG2_3 * 2 ** (3 - self.loop_log2)
+
+
+def simulate(loop_log2, d, cnt_at_reset=0, midstate=GENESIS_MIDSTATE, work_data=GENESIS_WORK_DATA, golden=GENESIS_NONCE, max_edges=10000):
+    """Run RtlSimulation from a reset with nonce_min = golden - d, returns the simulation
+    after the edge that raised new_golden_nonce (sim.cycle - 1 is that edge)."""
+    sim = RtlSimulation(loop_log2, midstate, work_data, (golden - d) & MASK)
+    sim.cnt = cnt_at_reset
+    sim.step(reset=True)
+    while not sim.new_golden_nonce:
+        if sim.cycle > max_edges:
+            raise RuntimeError("no golden nonce after %d edges" % max_edges)
+        sim.step()
+    return sim
+
+
+def run_testbench(loop_log2=0):
+    """test_fpgaminer_top.v in RtlSimulation: the predicted $time (ns) of "Finished tests" and the nonce."""
+    reset_edge_ns, period_ns = 105, 10
+    sim = simulate(loop_log2, 2)
+    # the testbench samples new_golden_nonce on the edge after it went high
+    return reset_edge_ns + sim.cycle * period_ns, sim.golden_nonce
+
+
+def validate():
+    """Check MinerModel's formulas against RtlSimulation for every LOOP_LOG2 and cnt phase."""
+    for loop_log2 in range(6):
+        model = MinerModel(loop_log2)
+        for cnt in range(model.loop):
+            for d in (1, 3):
+                sim = simulate(loop_log2, d, cnt)
+                assert sim.golden_nonce == GENESIS_NONCE, (loop_log2, cnt, d, hex(sim.golden_nonce))
+                assert sim.cycle - 1 == model.golden_edge(d, cnt), (loop_log2, cnt, d, sim.cycle - 1, model.golden_edge(d, cnt))
+
+            checked = dict(sim.checked)
+            first = model.first_hash_edge(cnt)
+            assert checked[first] == double_hash(GENESIS_MIDSTATE, GENESIS_WORK_DATA, (GENESIS_NONCE - 3 + 1) & MASK)
+            assert not any(edge < first and h == double_hash(GENESIS_MIDSTATE, GENESIS_WORK_DATA, (GENESIS_NONCE - 3) & MASK) for edge, h in checked.items())
+
+        # a range ending at nonce_max idles once that hash is checked, a golden nonce in it is still reported
+        for nonce_max in (GENESIS_NONCE - 1, GENESIS_NONCE):
+            sim = RtlSimulation(loop_log2, GENESIS_MIDSTATE, GENESIS_WORK_DATA, GENESIS_NONCE - 3, nonce_max=nonce_max)
+            sim.step(reset=True)
+            while not sim.wait_for_work and sim.cycle < 10000:
+                sim.step()
+            sim.step()
+            assert sim.checked[-1][1] == double_hash(GENESIS_MIDSTATE, GENESIS_WORK_DATA, nonce_max), (loop_log2, hex(nonce_max))
+            assert sim.new_golden_nonce == (nonce_max == GENESIS_NONCE), (loop_log2, hex(nonce_max))
+            assert sim.golden_nonce == (GENESIS_NONCE if sim.new_golden_nonce else 0), (loop_log2, hex(nonce_max))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Timing model of fpgaminer_top.v.")
+    parser.add_argument("--clock", type=float, action="append", help="hash clock in MHz (repeatable, default 100.5)")
+    parser.add_argument("--skip-validation", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_validation:
+        validate()
+        time_ns, nonce = run_testbench()
+        print("model matches RtlSimulation for LOOP_LOG2 0..5 and every cnt phase")
+        print("RtlSimulation of test_fpgaminer_top.v (LOOP_LOG2=0): nonce %08x, predicted at %d ns" % (nonce, time_ns))
+
+    print()
+    print("LOOP_LOG2  clock MHz       MH/s  first hash us  golden nonce after (d=1M)  s per diff-1 nonce   LUT4s (est.)")
+    for clock in args.clock or [DEFAULT_CLOCK / 1e6]:
+        for loop_log2 in range(6):
+            model = MinerModel(loop_log2, clock * 1e6)
+            fits = "" if model.luts() <= ECP5_85F_LUTS else " does not fit"
+            print(
+                "%9d  %9.3f  %9.3f  %13.2f  %23.2f ms  %18.1f  %13d%s"
+                % (loop_log2, clock, model.hashrate / 1e6, model.first_hash_latency() * 1e6, model.golden_delay(1 << 20) * 1e3, model.seconds_per_golden_nonce(), model.luts(), fits)
+            )
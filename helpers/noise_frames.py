@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Zero-copy framing for the Noise transport messages used by stratum_v2.py.
+#
+# A transport message is a 2 byte little-endian length followed by the
+# ciphertext of one Stratum V2 frame. FrameReader receives into a preallocated
+# ring buffer, reassembles messages split across reads and decrypts them in
+# place. FrameWriter builds several frames back to back in a preallocated
+# buffer, encrypting each in place, so a batch goes out with a single send.
+#
+# In-place encryption needs the *_into AEAD methods of `cryptography` 47 and
+# later (noise-connector-requirements.txt pins one); with older releases
+# TransportCipher goes through the CipherState and copies the result into the
+# buffer instead. It also needs the CipherState's key, which dissononce keeps
+# private: cipher_key reads it for the dissononce releases known to store it.
+#
+# Usage: python3 noise_frames.py    benchmarks frames/sec and allocated bytes per frame
+
+import importlib.metadata
+import struct
+
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.exceptions import InvalidTag
+from dissononce.cipher.chachapoly import ChaChaPolyCipher
+from dissononce.exceptions.decrypt import DecryptFailedException
+
+LENGTH_SIZE = 2
+MAX_MESSAGE = 65535
+MAC_SIZE = 16
+# extension_type U16, msg_type U8, msg_length U24
+FRAME_HEADER_SIZE = 6
+# dissononce releases whose CipherState keeps its key in `_key`
+KEY_LAYOUT_VERSIONS = ("0.34.",)
+
+
+def cipher_key(cipherstate):
+    """The key of a dissononce CipherState after the handshake."""
+    version = importlib.metadata.version("dissononce")
+    key = getattr(cipherstate, "_key", None)
+    if not version.startswith(KEY_LAYOUT_VERSIONS) or not isinstance(key, bytes) or len(key) != 32:
+        raise RuntimeError(
+            "cannot read the CipherState key of dissononce %s (known layout: %s); install dissononce from noise-connector-requirements.txt"
+            % (version, ", ".join(v + "x" for v in KEY_LAYOUT_VERSIONS))
+        )
+    return key
+
+
+class TransportCipher:
+    """One direction of a finished handshake, encrypting and decrypting in place."""
+
+    def __init__(self, cipherstate):
+        self.cipherstate = cipherstate
+        self.nonce = bytearray(12)
+        self.counter = 0
+        self.aead = None
+        if isinstance(cipherstate.cipher, ChaChaPolyCipher) and hasattr(ChaCha20Poly1305, "encrypt_into"):
+            # the CipherState builds a new ChaCha20Poly1305 for every message, this one is reused
+            self.aead = ChaCha20Poly1305(cipher_key(cipherstate))
+
+    def _next_nonce(self):
+        struct.pack_into("<Q", self.nonce, 4, self.counter)
+        self.counter += 1
+        return self.nonce
+
+    def encrypt(self, view, length):
+        """Encrypt the plaintext in view[:length], returns the ciphertext length."""
+        if self.aead is None:
+            ciphertext = self.cipherstate.encrypt_with_ad(b"", bytes(view[:length]))
+            view[: len(ciphertext)] = ciphertext
+            return len(ciphertext)
+        return self.aead.encrypt_into(self._next_nonce(), view[:length], b"", view[: length + MAC_SIZE])
+
+    def decrypt(self, view):
+        """Decrypt the ciphertext in view, returns the plaintext length."""
+        if self.aead is None:
+            plaintext = self.cipherstate.decrypt_with_ad(b"", bytes(view))
+            view[: len(plaintext)] = plaintext
+            return len(plaintext)
+        try:
+            return self.aead.decrypt_into(self._next_nonce(), view, b"", view[: len(view) - MAC_SIZE])
+        except InvalidTag:
+            self.counter -= 1
+            raise DecryptFailedException(reason=DecryptFailedException.REASON_INVALID_TAG)
+
+
+class RingBuffer:
+    """Fixed size byte ring; data that wraps around the end is only copied
+    when a message spanning the wrap is read."""
+
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.scratch = memoryview(bytearray(MAX_MESSAGE))
+
+    def writable(self):
+        """The contiguous free space after the data."""
+        end = (self.start + self.size) % self.capacity
+        return self.view[end : end + min(self.capacity - self.size, self.capacity - end)]
+
+    def written(self, n):
+        self.size += n
+
+    def feed(self, data):
+        data = memoryview(data)
+        while len(data):
+            free = self.writable()
+            if not len(free):
+                raise BufferError("ring buffer full")
+            n = min(len(free), len(data))
+            free[:n] = data[:n]
+            self.written(n)
+            data = data[n:]
+
+    def byte(self, offset):
+        return self.buffer[(self.start + offset) % self.capacity]
+
+    def contiguous(self, offset, n):
+        start = (self.start + offset) % self.capacity
+        if start + n <= self.capacity:
+            return self.view[start : start + n]
+        head = self.capacity - start
+        self.scratch[:head] = self.view[start:]
+        self.scratch[head:n] = self.view[: n - head]
+        return self.scratch[:n]
+
+    def consume(self, n):
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+        if not self.size:
+            self.start = 0
+
+
+class FrameReader:
+    """Splits received bytes into transport messages and decrypts them.
+
+    Messages are returned as memoryviews into the ring buffer, valid until
+    the next receive into it.
+    """
+
+    def __init__(self, cipher=None, capacity=4 * (LENGTH_SIZE + MAX_MESSAGE)):
+        self.ring = RingBuffer(capacity)
+        self.cipher = cipher
+
+    def writable(self):
+        return self.ring.writable()
+
+    def written(self, n):
+        self.ring.written(n)
+
+    def feed(self, data):
+        self.ring.feed(data)
+
+    def recv_from(self, sock):
+        """One recv straight into the ring, returns the number of bytes read."""
+        n = sock.recv_into(self.ring.writable())
+        self.ring.written(n)
+        return n
+
+    def next_message(self):
+        """The next complete message (decrypted, if there is a cipher) or None."""
+        ring = self.ring
+        if ring.size < LENGTH_SIZE:
+            return None
+        length = ring.byte(0) | ring.byte(1) << 8
+        if ring.size < LENGTH_SIZE + length:
+            return None
+
+        message = ring.contiguous(LENGTH_SIZE, length)
+        ring.consume(LENGTH_SIZE + length)
+        if self.cipher is not None:
+            message = message[: self.cipher.decrypt(message)]
+        return message
+
+
+class FrameWriter:
+    """Batches length-prefixed transport messages into one preallocated buffer."""
+
+    def __init__(self, cipher=None, capacity=4 * (LENGTH_SIZE + MAX_MESSAGE)):
+        self.cipher = cipher
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.end = 0
+
+    def room(self):
+        return len(self.buffer) - self.end - LENGTH_SIZE - MAC_SIZE
+
+    def _reserve(self, length):
+        if length > min(self.room(), MAX_MESSAGE - MAC_SIZE):
+            raise BufferError("no room for the message, flush first")
+        return self.view[self.end + LENGTH_SIZE :]
+
+    def _commit(self, view, length):
+        if self.cipher is not None:
+            length = self.cipher.encrypt(view, length)
+        struct.pack_into("<H", self.buffer, self.end, length)
+        self.end += LENGTH_SIZE + length
+
+    def add_message(self, data):
+        """A raw message, e.g. a handshake message."""
+        view = self._reserve(len(data))
+        view[: len(data)] = data
+        self._commit(view, len(data))
+
+    def add_frame(self, extension_type, msg_type, payload):
+        """A Stratum V2 frame, built straight into the buffer."""
+        length = FRAME_HEADER_SIZE + len(payload)
+        view = self._reserve(length)
+        struct.pack_into("<HBHB", view, 0, extension_type, msg_type, len(payload) & 0xFFFF, len(payload) >> 16)
+        view[FRAME_HEADER_SIZE:length] = payload
+        self._commit(view, length)
+
+    def pending(self):
+        return self.view[: self.end]
+
+    def clear(self):
+        self.end = 0
+
+    def send_to(self, sock):
+        """Send every batched message with one sendall."""
+        sock.sendall(self.pending())
+        self.clear()
+
+
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+
+    from stratum_v2 import NEW_MINING_JOB, CHANNEL_MSG_BIT, new_handshake_state, parse_frame
+    from dissononce.processing.handshakepatterns.interactive.NX import NXHandshakePattern
+    from dissononce.dh.x25519.x25519 import X25519DH
+
+    def cipher_pair():
+        initiator, responder = new_handshake_state(), new_handshake_state()
+        initiator.initialize(NXHandshakePattern(), True, b"")
+        responder.initialize(NXHandshakePattern(), False, b"", s=X25519DH().generate_keypair())
+        message = bytearray()
+        initiator.write_message(b"", message)
+        responder.read_message(bytes(message), bytearray())
+        message = bytearray()
+        responder_ciphers = responder.write_message(b"", message)
+        initiator_ciphers = initiator.read_message(bytes(message), bytearray())
+        # initiator to responder
+        return initiator_ciphers[0], responder_ciphers[0]
+
+    def wrap(item):
+        return len(item).to_bytes(2, byteorder="little") + item
+
+    def unwrap(item):
+        payload_length = int.from_bytes(item[0:2], byteorder="little")
+        return (item[2 : 2 + payload_length], item[payload_length + 2 :])
+
+    def frame(msg_type, payload):
+        return struct.pack("<HB", CHANNEL_MSG_BIT, msg_type) + len(payload).to_bytes(3, "little") + payload
+
+    # a NewMiningJob sized payload
+    payload = bytes(45)
+    count = 20000
+    batch = 32
+    # arbitrary recv sizes, so messages get split across reads and around the ring
+    chunk = 1000
+
+    def frames_per_second(run):
+        # steady state: set up the ciphers once and repeat the batch
+        send, receive = cipher_pair()
+        writer = FrameWriter(TransportCipher(send))
+        reader = FrameReader(TransportCipher(receive))
+        start = time.perf_counter()
+        for _ in range(count // batch):
+            run(send, receive, writer, reader)
+        return count // batch * batch / (time.perf_counter() - start)
+
+    def allocated_per_frame(run):
+        send, receive = cipher_pair()
+        writer = FrameWriter(TransportCipher(send))
+        reader = FrameReader(TransportCipher(receive))
+        run(send, receive, writer, reader)
+        tracemalloc.start()
+        total = 0
+        rounds = 50
+        for _ in range(rounds):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            run(send, receive, writer, reader)
+            total += tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        return total / (rounds * batch)
+
+    def run_copying(send, receive, writer, reader):
+        stream = b""
+        for _ in range(batch):
+            stream += wrap(send.encrypt_with_ad(b"", frame(NEW_MINING_JOB, payload)))
+        while stream:
+            message, stream = unwrap(stream)
+            parse_frame(receive.decrypt_with_ad(b"", message))
+
+    def run_zero_copy(send, receive, writer, reader):
+        for _ in range(batch):
+            writer.add_frame(CHANNEL_MSG_BIT, NEW_MINING_JOB, payload)
+        data = writer.pending()
+        for offset in range(0, len(data), chunk):
+            reader.feed(data[offset : offset + chunk])
+            while (message := reader.next_message()) is not None:
+                parse_frame(message)
+        writer.clear()
+
+    for name, run in (("wrap/unwrap", run_copying), ("ring buffer", run_zero_copy)):
+        print("%-12s %8.0f frames/s, %6.0f bytes allocated per frame (peak)" % (name, frames_per_second(run), allocated_per_frame(run)))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Batch PUSH_JOB/QUEUE_JOB framing over a preallocated buffer.
+#
+# The miner takes block header data with the bytes of every 4-byte word
+# reversed (swap_words in uart_host.py, done by hand for the genesis frame in
+# crc32.py). JobPacker lays whole frames, header, payload and CRC, out back to
+# back in one bytearray that is reused from batch to batch:
+#   - the word reversal of many headers is one numpy byteswap,
+#   - each frame is written with a single struct.pack_into,
+#   - the CRCs are computed over the frames in place, a byte column at a time
+#     for all of them (crc32.CrcModel.compute_rows).
+# Without numpy the same steps run one frame at a time.
+#
+# The way back: a golden nonce from MSG_NONCE goes into the block header as
+# its big-endian bytes. put_nonce writes it into a header buffer and
+# header_nonces converts many of them at once.
+#
+# Usage: python3 packer.py
+# Checks the frames against uart_host.build_frame/pack_job and the genesis
+# frame from crc32.py, and prints the throughput against framing one job at a time.
+
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # one frame at a time
+    np = None
+
+from crc32 import CRC32_FPGA
+from midstate import calculateMidstates
+from uart_host import CRC_SIZE, MSG_BUF_LEN, MSG_PUSH_JOB, header_nonce, swap_words
+
+MASK = 0xFFFFFFFF
+
+# header, max nonce, min nonce, the 12 tail bytes and the midstate (see pack_job)
+_FRAME = struct.Struct("<4BII12s32s")
+# CRC32_FPGA does not reflect its output, the CRC goes on the frame big-endian
+_CRC = struct.Struct(">I")
+_NONCE = struct.Struct(">I")
+
+
+def swap_headers(headers):
+    """The midstate blocks and tails of 80 (or 76) byte block headers, words
+    byte-reversed for the miner: swap_words(header[:64]), swap_words(header[64:76])."""
+    for header in headers:
+        if len(header) not in (76, 80):
+            raise ValueError("header must be 76 or 80 bytes long")
+    if np is None:
+        return [swap_words(header[:64]) for header in headers], [swap_words(header[64:76]) for header in headers]
+
+    words = np.frombuffer(b"".join(header[:76] for header in headers), dtype="<u4").reshape(len(headers), 19).byteswap()
+    return [row.tobytes() for row in words[:, :16]], [row.tobytes() for row in words[:, 16:]]
+
+
+def header_nonces(nonces):
+    """header_nonce of many golden nonces at once."""
+    if np is None:
+        return [header_nonce(nonce) for nonce in nonces]
+    return np.asarray(nonces, dtype=np.uint32).byteswap().tolist()
+
+
+def put_nonce(header, nonce, offset=76):
+    """Write a golden nonce from MSG_NONCE into an 80 byte header buffer."""
+    _NONCE.pack_into(header, offset, nonce)
+
+
+def with_nonce(header, nonce):
+    """The 80 byte header for a 76 (or 80) byte header and a golden nonce from MSG_NONCE."""
+    return bytes(header[:76]) + _NONCE.pack(nonce)
+
+
+class JobPacker:
+    """Frames for up to `capacity` jobs at a time, in one reusable buffer.
+
+    pack and pack_headers return memoryviews into the buffer, which the next
+    call overwrites: copy a frame (bytes(frame)) to keep it, or use a packer
+    per batch.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * MSG_BUF_LEN)
+        view = memoryview(self.buffer)
+        self.frames = [view[offset : offset + MSG_BUF_LEN] for offset in range(0, len(self.buffer), MSG_BUF_LEN)]
+        self._rows = None if np is None else np.frombuffer(self.buffer, dtype=np.uint8).reshape(capacity, MSG_BUF_LEN)
+
+    def pack(self, jobs, msg_type=MSG_PUSH_JOB):
+        """Frames for (midstate, tail[, nonce_min[, nonce_max]]) tuples, as for pack_job."""
+        if len(jobs) > self.capacity:
+            raise ValueError("%d jobs do not fit into a packer for %d" % (len(jobs), self.capacity))
+
+        for offset, job in zip(range(0, len(self.buffer), MSG_BUF_LEN), jobs):
+            midstate, tail, nonce_min, nonce_max = _job(*job)
+            _FRAME.pack_into(self.buffer, offset, MSG_BUF_LEN, 0, 0, msg_type, nonce_max, nonce_min, tail, midstate)
+
+        count = len(jobs)
+        if self._rows is not None:
+            crcs = CRC32_FPGA.compute_rows(self._rows[:count, : MSG_BUF_LEN - CRC_SIZE])
+        else:
+            crcs = [CRC32_FPGA(frame[:-CRC_SIZE]) for frame in self.frames[:count]]
+        for offset, crc in zip(range(MSG_BUF_LEN - CRC_SIZE, len(self.buffer), MSG_BUF_LEN), crcs):
+            _CRC.pack_into(self.buffer, offset, crc)
+        return self.frames[:count]
+
+    def pack_headers(self, headers, nonce_min=0, nonce_max=MASK, msg_type=MSG_PUSH_JOB, executor=None):
+        """Frames for block headers in the order the pool sends them, midstates
+        computed in one batch (see midstate.calculateMidstates)."""
+        blocks, tails = swap_headers(headers)
+        midstates = calculateMidstates(blocks, executor=executor)
+        return self.pack([(midstate, tail, nonce_min, nonce_max) for midstate, tail in zip(midstates, tails)], msg_type)
+
+
+def _job(midstate, tail, nonce_min=0, nonce_max=MASK):
+    # struct pads or cuts "s" fields silently
+    if len(midstate) != 32:
+        raise ValueError("midstate must be 32 bytes long")
+    if len(tail) != 12:
+        raise ValueError("tail must be 12 bytes long")
+    return midstate, tail, nonce_min, nonce_max
+
+
+if __name__ == "__main__":
+    import os
+    import time
+
+    from uart_host import MSG_QUEUE_JOB, build_frame, job_from_header, pack_job
+
+    GENESIS_HEADER = bytes.fromhex(
+        "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c"
+    )
+    # test_top.v's genesis push, starting a nonce short of the golden one, and its CRC from crc32.py
+    GENESIS_FRAME = bytes.fromhex("3C000002FFFFFFFF7B2BAC1D4A5E1E4B495FAB291d00FFFF339A90BCF0BF58637DACCC90A8CA591EE9D8C8C3C803014F3687B1961BF9194777154f81")
+
+    packer = JobPacker(256)
+    assert bytes(packer.pack_headers([GENESIS_HEADER], 0x1DAC2B7B)[0]) == GENESIS_FRAME
+
+    headers = [GENESIS_HEADER[:36] + os.urandom(32) + GENESIS_HEADER[68:] for _ in range(packer.capacity)]
+    jobs = [job_from_header(header) + (i, MASK - i) for i, header in enumerate(headers)]
+    for msg_type in (MSG_PUSH_JOB, MSG_QUEUE_JOB):
+        frames = packer.pack(jobs, msg_type)
+        assert [bytes(frame) for frame in frames] == [build_frame(msg_type, pack_job(*job)) for job in jobs]
+        assert CRC32_FPGA.check_frames(frames) == [True] * len(frames)
+    assert [bytes(frame) for frame in packer.pack_headers(headers[:8], 5)] == [build_frame(MSG_PUSH_JOB, pack_job(*job_from_header(header), 5)) for header in headers[:8]]
+
+    # nonce back into the header
+    header = bytearray(GENESIS_HEADER)
+    put_nonce(header, 0x1DAC2B7C)
+    assert header == GENESIS_HEADER and with_nonce(GENESIS_HEADER, 0x1DAC2B7C) == GENESIS_HEADER
+    nonces = [0x1DAC2B7C, 0, 0x12345678, MASK]
+    assert header_nonces(nonces) == [header_nonce(nonce) for nonce in nonces]
+
+    def rate(f, count):
+        start = time.perf_counter()
+        f()
+        return count / (time.perf_counter() - start)
+
+    one_by_one = rate(lambda: [build_frame(MSG_PUSH_JOB, pack_job(*job)) for job in jobs], len(jobs))
+    batched = rate(lambda: packer.pack(jobs), len(jobs))
+    print("frames: %.0f/s one at a time, %.0f/s batched (%.1fx)" % (one_by_one, batched, batched / one_by_one))
+    swap = rate(lambda: [(swap_words(header[:64]), swap_words(header[64:76])) for header in headers], len(headers))
+    batched = rate(lambda: swap_headers(headers), len(headers))
+    print("word reversal: %.0f/s one at a time, %.0f/s batched (%.1fx)" % (swap, batched, batched / swap))
+    print("OK")
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+# Several Stratum V1 pools behind the job source interface of one.
+#
+# PoolManager keeps a session open to every pool, subscribed, authorized and
+# prefetching work, including backup pools that get no hashrate while the
+# others are up. Each session is health-checked: a probe request every
+# `interval` seconds has to be answered within `timeout` (an error answer
+# counts, pools answer unknown methods with one), and a session that drops or
+# misses a probe is marked down and reconnected in the background.
+#
+# Work of a pool that is down is no longer current, so scheduler.py moves its
+# boards to fresh work right away (see on_clean below), and
+# next_work() hands out work of the pools that are up. Hashrate is split by
+# weight, every Work (a 2^32 nonce sweep) counting the same: a smooth
+# weighted round robin over the up pools with a weight. Pools with weight 0
+# are backups, used in the order given when no weighted pool is up, and left
+# again as soon as one is.
+#
+# The `on_clean` callbacks run on a clean job of any pool and whenever a pool
+# goes down or comes back, when work handed out before may have gone stale.
+#
+# Usage: python3 pool_manager.py
+# Mines with emulated boards on two weighted mock pools and a backup, stalls
+# and drops pools and prints the split and the time to switch.
+
+import asyncio
+import collections
+import weakref
+
+from stratum_v1 import StratumError
+
+
+class _Pool:
+    __slots__ = ("client", "weight", "up", "current", "handed", "failures", "latency", "down_at")
+
+    def __init__(self, client, weight):
+        self.client = client
+        self.weight = weight
+        self.up = False
+        # smooth weighted round robin state
+        self.current = 0
+        self.handed = 0
+        self.failures = 0
+        self.latency = None
+        self.down_at = None
+
+    @property
+    def name(self):
+        return "%s:%s" % (self.client.host, self.client.port)
+
+
+class _Queues:
+    """The prefetch queues of the pools that are up, for `source.work.empty()`."""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def empty(self):
+        return all(pool.client.work.empty() for pool in self.manager.pools if pool.up)
+
+    def qsize(self):
+        return sum(pool.client.work.qsize() for pool in self.manager.pools if pool.up)
+
+
+class PoolManager:
+    """A job source over StratumV1Client sessions, each with a weight, 0 for a backup."""
+
+    def __init__(self, clients, weights=None, interval=1.0, timeout=2.0, retry=2.0):
+        weights = weights if weights is not None else [1] * len(clients)
+        if len(weights) != len(clients):
+            raise ValueError("one weight per pool")
+        self.pools = [_Pool(client, weight) for client, weight in zip(clients, weights)]
+        self.interval = interval
+        self.timeout = timeout
+        self.retry = retry
+        self.work = _Queues(self)
+        # seconds from a pool going down to the first work handed out from another
+        self.switches = collections.deque(maxlen=64)
+        self.on_clean = []
+        for pool in self.pools:
+            pool.client.on_clean.append(self._clean)
+
+        self._owners = weakref.WeakKeyDictionary()
+        self._changed = asyncio.Event()
+        self._pending_switch = None
+        self._tasks = []
+
+    async def connect(self):
+        """Connect to every pool; fails only if none can be reached."""
+        results = await asyncio.gather(*(asyncio.wait_for(pool.client.connect(), self.timeout) for pool in self.pools), return_exceptions=True)
+        for pool, result in zip(self.pools, results):
+            pool.up = not isinstance(result, BaseException)
+        if not any(pool.up for pool in self.pools):
+            raise StratumError("no pool could be reached: %s" % ", ".join(str(result) for result in results))
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._watch(pool)) for pool in self.pools]
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for pool in self.pools:
+            pool.client.close()
+
+    @property
+    def accepted(self):
+        return sum(pool.client.accepted for pool in self.pools)
+
+    @property
+    def rejected(self):
+        return sum((pool.client.rejected for pool in self.pools), collections.Counter())
+
+    def stats(self):
+        return [
+            {"pool": pool.name, "weight": pool.weight, "up": pool.up, "handed": pool.handed, "accepted": pool.client.accepted, "failures": pool.failures, "latency": pool.latency}
+            for pool in self.pools
+        ]
+
+    # Job source
+
+    def is_current(self, work):
+        """Whether shares for the work would still be accepted, by a pool that is in use."""
+        pool = self._owners.get(work.job)
+        if pool is None or not pool.up or not pool.client.is_current(work):
+            return False
+        # a backup's work ends once a weighted pool is back
+        return pool.weight > 0 or not any(other.up and other.weight > 0 for other in self.pools)
+
+    def is_valid(self, work):
+        """Whether the work's pool still takes shares for it, in use or not: a
+        backup's shares count after the weighted pools are back."""
+        pool = self._owners.get(work.job)
+        return pool is not None and pool.up and pool.client.is_current(work)
+
+    async def next_work(self):
+        """The next Work, from the pool whose turn it is."""
+        while True:
+            changed = self._changed
+            pool = self._pick()
+            if pool is None:
+                await changed.wait()
+                continue
+            work = await self._take(pool, changed)
+            if work is None:
+                continue
+            pool.handed += 1
+            if self._pending_switch is not None:
+                self.switches.append(asyncio.get_running_loop().time() - self._pending_switch)
+                self._pending_switch = None
+            return work
+
+    async def _take(self, pool, changed):
+        """Current work from the pool's queue, None if the pools changed meanwhile."""
+        wait = asyncio.ensure_future(changed.wait())
+        try:
+            while True:
+                get = asyncio.ensure_future(pool.client.work.get())
+                await asyncio.wait({get, wait}, return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    return None
+                work = get.result()
+                self._owners[work.job] = pool
+                # stale work is skipped without giving the pool's turn away
+                if self.is_current(work):
+                    return work
+        finally:
+            wait.cancel()
+
+    async def submit(self, work, nonce):
+        pool = self._owners.get(work.job)
+        if pool is None or not pool.up:
+            return False
+        return await pool.client.submit(work, nonce)
+
+    def _pick(self):
+        candidates = [pool for pool in self.pools if pool.up and pool.weight > 0]
+        if not candidates:
+            return next((pool for pool in self.pools if pool.up), None)
+        total = sum(pool.weight for pool in candidates)
+        for pool in candidates:
+            pool.current += pool.weight
+        best = max(candidates, key=lambda pool: pool.current)
+        best.current -= total
+        return best
+
+    def _set_up(self, pool, up):
+        pool.up = up
+        if not up:
+            pool.failures += 1
+            pool.current = 0
+            pool.down_at = asyncio.get_running_loop().time()
+            if self._pending_switch is None:
+                self._pending_switch = pool.down_at
+        # wake next_work() waiting on another pool's queue
+        self._changed.set()
+        self._changed = asyncio.Event()
+        self._clean()
+
+    def _clean(self):
+        for callback in self.on_clean:
+            callback()
+
+    # Health
+
+    async def _watch(self, pool):
+        loop = asyncio.get_running_loop()
+        client = pool.client
+        while True:
+            if not pool.up:
+                try:
+                    await asyncio.wait_for(client.reconnect(), self.timeout)
+                except (OSError, StratumError, asyncio.TimeoutError):
+                    await asyncio.sleep(self.retry)
+                    continue
+                self._set_up(pool, True)
+
+            await asyncio.wait({client.closed}, timeout=self.interval)
+            if client.closed.done():
+                self._set_up(pool, False)
+                continue
+            started = loop.time()
+            try:
+                await asyncio.wait_for(self._probe(client), self.timeout)
+            except asyncio.TimeoutError:
+                client.close()
+                self._set_up(pool, False)
+                continue
+            pool.latency = loop.time() - started
+
+    async def _probe(self, client):
+        try:
+            await client.call("mining.ping", [])
+        except StratumError:
+            pass
+
+
+async def main():
+    from concurrent.futures import ProcessPoolExecutor
+
+    from difficulty import difficulty_target
+    from fpga_emulator import FpgaEmulator
+    from metrics import HostMetrics, PoolMetrics, Registry
+    from scheduler import Scheduler
+    from stratum_v1 import MockStratumServer, StratumV1Client
+    from uart_host import UartHost
+
+    difficulty = 2**-24
+    target = difficulty_target(difficulty)
+    registry = Registry()
+    executor = ProcessPoolExecutor()
+    servers = [await MockStratumServer(difficulty=difficulty).start() for _ in range(3)]
+    clients = [StratumV1Client("127.0.0.1", server.port, "worker", executor=executor, metrics=PoolMetrics(registry, "127.0.0.1:%d" % server.port)) for server in servers]
+    manager = PoolManager(clients, weights=[3, 1, 0], interval=0.2, timeout=0.3, retry=0.3)
+    await manager.connect()
+
+    emulators = [FpgaEmulator(baud_rate=115200, hashrate=rate, batch_size=1024, target=target) for rate in (4000, 4000, 8000)]
+    scheduler = Scheduler(manager, heartbeat=0.5, check_interval=0.05)
+    for emulator in emulators:
+        scheduler.add_board(emulator.port, await UartHost.open(emulator.port, baud=115200, timeout=0.2, retries=1, metrics=HostMetrics(registry, emulator.port, target)))
+    scheduler.start()
+
+    async def new_blocks():
+        # a job cycle: every pool moves to the next block at the same time
+        while True:
+            await asyncio.sleep(0.25)
+            for server in servers:
+                server.notify(clean=True)
+
+    blocks = asyncio.get_running_loop().create_task(new_blocks())
+
+    def report(title):
+        print(title)
+        for stats in manager.stats():
+            print("  %-16s weight %d  %-4s %4d works handed %4d shares" % (stats["pool"], stats["weight"], "up" if stats["up"] else "down", stats["handed"], stats["accepted"]))
+
+    try:
+        await asyncio.sleep(3)
+        report("both weighted pools up:")
+        first, second, _ = manager.pools
+        assert 2 <= first.handed / second.handed <= 4
+
+        servers[0].stalled = True
+        await asyncio.sleep(2)
+        report("first pool stalled:")
+        assert not first.up
+
+        servers[1].drop()
+        servers[1].stalled = True
+        handed = manager.pools[2].handed
+        await asyncio.sleep(2)
+        report("second pool dropped, on the backup:")
+        assert manager.pools[2].handed > handed
+
+        servers[0].stalled = servers[1].stalled = False
+        await asyncio.sleep(2)
+        report("both back:")
+        assert first.up and second.up
+
+        switches = sorted(manager.switches)
+        print("switched in %s s, scheduler checks every %.2f s, new jobs every 0.25 s" % (", ".join("%.3f" % s for s in switches), scheduler.check_interval))
+        # the mock pools take shares of their latest job only; the scheduler drops nonces of stale work, the rejected ones were on their way
+        print("shares accepted %d, rejected %s" % (manager.accepted, dict(manager.rejected)))
+    finally:
+        blocks.cancel()
+        stopped = scheduler.close()
+        for board in scheduler.boards:
+            board.host.close()
+        await stopped
+        manager.close()
+        for emulator in emulators:
+            emulator.close()
+        for server in servers:
+            await server.close()
+        executor.shutdown()
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+
+# Drives several boards, each on its own serial port, from one Stratum V1 session.
+#
+# The FPGA sweeps the whole nonce range of a job, so boards never share a job:
+# every board gets its own Work from StratumV1Client (a distinct extranonce2,
+# midstates prepared on a process pool), or, when the prefetch queue is empty,
+# a copy of the latest Work with ntime rolled forward, which only changes the
+# tail and needs no new midstate.
+#
+# fpgaminer_top.v stops at the first golden nonce, so the nonce tells how far
+# the board got: nonce - nonce_min + 1 hashes since the job was acked. Those
+# samples give each board's hashrate, which sets when its job is used up. After
+# a nonce the board carries on with the same Work from the next nonce.
+#
+# Nonces are checked with difficulty.ShareVerifier before they go to the pool;
+# only blocks and shares are submitted, bogus nonces are counted per board.
+#
+# A heartbeat pings every board. A board that stops answering is marked down;
+# the part of its job it has presumably not reached yet is handed to the next
+# board that asks for work, and the board gets fresh work once it answers again
+# (after a reset it has no job).
+#
+# With a queue depth, the board's job FIFO (QUEUE_JOB in uart_comm.v) is kept
+# topped up, so the board goes on to the next job at a golden nonce or the end
+# of its range without waiting for the host. The board does not say when it
+# switches: a nonce belongs to the first job, running or queued, whose hash it
+# meets, and the jobs before that one ran out; a job with no nonce by its
+# deadline is taken as done. Clean jobs drop the queue with CLEAR_QUEUE.
+#
+# A clean job wakes every board at once instead of at its next check. Work
+# replacing stale work goes out as a priority frame (see UartHost.submit), ahead
+# of anything queued for the board and in place of job frames not sent yet.
+# Nonces that come in late for work its pool no longer takes (source.is_valid;
+# a backup pool's work stays valid after the boards leave it) are dropped
+# before verification, counted per board as stale.
+#
+# Each board's job switch latency, from the pool's notify to the board ACKing
+# the first work of the new job, goes to its UartHost's metrics; --metrics PORT
+# serves them with the pool's over HTTP (see metrics.py).
+#
+# Usage:
+#   python3 scheduler.py                                        3 emulated boards and a local mock pool, a new block every second
+#   python3 scheduler.py --pool HOST:PORT --user NAME [--metrics PORT] [--queue-depth N] [--record DIR] /dev/ttyUSB0 /dev/ttyUSB1 ...
+#   python3 scheduler.py --pool A:PORT --pool B:PORT --weights 3,1 --backup C:PORT ...   several pools, see pool_manager.py
+
+import argparse
+import asyncio
+import collections
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from difficulty import BLOCK, BOGUS, SHARE, ShareVerifier, difficulty_target, hash_value
+from metrics import FPGA_TARGET, HostMetrics, MetricsServer, PoolMetrics, Registry
+from packer import with_nonce
+from pool_manager import PoolManager
+from session_log import SessionRecorder
+from stratum_v1 import MockStratumServer, StratumV1Client, Work
+from uart_host import MSG_PUSH_JOB, QUEUE_DEPTH, Preempted, ProtocolError, UartHost, build_frame, pack_job, swap_words
+
+NONCE_RANGE = 1 << 32
+# fpgaminer_top.v with LOOP_LOG2=5
+NOMINAL_HASHRATE = 100.5e6 / 32
+
+
+def roll_ntime(work, seconds):
+    """The same work with ntime moved forward; ntime is in the tail, the midstate stays."""
+    header = work.header[:68] + struct.pack("<I", work.ntime + seconds) + work.header[72:]
+    return Work(work.job, work.extranonce2, header, work.midstate, swap_words(header[64:76]))
+
+
+class Board:
+    """Scheduling state of one board."""
+
+    def __init__(self, name, host, nominal_hashrate=NOMINAL_HASHRATE, queue_depth=0):
+        self.name = name
+        self.host = host
+        self.nominal_hashrate = nominal_hashrate
+        self.queue_depth = queue_depth
+        # (work, nonce_min) queued on the board behind the running job
+        self.queued = collections.deque()
+        # work the board is presumably done with, for nonces that come in late
+        self.retired = collections.deque(maxlen=2 * QUEUE_DEPTH)
+        self.work = None
+        self.nonce_min = 0
+        self.started = 0.0
+        self.down = False
+        self.jobs = 0
+        self.nonces = 0
+        self.bogus = 0
+        self.stale = 0
+        self.resets = 0
+        # set when a clean job makes work stale
+        self.wake = asyncio.Event()
+        # (hashes, seconds) from the start of a job to its golden nonce
+        self.samples = collections.deque(maxlen=64)
+
+    def hashrate(self):
+        seconds = sum(s for _, s in self.samples)
+        if len(self.samples) < 4 or seconds <= 0:
+            return self.nominal_hashrate
+        return sum(h for h, _ in self.samples) / seconds
+
+    def progress(self, now, margin=0.9):
+        """A nonce the board has most likely swept up to; `margin` keeps the
+        handed-over range from starting past nonces the board never reached."""
+        return min(NONCE_RANGE - 1, self.nonce_min + int(margin * self.hashrate() * (now - self.started)))
+
+    def deadline(self):
+        """When the board will have swept to the end of the nonce range."""
+        return self.started + (NONCE_RANGE - self.nonce_min) / self.hashrate()
+
+
+class Scheduler:
+    """Hands out disjoint work to boards and submits their nonces.
+
+    `source` is a connected StratumV1Client or PoolManager. `heartbeat` is the ping interval,
+    `check_interval` how often a mining board is checked for stale work or a
+    failed heartbeat, `max_ntime_roll` how many seconds ntime may be rolled.
+    """
+
+    def __init__(self, source, heartbeat=5.0, check_interval=0.5, max_ntime_roll=60):
+        self.source = source
+        self.heartbeat = heartbeat
+        self.check_interval = check_interval
+        self.max_ntime_roll = max_ntime_roll
+        self.boards = []
+        self._resume = collections.deque()
+        self._latest = None
+        self._rolled = 0
+        self._tasks = []
+        self.verifier = ShareVerifier()
+        self._unverified = []
+        source.on_clean.append(self._wake)
+
+    def add_board(self, name, host, nominal_hashrate=NOMINAL_HASHRATE, queue_depth=0):
+        """`queue_depth` jobs are kept queued on the board, 0 for bitstreams without QUEUE_JOB."""
+        board = Board(name, host, nominal_hashrate, queue_depth)
+        self.boards.append(board)
+        return board
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        for board in self.boards:
+            self._tasks.append(loop.create_task(self._run_queued(board) if board.queue_depth else self._run(board)))
+            self._tasks.append(loop.create_task(self._watch(board)))
+
+    def close(self):
+        """Stop the boards' tasks; returns a future for them to have ended,
+        which raises the first error a task died of."""
+        for task in self._tasks:
+            task.cancel()
+        return asyncio.ensure_future(self._stopped())
+
+    async def _stopped(self):
+        results = await asyncio.gather(*self._tasks, return_exceptions=True)
+        for result in results:
+            # cancelled tasks give a CancelledError, a BaseException
+            if isinstance(result, Exception):
+                raise result
+
+    def stats(self):
+        return [
+            {"board": b.name, "hashrate": b.hashrate(), "jobs": b.jobs, "nonces": b.nonces, "bogus": b.bogus, "stale": b.stale, "resets": b.resets, "down": b.down}
+            for b in self.boards
+        ]
+
+    # Work
+
+    async def _next_assignment(self):
+        while self._resume:
+            work, nonce_min = self._resume.popleft()
+            if self.source.is_current(work):
+                return work, nonce_min
+
+        latest = self._latest
+        if self.source.work.empty() and latest is not None and self.source.is_current(latest) and self._rolled < self.max_ntime_roll:
+            self._rolled += 1
+            return roll_ntime(latest, self._rolled), 0
+
+        self._latest = await self.source.next_work()
+        self._rolled = 0
+        return self._latest, 0
+
+    async def _run(self, board):
+        loop = asyncio.get_running_loop()
+        assignment = None
+        while True:
+            if board.down:
+                await self._recover(board)
+            if assignment is None:
+                assignment = await self._next_assignment()
+            work, nonce_min = assignment
+
+            frame = work.frame if nonce_min == 0 else build_frame(MSG_PUSH_JOB, pack_job(work.midstate, work.tail, nonce_min))
+            try:
+                await board.host.submit(frame, self._stale(board.work))
+            except ProtocolError as error:
+                self._resume.append(assignment)
+                assignment = None
+                # a preempted frame never reached the board, nothing wrong with it
+                board.down = not isinstance(error, Preempted)
+                continue
+
+            # nonces that came in before the ACK are from the previous job
+            previous = board.work
+            while not board.host.nonces.empty():
+                self._submit(board, previous, board.host.nonces.get_nowait())
+            if previous is None or previous.job is not work.job:
+                board.host.metrics.job_switch.observe(time.monotonic() - work.job.received)
+            board.work, board.nonce_min, board.started = work, nonce_min, loop.time()
+            board.jobs += 1
+            assignment = await self._mine(board)
+
+    async def _mine(self, board):
+        """Wait for the board's current job to end, returns what to push next
+        (None for fresh work)."""
+        loop = asyncio.get_running_loop()
+        deadline = board.deadline()
+        while True:
+            nonce = await self._next_nonce(board, min(self.check_interval, deadline - loop.time()))
+            now = loop.time()
+
+            if nonce is not None:
+                board.samples.append(((nonce - board.nonce_min) % NONCE_RANGE + 1, now - board.started))
+                self._submit(board, board.work, nonce)
+                # the miner idles after a golden nonce, the rest of the range is still good
+                return None if nonce == NONCE_RANGE - 1 else (board.work, nonce + 1)
+            if board.down:
+                self._resume.append((board.work, board.progress(now)))
+                board.work = None
+                return None
+            if not self.source.is_current(board.work) or now >= deadline:
+                return None
+
+    async def _next_nonce(self, board, timeout):
+        """The board's next nonce, None after `timeout` seconds or when a clean job wakes it."""
+        nonce = asyncio.ensure_future(board.host.nonces.get())
+        wake = asyncio.ensure_future(board.wake.wait())
+        try:
+            await asyncio.wait({nonce, wake}, timeout=max(0.0, timeout), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wake.cancel()
+            if not nonce.done():
+                nonce.cancel()
+        if wake.done() and not wake.cancelled():
+            board.wake.clear()
+        return nonce.result() if nonce.done() and not nonce.cancelled() else None
+
+    def _wake(self):
+        for board in self.boards:
+            board.wake.set()
+
+    def _stale(self, work):
+        """Whether work the board has is no longer current, so what replaces it has priority."""
+        return work is not None and not self.source.is_current(work)
+
+    # Queued work
+
+    async def _run_queued(self, board):
+        """Like _run, but with the board's job FIFO kept topped up."""
+        while True:
+            if board.down:
+                await self._recover(board)
+            try:
+                if board.work is None or not self.source.is_current(board.work):
+                    await self._push_fresh(board)
+                while len(board.queued) < board.queue_depth:
+                    assignment = await self._next_assignment()
+                    work, nonce_min = assignment
+                    try:
+                        await board.host.queue_job(work.midstate, work.tail, nonce_min)
+                    except ProtocolError:
+                        self._resume.append(assignment)
+                        raise
+                    board.queued.append(assignment)
+            except Preempted:
+                continue
+            except ProtocolError:
+                board.down = True
+                self._hand_over(board, asyncio.get_running_loop().time())
+                continue
+            await self._mine_queued(board)
+
+    async def _push_fresh(self, board):
+        """Replace the running job and drop the queued ones, at the start and after clean jobs."""
+        loop = asyncio.get_running_loop()
+        priority = self._stale(board.work)
+        if board.queued:
+            await board.host.clear_queue(priority)
+            # stale ones are skipped by _next_assignment
+            self._resume.extend(board.queued)
+            board.queued.clear()
+        previous = board.work
+        if previous is not None:
+            board.retired.append(previous)
+
+        assignment = await self._next_assignment()
+        work, nonce_min = assignment
+        frame = work.frame if nonce_min == 0 else build_frame(MSG_PUSH_JOB, pack_job(work.midstate, work.tail, nonce_min))
+        try:
+            await board.host.submit(frame, priority)
+        except ProtocolError:
+            self._resume.append(assignment)
+            raise
+        if previous is None or previous.job is not work.job:
+            board.host.metrics.job_switch.observe(time.monotonic() - work.job.received)
+        self._start(board, work, nonce_min, loop.time())
+
+    def _start(self, board, work, nonce_min, started):
+        board.work, board.nonce_min, board.started = work, nonce_min, started
+        board.jobs += 1
+
+    def _advance(self, board, now):
+        """The running job is done, the board has gone on to the next queued one."""
+        board.retired.append(board.work)
+        if board.queued:
+            self._start(board, *board.queued.popleft(), now)
+        else:
+            board.work = None
+
+    def _hand_over(self, board, now):
+        """Give the work of a board that went down to the other boards."""
+        if board.work is not None:
+            self._resume.append((board.work, board.progress(now)))
+        self._resume.extend(board.queued)
+        board.queued.clear()
+        board.work = None
+
+    def _golden(self, board, work, nonce):
+        return hash_value(with_nonce(work.header, nonce)) <= board.host.metrics.target
+
+    async def _mine_queued(self, board):
+        """Wait for the next nonce, or for the running job to reach its deadline."""
+        loop = asyncio.get_running_loop()
+        deadline = board.deadline()
+        while True:
+            nonce = await self._next_nonce(board, min(self.check_interval, deadline - loop.time()))
+            now = loop.time()
+
+            if nonce is not None:
+                self._attribute(board, nonce, now)
+                return
+            if board.down:
+                self._hand_over(board, now)
+                return
+            if not self.source.is_current(board.work):
+                return
+            if now >= deadline:
+                self._advance(board, deadline)
+                return
+
+    def _attribute(self, board, nonce, now):
+        """Find the job a nonce belongs to and move the board on to the job after it."""
+        for i, (work, nonce_min) in enumerate([(board.work, board.nonce_min)] + list(board.queued)):
+            if not self._golden(board, work, nonce):
+                continue
+            # the jobs before it ran out without a nonce
+            for _ in range(i):
+                self._advance(board, now)
+            if i == 0:
+                board.samples.append(((nonce - nonce_min) % NONCE_RANGE + 1, now - board.started))
+            self._submit(board, work, nonce)
+            # the miner idles after a golden nonce, the rest of the range is still good
+            if nonce != NONCE_RANGE - 1:
+                self._resume.append((work, nonce + 1))
+            self._advance(board, now)
+            return
+        for work in board.retired:
+            if self._golden(board, work, nonce):
+                self._submit(board, work, nonce)
+                return
+        # bogus, counted as such by the verifier
+        self._submit(board, board.work, nonce)
+
+    def _submit(self, board, work, nonce):
+        if work is None:
+            return
+        board.nonces += 1
+        if not self.source.is_valid(work):
+            # the pool would reject it, not worth hashing
+            board.stale += 1
+            board.host.metrics.stale_nonces.inc()
+            return
+        # nonces of all boards that arrive in the same loop iteration are verified together
+        if not self._unverified:
+            asyncio.get_running_loop().call_soon(self._verify)
+        self._unverified.append((board, work, nonce))
+
+    def _verify(self):
+        pending, self._unverified = self._unverified, []
+        verdicts = self.verifier.verify([(work, nonce) for _, work, nonce in pending])
+        loop = asyncio.get_running_loop()
+        for (board, _, _), verdict in zip(pending, verdicts):
+            if verdict.kind in (BLOCK, SHARE):
+                loop.create_task(self.source.submit(verdict.work, verdict.nonce))
+            elif verdict.kind == BOGUS:
+                board.bogus += 1
+
+    # Health
+
+    async def _watch(self, board):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            if board.down:
+                continue
+            try:
+                await board.host.ping()
+            except ProtocolError:
+                board.down = True
+
+    async def _recover(self, board):
+        while True:
+            try:
+                await board.host.ping()
+                break
+            except ProtocolError:
+                await asyncio.sleep(self.heartbeat)
+        board.down = False
+        board.resets += 1
+
+
+def print_stats(scheduler, source):
+    for stats in scheduler.stats():
+        print("  %(board)-14s %(hashrate)10.0f H/s  %(jobs)4d jobs  %(nonces)4d nonces  %(bogus)d bogus  %(stale)d stale  %(resets)d resets" % stats, "(down)" if stats["down"] else "")
+    print("  shares accepted %d, rejected %d" % (source.accepted, sum(source.rejected.values())))
+
+
+def print_metrics(registry):
+    snapshot = registry.snapshot()
+    for sample in snapshot["miner_effective_hashrate"]["samples"]:
+        print("  %-30s %-14s %10.0f H/s from nonces" % ("miner_effective_hashrate", sample["labels"]["board"], sample["value"]))
+    for name in ("miner_uart_round_trip_seconds", "miner_job_switch_seconds", "miner_share_submit_seconds"):
+        for sample in snapshot[name]["samples"]:
+            labels = ",".join(sample["labels"].values())
+            print("  %-30s %-14s %5d samples, p50 <= %s s, p99 <= %s s" % (name, labels, sample["count"], sample["p50"], sample["p99"]))
+
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    executor = ProcessPoolExecutor()
+    emulators = []
+    server = None
+    registry = Registry()
+    target = FPGA_TARGET
+
+    if args.pool:
+        pools = [address.rsplit(":", 1) for address in args.pool + args.backup]
+        weights = [int(weight) for weight in args.weights.split(",")] if args.weights else [1] * len(args.pool)
+        weights += [0] * len(args.backup)
+        ports = args.ports
+    else:
+        from fpga_emulator import FpgaEmulator
+
+        # easy shares, so the emulated boards find nonces every few hundred hashes
+        difficulty = 2**-24
+        server = await MockStratumServer(difficulty=difficulty).start()
+        pools, weights = [("127.0.0.1", server.port)], [1]
+        target = difficulty_target(difficulty)
+        emulators = [FpgaEmulator(baud_rate=115200, hashrate=rate, batch_size=1024, target=target) for rate in (2000, 4000, 8000)]
+        ports = [emulator.port for emulator in emulators]
+
+    clients = [StratumV1Client(host, int(port), args.user, executor=executor, metrics=PoolMetrics(registry, "%s:%s" % (host, port))) for host, port in pools]
+    source = clients[0] if len(clients) == 1 else PoolManager(clients, weights)
+    await source.connect()
+    scheduler = Scheduler(source, heartbeat=0.5)
+    recorders = [SessionRecorder(os.path.join(args.record, os.path.basename(name) + ".log")) for name in ports] if args.record else [None] * len(ports)
+    for name, recorder in zip(ports, recorders):
+        host = await UartHost.open(name, baud=115200, timeout=0.2, retries=1, metrics=HostMetrics(registry, name, target), recorder=recorder)
+        scheduler.add_board(name, host, queue_depth=args.queue_depth)
+    metrics_server = await MetricsServer(registry).start(port=args.metrics) if args.metrics is not None else None
+    scheduler.start()
+
+    async def new_blocks():
+        while True:
+            await asyncio.sleep(1.0)
+            server.notify(clean=True)
+
+    blocks = loop.create_task(new_blocks()) if emulators else None
+    try:
+        if emulators:
+            await asyncio.sleep(args.duration / 2)
+            print("after %.0f s:" % (args.duration / 2))
+            print_stats(scheduler, source)
+            print("resetting", ports[-1])
+            emulators[-1].reset(downtime=1.0)
+            await asyncio.sleep(args.duration / 2)
+            print("after %.0f s:" % args.duration)
+            print_stats(scheduler, source)
+            print_metrics(registry)
+        else:
+            while True:
+                await asyncio.sleep(args.duration)
+                print(time.strftime("%H:%M:%S"))
+                print_stats(scheduler, source)
+    finally:
+        if blocks is not None:
+            blocks.cancel()
+        stopped = scheduler.close()
+        if metrics_server is not None:
+            await metrics_server.close()
+        for board in scheduler.boards:
+            board.host.close()
+        await stopped
+        for recorder in recorders:
+            if recorder is not None:
+                recorder.close()
+        source.close()
+        for emulator in emulators:
+            emulator.close()
+        if server is not None:
+            await server.close()
+        await loop.run_in_executor(None, executor.shutdown)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mine on several boards from one Stratum V1 pool.")
+    parser.add_argument("ports", nargs="*", help="serial ports of the boards")
+    parser.add_argument("--pool", action="append", help="HOST:PORT of a pool, can be repeated; without it, runs emulated boards against a mock pool")
+    parser.add_argument("--weights", help="comma separated share of the boards' work per --pool, e.g. 3,1")
+    parser.add_argument("--backup", action="append", default=[], help="HOST:PORT of a backup pool, used while no --pool is up; can be repeated")
+    parser.add_argument("--user", default="worker")
+    parser.add_argument("--duration", type=float, default=6.0, help="seconds between stats")
+    parser.add_argument("--queue-depth", type=int, default=QUEUE_DEPTH, help="jobs kept queued on each board, 0 for bitstreams without QUEUE_JOB")
+    parser.add_argument("--record", metavar="DIR", help="record each board's serial traffic to DIR/<port>.log (see session_log.py)")
+    parser.add_argument("--metrics", type=int, help="serve Prometheus metrics on this port (/metrics, /metrics.json)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+# Recording and replay of the serial traffic of a board.
+#
+# SessionRecorder appends every frame UartHost sends and every message it
+# decodes (see FrameParser in uart_host.py) to a binary log, through a
+# memory map of the file that grows a chunk at a time:
+#   header:  b"FPGASES1", u64 end of the last record
+#   records: f64 time (time.time()), u8 direction (TX to the FPGA, RX from it),
+#            u8 message type (MSG_PING for a ping), u16 length, data
+# A TX record holds the frame as sent, an RX record the message body. The end
+# offset in the header is updated after each record, so a log cut short by a
+# crash still reads up to its last complete record.
+#
+# SessionLog reads a log back with an index by message type and time, and
+# Replayer feeds the RX side of a log into a UartHost over a pseudo-terminal,
+# at the recorded pace (or a multiple of it) or as fast as the host reads, to
+# reproduce an incident offline or to profile the host's receive path on real
+# traffic.
+#
+# Usage: python3 session_log.py query LOG [--type NONCE ...] [--direction rx|tx] [--since T] [--until T]
+#        python3 session_log.py replay LOG [--speed X] [--timeout S]  (speed 0: as fast as possible)
+#        python3 scheduler.py --record DIR ...         (one log per board)
+# Without arguments, records a session with the pty stand-in and replays it.
+
+import argparse
+import asyncio
+import bisect
+import collections
+import heapq
+import mmap
+import os
+import struct
+import time
+import tty
+from array import array
+
+from uart_host import HEADER_SIZE, MSG_ACK, MSG_CLEAR_QUEUE, MSG_INFO, MSG_INVALID, MSG_NONCE, MSG_PUSH_JOB, MSG_QUEUE_JOB, MSG_RESEND
+
+MAGIC = b"FPGASES1"
+TX = 0
+RX = 1
+# not a uart_comm.v message type, a lone 0x00 byte
+MSG_PING = 0xFF
+
+MSG_NAMES = {
+    MSG_INFO: "INFO",
+    MSG_INVALID: "INVALID",
+    MSG_PUSH_JOB: "PUSH_JOB",
+    MSG_NONCE: "NONCE",
+    MSG_ACK: "ACK",
+    MSG_RESEND: "RESEND",
+    MSG_QUEUE_JOB: "QUEUE_JOB",
+    MSG_CLEAR_QUEUE: "CLEAR_QUEUE",
+    MSG_PING: "PING",
+}
+
+_HEADER = struct.Struct("<8sQ")
+_RECORD = struct.Struct("<dBBH")
+
+Record = collections.namedtuple("Record", ["time", "direction", "type", "data"])
+
+
+class SessionRecorder:
+    """Appends to the log at `path`, `chunk` bytes of file at a time. Pass it
+    to UartHost as `recorder`."""
+
+    def __init__(self, path, chunk=1 << 20):
+        self.path = path
+        self.chunk = chunk
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size < _HEADER.size:
+            size = chunk
+            os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size)
+            self.end = _HEADER.size
+            _HEADER.pack_into(self.map, 0, MAGIC, self.end)
+        else:
+            self.map = mmap.mmap(self.fd, size)
+            magic, self.end = _HEADER.unpack_from(self.map)
+            if magic != MAGIC:
+                self.map.close()
+                os.close(self.fd)
+                raise ValueError("%s is not a session log" % path)
+        self.last = 0.0
+
+    def record(self, direction, msg_type, data, now=None):
+        # kept in order for the time index, even when the clock is set back
+        now = self.last = max(time.time() if now is None else now, self.last)
+        end = self.end + _RECORD.size + len(data)
+        if end > len(self.map):
+            self._grow(end)
+        _RECORD.pack_into(self.map, self.end, now, direction, msg_type, len(data))
+        self.map[self.end + _RECORD.size : end] = data
+        self.end = end
+        struct.pack_into("<Q", self.map, 8, end)
+
+    def sent(self, frame):
+        self.record(TX, frame[3] if len(frame) >= HEADER_SIZE else MSG_PING, frame)
+
+    def received(self, message):
+        self.record(RX, message.type, message.body)
+
+    def _grow(self, end):
+        size = (end // self.chunk + 1) * self.chunk
+        self.map.close()
+        os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        """Cut the file down to its records."""
+        self.map.close()
+        os.ftruncate(self.fd, self.end)
+        os.close(self.fd)
+
+
+class SessionLog:
+    """A recorded session, read through a memory map. Records are indexed by
+    type and time when the log is opened."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.end = _HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError("%s is not a session log" % path)
+
+        self.offsets = array("Q")
+        self.times = array("d")
+        # record numbers by message type, ascending
+        self.by_type = collections.defaultdict(lambda: array("L"))
+        offset = _HEADER.size
+        while offset + _RECORD.size <= self.end:
+            now, _, msg_type, length = _RECORD.unpack_from(self.map, offset)
+            self.by_type[msg_type].append(len(self.offsets))
+            self.offsets.append(offset)
+            self.times.append(now)
+            offset += _RECORD.size + length
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        offset = self.offsets[i]
+        now, direction, msg_type, length = _RECORD.unpack_from(self.map, offset)
+        start = offset + _RECORD.size
+        return Record(now, direction, msg_type, self.map[start : start + length])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def query(self, types=None, direction=None, since=None, until=None):
+        """Records of the given message types, direction and time range [since, until)."""
+        lo = 0 if since is None else bisect.bisect_left(self.times, since)
+        hi = len(self) if until is None else bisect.bisect_left(self.times, until)
+        if types is None:
+            numbers = range(lo, hi)
+        else:
+            ranges = []
+            for msg_type in types:
+                index = self.by_type.get(msg_type, ())
+                ranges.append(index[bisect.bisect_left(index, lo) : bisect.bisect_left(index, hi)])
+            numbers = heapq.merge(*ranges)
+        for i in numbers:
+            record = self[i]
+            if direction is None or record.direction == direction:
+                yield record
+
+    def close(self):
+        self.map.close()
+
+
+def encode(record):
+    """The bytes uart_comm.v sent for an RX record."""
+    if record.type == MSG_ACK and not record.data:
+        return b"\x01"
+    return bytes([HEADER_SIZE + len(record.data), 0, 0, record.type]) + record.data
+
+
+class Replayer:
+    """Plays the FPGA's side of a session into whatever opens `port`. What the
+    host writes is read and counted, not answered."""
+
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        os.set_blocking(self.master, False)
+        self.written = 0
+        self.host_bytes = 0
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.master, self._on_readable)
+
+    def close(self):
+        self._loop.remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+    async def play(self, records, speed=1.0):
+        """Send the RX records; `speed` 2 plays twice as fast as recorded, 0 as fast as possible."""
+        start = self._loop.time()
+        first = None
+        pending = bytearray()
+        for record in records:
+            if record.direction != RX:
+                continue
+            if speed:
+                first = record.time if first is None else first
+                delay = start + (record.time - first) / speed - self._loop.time()
+                if delay > 0:
+                    await self._send(pending)
+                    pending.clear()
+                    await asyncio.sleep(delay)
+            pending += encode(record)
+            if len(pending) >= 4096:
+                await self._send(pending)
+                pending.clear()
+        await self._send(pending)
+
+    async def _send(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                n = os.write(self.master, view)
+            except BlockingIOError:
+                n = 0
+            self.written += n
+            view = view[n:]
+            if view:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self.master, lambda: writable.done() or writable.set_result(None))
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self.master)
+
+    def _on_readable(self):
+        try:
+            self.host_bytes += len(os.read(self.master, 4096))
+        except BlockingIOError:
+            pass
+
+
+def describe(record):
+    name = MSG_NAMES.get(record.type, "type %d" % record.type)
+    stamp = time.strftime("%H:%M:%S", time.localtime(record.time)) + ("%.6f" % (record.time % 1))[1:]
+    return "%s %s %-11s %s" % (stamp, "->" if record.direction == TX else "<-", name, bytes(record.data).hex())
+
+
+async def replay(path, speed, timeout=2.0):
+    """Play a log into a UartHost; after the last byte, waits for the host's
+    nonces until `timeout` seconds pass without a new one."""
+    from uart_host import UartHost
+
+    log = SessionLog(path)
+    replayer = Replayer()
+    host = await UartHost.open(replayer.port, baud=115200)
+    nonces = sum(1 for _ in log.query([MSG_NONCE], RX))
+    try:
+        started = time.perf_counter()
+        await replayer.play(log, speed)
+        received, last = host.nonces.qsize(), time.perf_counter()
+        while received < nonces and time.perf_counter() - last < timeout:
+            await asyncio.sleep(0.001)
+            if host.nonces.qsize() > received:
+                received, last = host.nonces.qsize(), time.perf_counter()
+        elapsed = last - started
+    finally:
+        host.close()
+        replayer.close()
+        log.close()
+    print("replayed %d bytes, %d nonces in %.3f s (%.0f bytes/s)" % (replayer.written, received, elapsed, replayer.written / elapsed))
+    if received < nonces:
+        print("%d of the %d recorded nonces did not come out of the host" % (nonces - received, nonces))
+    return host
+
+
+async def demo(path):
+    from uart_host import PtyStandIn, UartHost
+
+    stand_in = PtyStandIn()
+    recorder = SessionRecorder(path, chunk=4096)
+    host = await UartHost.open(stand_in.port, baud=115200, recorder=recorder)
+    try:
+        await host.ping()
+        print("info", (await host.get_info()).hex())
+        for i in range(200):
+            await host.push_job(bytes(32), bytes(12), i)
+            stand_in.send_nonce(i)
+            await host.nonces.get()
+    finally:
+        host.close()
+        stand_in.close()
+        recorder.close()
+
+    log = SessionLog(path)
+    assert len(log) == 2 + 2 + 200 * 3
+    nonces = list(log.query([MSG_NONCE]))
+    assert [int.from_bytes(record.data[:4], "big") for record in nonces] == list(range(200))
+    middle = log.times[len(log) // 2]
+    assert all(record.time >= middle for record in log.query([MSG_PUSH_JOB, MSG_ACK], since=middle))
+    assert len(list(log.query(direction=TX))) == 2 + 200
+    for record in log.query(until=log.times[4]):
+        print(describe(record))
+    log.close()
+
+    # the receive path against the recorded traffic
+    host = await replay(path, speed=0)
+    assert host.nonces.qsize() == 200
+    print("OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and replay serial session logs.")
+    commands = parser.add_subparsers(dest="command")
+    query = commands.add_parser("query", help="print records of a log")
+    query.add_argument("log")
+    query.add_argument("--type", action="append", choices=[name for name in MSG_NAMES.values()], help="message type, can be repeated")
+    query.add_argument("--direction", choices=["tx", "rx"])
+    query.add_argument("--since", type=float, help="unix time")
+    query.add_argument("--until", type=float, help="unix time")
+    play = commands.add_parser("replay", help="replay a log into a UartHost")
+    play.add_argument("log")
+    play.add_argument("--speed", type=float, default=1.0, help="multiple of the recorded pace, 0 for as fast as possible")
+    play.add_argument("--timeout", type=float, default=2.0, help="seconds to wait for a missing nonce after the last byte")
+    args = parser.parse_args()
+
+    if args.command == "query":
+        codes = {name: code for code, name in MSG_NAMES.items()}
+        log = SessionLog(args.log)
+        types = None if args.type is None else [codes[name] for name in args.type]
+        direction = None if args.direction is None else {"tx": TX, "rx": RX}[args.direction]
+        for record in log.query(types, direction, args.since, args.until):
+            print(describe(record))
+        log.close()
+    elif args.command == "replay":
+        asyncio.run(replay(args.log, args.speed, args.timeout))
+    else:
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(demo(os.path.join(directory, "session.log")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+# Stratum V1 mining client that keeps a queue of FPGA work ready to push.
+#
+# The client subscribes and authorizes, follows mining.notify and
+# mining.set_difficulty, and in the background rolls extranonce2 over the
+# current job: for every extranonce2 it builds the coinbase, the merkle root and
+# the block header, and turns the header into a PUSH_JOB frame (midstate + 12
+# tail bytes, see uart_host.py). Up to `prefetch` of those wait in a queue, so
+# next_work() returns immediately when the board asks for more. A clean_jobs
+# notify throws the queued work away and calls the `on_clean` callbacks, so the
+# boards can leave the old job before work of the new one is ready.
+#
+# Byte order on the wire follows the stratum-mining reference: prevhash is the
+# header field with every 4 byte word reversed, version/nbits/ntime/nonce are
+# big-endian hex of the header's little-endian values, and the coinbase and
+# merkle branches are raw bytes.
+#
+# Usage: python3 stratum_v1.py    runs the client against a local MockStratumServer
+
+import asyncio
+import collections
+import functools
+import json
+import struct
+import time
+
+from difficulty import DIFF1_TARGET, difficulty_target, double_sha256, hash_value
+from metrics import PoolMetrics
+from merkle import MerkleEngine
+from midstate import calculateMidstates
+from packer import JobPacker, swap_headers
+from uart_host import MSG_PUSH_JOB, build_frame, header_nonce, pack_job, swap_words
+
+
+class StratumError(Exception):
+    pass
+
+
+class StratumJob:
+    """The parameters of one mining.notify."""
+
+    def __init__(self, job_id, prevhash, coinb1, coinb2, merkle_branch, version, nbits, ntime, clean, extranonce1, extranonce2_size, target):
+        self.job_id = job_id
+        self.prev_hash = swap_words(bytes.fromhex(prevhash))
+        self.coinb1 = bytes.fromhex(coinb1)
+        self.coinb2 = bytes.fromhex(coinb2)
+        self.merkle_branch = [bytes.fromhex(branch) for branch in merkle_branch]
+        self.version = int(version, 16)
+        self.nbits = int(nbits, 16)
+        self.ntime = int(ntime, 16)
+        self.clean = clean
+        self.extranonce1 = extranonce1
+        self.extranonce2_size = extranonce2_size
+        self.target = target
+        # when the notify came in, for the job switch latency
+        self.received = time.monotonic()
+
+    @classmethod
+    def from_notify(cls, params, extranonce1, extranonce2_size, target):
+        return cls(*params[:9], extranonce1, extranonce2_size, target)
+
+    @functools.cached_property
+    def engine(self):
+        """The coinbase and merkle branch hashing state of the job."""
+        return MerkleEngine(self.coinb1, self.extranonce1, self.coinb2, self.merkle_branch, self.version, self.prev_hash)
+
+    def merkle_root(self, extranonce2):
+        return self.engine.merkle_root(extranonce2)
+
+    def header(self, extranonce2, ntime=None):
+        """The 76 byte block header without the nonce."""
+        return self.headers([extranonce2], ntime)[0]
+
+    def headers(self, extranonces2, ntime=None):
+        ntime = self.ntime if ntime is None else ntime
+        tail = struct.pack("<II", ntime, self.nbits)
+        return [block + root[28:] + tail for root, block in self.engine.roll(extranonces2)]
+
+    def __repr__(self):
+        return "StratumJob(job_id=%r, ntime=%08x, clean=%r)" % (self.job_id, self.ntime, self.clean)
+
+
+class Work:
+    """One extranonce2 of a job: the 76 byte header and the PUSH_JOB frame for it."""
+
+    __slots__ = ("job", "extranonce2", "ntime", "header", "midstate", "tail", "frame")
+
+    def __init__(self, job, extranonce2, header, midstate, tail, frame=None):
+        self.job = job
+        self.extranonce2 = extranonce2
+        self.ntime = struct.unpack_from("<I", header, 68)[0]
+        self.header = header
+        self.midstate = midstate
+        self.tail = tail
+        self.frame = build_frame(MSG_PUSH_JOB, pack_job(midstate, tail)) if frame is None else frame
+
+    def __repr__(self):
+        return "Work(job_id=%r, extranonce2=%s)" % (self.job.job_id, self.extranonce2.hex())
+
+
+def build_work(job, extranonces2, executor=None):
+    """Work for several extranonce2 values of a job, midstates computed and
+    frames packed in one batch. The frames are views into the batch's buffer."""
+    headers = job.headers(extranonces2)
+    blocks, tails = swap_headers(headers)
+    midstates = calculateMidstates(blocks, executor=executor)
+    frames = JobPacker(len(headers)).pack(list(zip(midstates, tails)))
+    return [Work(job, *args) for args in zip(extranonces2, headers, midstates, tails, frames)]
+
+
+class StratumV1Client:
+    """A Stratum V1 session with prefetched work.
+
+    `prefetch` is the number of Work items kept ready, `batch` how many are
+    built at once. Midstates are computed off the event loop, fanned out over
+    `executor` (see midstate.calculateMidstates) if one is given. Shares are
+    counted into `metrics`, a metrics.PoolMetrics.
+    """
+
+    def __init__(self, host, port, username, password="x", prefetch=16, batch=8, executor=None, user_agent="fpga-bitcoin-miner", metrics=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.prefetch = prefetch
+        self.batch = batch
+        self.executor = executor
+        self.user_agent = user_agent
+        self.metrics = metrics if metrics is not None else PoolMetrics()
+
+        self.extranonce1 = b""
+        self.extranonce2_size = 4
+        self.difficulty = 1
+        self.target = DIFF1_TARGET
+        self.job = None
+        self.jobs = {}
+        self.work = asyncio.Queue(maxsize=prefetch)
+        self.accepted = 0
+        self.rejected = collections.Counter()
+        self.closed = None
+        # called on a clean_jobs notify
+        self.on_clean = []
+
+        self._reader = None
+        self._writer = None
+        self._next_id = 1
+        self._pending = {}
+        self._extranonce2 = 0
+        self._new_job = asyncio.Event()
+        self._tasks = []
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        self._tasks = [loop.create_task(self._receive()), loop.create_task(self._prefetch())]
+
+        await self.call("mining.subscribe", [self.user_agent])
+        if not await self.call("mining.authorize", [self.username, self.password]):
+            raise StratumError("authorization failed for " + self.username)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+    async def reconnect(self):
+        """Drop the session and open a new one; work of the old one is gone."""
+        self.close()
+        self.jobs.clear()
+        self.job = None
+        self._drop_work()
+        await self.connect()
+
+    # JSON-RPC
+
+    def call(self, method, params):
+        """Send a request, returns a future for its result."""
+        request_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (method, future)
+        self._writer.write(json.dumps({"id": request_id, "method": method, "params": params}).encode() + b"\n")
+        return future
+
+    async def _receive(self):
+        try:
+            while line := await self._reader.readline():
+                message = json.loads(line)
+                if message.get("method") is not None:
+                    self.handle(message["method"], message["params"])
+                    continue
+                method, future = self._pending.pop(message.get("id"), (None, None))
+                if future is None or future.done():
+                    continue
+                if message.get("error"):
+                    future.set_exception(StratumError(message["error"]))
+                    continue
+                if method == "mining.subscribe":
+                    # pools send the first notify right behind this, it needs the extranonce
+                    _, extranonce1, self.extranonce2_size = message["result"]
+                    self.extranonce1 = bytes.fromhex(extranonce1)
+                future.set_result(message.get("result"))
+        finally:
+            for _, future in self._pending.values():
+                future.cancel()
+            if not self.closed.done():
+                self.closed.set_result(None)
+
+    def handle(self, method, params):
+        if method == "mining.notify":
+            job = StratumJob.from_notify(params, self.extranonce1, self.extranonce2_size, self.target)
+            if job.clean:
+                self.jobs.clear()
+                self._drop_work()
+            self.jobs[job.job_id] = job
+            self.job = job
+            self._new_job.set()
+            if job.clean:
+                for callback in self.on_clean:
+                    callback()
+        elif method == "mining.set_difficulty":
+            # applies from the next job on
+            self.difficulty = params[0]
+            self.target = difficulty_target(params[0])
+
+    # Work
+
+    def _drop_work(self):
+        while not self.work.empty():
+            self.work.get_nowait()
+
+    def _next_extranonces2(self, n):
+        size = self.extranonce2_size
+        values = [((self._extranonce2 + i) % (1 << 8 * size)).to_bytes(size, "big") for i in range(n)]
+        self._extranonce2 += n
+        return values
+
+    async def _prefetch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._new_job.wait()
+            self._new_job.clear()
+            job = self.job
+            while job is self.job:
+                n = min(self.batch, self.work.maxsize - self.work.qsize()) or self.batch
+                work = await loop.run_in_executor(None, functools.partial(build_work, job, self._next_extranonces2(n), self.executor))
+                for item in work:
+                    if job.job_id not in self.jobs:
+                        break
+                    await self.work.put(item)
+
+    def is_current(self, work):
+        """Whether shares for the work would still be accepted."""
+        return self.jobs.get(work.job.job_id) is work.job
+
+    def is_valid(self, work):
+        """Whether the pool takes shares for the work; with a single pool, is_current."""
+        return self.is_current(work)
+
+    async def next_work(self):
+        """The next Work to push to the FPGA, skipping work of stale jobs."""
+        while True:
+            work = await self.work.get()
+            if self.is_current(work):
+                return work
+
+    async def submit(self, work, nonce):
+        """Submit a golden nonce, as reported by the FPGA, returns whether the pool accepted it."""
+        params = [self.username, work.job.job_id, work.extranonce2.hex(), "%08x" % work.ntime, "%08x" % header_nonce(nonce)]
+        start = time.monotonic()
+        try:
+            accepted = await self.call("mining.submit", params)
+        except StratumError as error:
+            self.metrics.share(False, work.job.target, time.monotonic() - start)
+            self.rejected[str(error.args[0])] += 1
+            return False
+        self.metrics.share(bool(accepted), work.job.target, time.monotonic() - start)
+        if accepted:
+            self.accepted += 1
+        else:
+            self.rejected["rejected"] += 1
+        return bool(accepted)
+
+
+class MockStratumServer:
+    """A local Stratum V1 pool whose job is the genesis block.
+
+    The genesis coinbase is split around 8 of the zero bytes of its input, so
+    extranonce1 and an extranonce2 of 0 give back the genesis merkle root.
+    Shares are checked with hashlib against the difficulty target. A
+    `stalled` server reads requests but no longer answers them, drop() closes
+    every client connection.
+    """
+
+    GENESIS_COINBASE = bytes.fromhex(
+        "01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000"
+    )
+    COINB1 = GENESIS_COINBASE[:29]
+    EXTRANONCE1 = GENESIS_COINBASE[29:33]
+    COINB2 = GENESIS_COINBASE[37:]
+    EXTRANONCE2_SIZE = 4
+    VERSION = 1
+    PREV_HASH = bytes(32)
+    NTIME = 0x495FAB29
+    NBITS = 0x1D00FFFF
+
+    def __init__(self, difficulty=1):
+        self.difficulty = difficulty
+        self.shares = []
+        self.clients = []
+        self.stalled = False
+        self.server = None
+        self.port = None
+        self._job_id = 0
+        self._handlers = []
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def drop(self):
+        for writer in self.clients:
+            writer.close()
+
+    def notify(self, clean=True):
+        """Hand out a new job (same block, new job id) to every client."""
+        self._job_id += 1
+        params = [
+            "%x" % self._job_id,
+            swap_words(self.PREV_HASH).hex(),
+            self.COINB1.hex(),
+            self.COINB2.hex(),
+            [],
+            "%08x" % self.VERSION,
+            "%08x" % self.NBITS,
+            "%08x" % self.NTIME,
+            clean,
+        ]
+        for writer in self.clients:
+            self._send(writer, {"id": None, "method": "mining.notify", "params": params})
+
+    def _send(self, writer, message):
+        writer.write(json.dumps(message).encode() + b"\n")
+
+    async def _serve(self, reader, writer):
+        self._handlers.append(asyncio.current_task())
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                if self.stalled:
+                    continue
+                result, error = self.handle(writer, request["method"], request["params"])
+                self._send(writer, {"id": request["id"], "result": result, "error": error})
+                if request["method"] == "mining.subscribe":
+                    self._send(writer, {"id": None, "method": "mining.set_difficulty", "params": [self.difficulty]})
+                    self.clients.append(writer)
+                    self.notify()
+        except ConnectionError:
+            pass
+        finally:
+            if writer in self.clients:
+                self.clients.remove(writer)
+            writer.close()
+
+    def handle(self, writer, method, params):
+        if method == "mining.subscribe":
+            subscriptions = [["mining.set_difficulty", "1"], ["mining.notify", "1"]]
+            return [subscriptions, self.EXTRANONCE1.hex(), self.EXTRANONCE2_SIZE], None
+        if method == "mining.authorize":
+            return True, None
+        if method == "mining.submit":
+            _, job_id, extranonce2, ntime, nonce = params
+            if int(job_id, 16) != self._job_id:
+                return None, [21, "Job not found", None]
+            merkle_root = double_sha256(self.COINB1 + self.EXTRANONCE1 + bytes.fromhex(extranonce2) + self.COINB2)
+            header = struct.pack("<I", self.VERSION) + self.PREV_HASH + merkle_root + struct.pack("<III", int(ntime, 16), self.NBITS, int(nonce, 16))
+            valid = hash_value(header) <= difficulty_target(self.difficulty)
+            self.shares.append((job_id, extranonce2, nonce, valid))
+            if not valid:
+                return None, [23, "Low difficulty share", None]
+            return True, None
+        return None, [20, "Unknown method", None]
+
+
+async def main():
+    server = await MockStratumServer().start()
+    client = StratumV1Client("127.0.0.1", server.port, "worker")
+    await client.connect()
+
+    # the first extranonce2 is 0, which makes the genesis block
+    work = await client.next_work()
+    print(work, "midstate", work.midstate.hex(), "tail", work.tail.hex())
+    print("push frame", work.frame.hex())
+    print("share accepted:", await client.submit(work, 0x1DAC2B7C), server.shares[-1])
+
+    # once the queue is full the board can take work as fast as it likes
+    while client.work.qsize() < client.prefetch - 1:
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    for _ in range(client.prefetch - 1):
+        await client.next_work()
+    print("%d prefetched jobs taken in %.3f ms" % (client.prefetch - 1, (time.perf_counter() - start) * 1000))
+
+    server.notify(clean=True)
+    while client.job.job_id == work.job.job_id:
+        await asyncio.sleep(0.01)
+    work = await client.next_work()
+    print("after clean_jobs:", work)
+
+    client.close()
+    await server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+
+# Long-lived Stratum V2 mining session over the Noise NX channel that
+# noise-connector.py sets up.
+#
+# After the handshake, every Noise transport message is a 2 byte little-endian
+# length followed by the ciphertext of one Stratum V2 frame:
+#   extension_type U16 (bit 15 = channel message), msg_type U8, msg_length U24, payload
+# Framing and in-place encryption are done by noise_frames.py.
+#
+# StratumV2Client sets up the connection, opens a standard mining channel and
+# turns NewMiningJob/SetNewPrevHash into MiningJob objects on its `jobs` queue,
+# ready to be pushed to the FPGA (see uart_host.py). Found nonces go back with
+# submit_share(). MockPool is a local pool to test against.
+#
+# Reconnects are kept short: the pool's certificate is verified once and then
+# trusted until its not_valid_after, and HandshakePool prepares the first
+# handshake message, with its fresh ephemeral key, on a thread ahead of the
+# next connection. The time to reconnect is recorded per phase (TCP connect,
+# handshake, channel setup, first job) in metrics.PoolMetrics.
+#
+# Usage: python3 stratum_v2.py    runs the client against a local MockPool and reconnects a few times
+
+import asyncio
+import collections
+import functools
+import hashlib
+import socket
+import struct
+import time
+
+import base58
+import ed25519
+
+from dissononce.processing.handshakepatterns.interactive.NX import NXHandshakePattern
+from dissononce.processing.impl.handshakestate import HandshakeState
+from dissononce.processing.impl.symmetricstate import SymmetricState
+from dissononce.processing.impl.cipherstate import CipherState
+from dissononce.cipher.chachapoly import ChaChaPolyCipher
+from dissononce.dh.x25519.x25519 import X25519DH
+from dissononce.hash.blake2s import Blake2sHash
+
+from noise_frames import FrameReader, FrameWriter, TransportCipher
+from metrics import PoolMetrics
+from uart_host import job_from_header, header_nonce
+
+HOST = "v2.eu.stratum.slushpool.com"
+PORT = 3336
+SLUSHPOOL_CA_PUBKEY = "u95GEReVMjK6k5YqiSFNqqTnKU4ypU2Wm8awa6tmbmDmk1bWt"
+
+# Message types of the mining protocol
+SETUP_CONNECTION = 0x00
+SETUP_CONNECTION_SUCCESS = 0x01
+SETUP_CONNECTION_ERROR = 0x02
+OPEN_STANDARD_MINING_CHANNEL = 0x10
+OPEN_STANDARD_MINING_CHANNEL_SUCCESS = 0x11
+OPEN_MINING_CHANNEL_ERROR = 0x12
+NEW_MINING_JOB = 0x15
+SUBMIT_SHARES_STANDARD = 0x1A
+SUBMIT_SHARES_SUCCESS = 0x1C
+SUBMIT_SHARES_ERROR = 0x1D
+SET_NEW_PREV_HASH = 0x20
+SET_TARGET = 0x21
+
+CHANNEL_MESSAGES = {NEW_MINING_JOB, SUBMIT_SHARES_STANDARD, SUBMIT_SHARES_SUCCESS, SUBMIT_SHARES_ERROR, SET_NEW_PREV_HASH, SET_TARGET}
+CHANNEL_MSG_BIT = 0x8000
+
+PROTOCOL_MINING = 0
+
+
+class StratumError(Exception):
+    pass
+
+
+# certificates with a good signature: (authority key, pool static key, fields, signature) -> not_valid_after
+_verified_certificates = {}
+
+
+@functools.lru_cache(maxsize=16)
+def decode_authority_key(authority_pubkey):
+    """The ed25519 key of a base58check encoded authority public key."""
+    return base58.b58decode_check(authority_pubkey)
+
+
+@functools.lru_cache(maxsize=16)
+def _verifying_key(authority_key):
+    return ed25519.VerifyingKey(authority_key)
+
+
+class SignatureMessage:
+    def __init__(self, raw_signature: bytes, noise_static_pubkey: bytes, authority_pubkey: str = SLUSHPOOL_CA_PUBKEY):
+        self.authority_key = decode_authority_key(authority_pubkey)
+        self.noise_static_pubkey = noise_static_pubkey
+        self.version = int.from_bytes(raw_signature[0:2], byteorder="little")
+        self.valid_from = int.from_bytes(raw_signature[2:6], byteorder="little")
+        self.not_valid_after = int.from_bytes(raw_signature[6:10], byteorder="little")
+        signature_length = int.from_bytes(raw_signature[10:12], byteorder="little")
+        self.signature = bytes(raw_signature[12 : 12 + signature_length])
+
+    @staticmethod
+    def serialize_for_verification(version, valid_from, not_valid_after, noise_static_pubkey, authority_key):
+        buffer = version.to_bytes(2, byteorder="little")
+        buffer += valid_from.to_bytes(4, byteorder="little")
+        buffer += not_valid_after.to_bytes(4, byteorder="little")
+        buffer += len(noise_static_pubkey).to_bytes(2, byteorder="little")
+        buffer += noise_static_pubkey
+        buffer += len(authority_key).to_bytes(2, byteorder="little")
+        buffer += authority_key
+        return bytes(buffer)
+
+    def verify(self):
+        """Check the certificate; its signature only the first time it is seen."""
+        now = int(time.time())
+        if now >= self.not_valid_after:
+            raise StratumError("Expired certificate")
+        key = (self.authority_key, bytes(self.noise_static_pubkey), self.version, self.valid_from, self.not_valid_after, self.signature)
+        if key in _verified_certificates:
+            return
+
+        message = self.serialize_for_verification(self.version, self.valid_from, self.not_valid_after, self.noise_static_pubkey, self.authority_key)
+        _verifying_key(self.authority_key).verify(self.signature, message)
+        for cached, not_valid_after in list(_verified_certificates.items()):
+            if now >= not_valid_after:
+                del _verified_certificates[cached]
+        _verified_certificates[key] = self.not_valid_after
+
+
+def new_handshake_state():
+    return HandshakeState(
+        SymmetricState(
+            CipherState(
+                # AESGCMCipher()
+                ChaChaPolyCipher()  # chacha20poly1305
+            ),
+            Blake2sHash(),
+        ),
+        X25519DH(),
+    )
+
+
+class HandshakePool:
+    """Initiator NX handshakes made ahead of time: ephemeral key generated and
+    first message written. Each one is used for a single connection; `size`
+    are kept ready, refilled on a thread after every take()."""
+
+    def __init__(self, size=1):
+        self.size = size
+        self._ready = collections.deque()
+        self._filling = None
+
+    @staticmethod
+    def prepare():
+        """(handshake state, first message) of a new handshake."""
+        handshakestate = new_handshake_state()
+        handshakestate.initialize(NXHandshakePattern(), True, b"")
+        # -> e     which is really      -> 2 byte length, 32 byte public key, 22 byte cleartext payload
+        message_buffer = bytearray()
+        handshakestate.write_message(b"", message_buffer)
+        return handshakestate, message_buffer
+
+    def take(self):
+        """A prepared handshake, or one made on the spot when none is ready."""
+        prepared = self._ready.popleft() if self._ready else self.prepare()
+        self.refill()
+        return prepared
+
+    def refill(self):
+        if self._filling is None or self._filling.done():
+            self._filling = asyncio.get_running_loop().run_in_executor(None, self._fill)
+
+    def _fill(self):
+        while len(self._ready) < self.size:
+            self._ready.append(self.prepare())
+
+
+# Serialization of the Stratum V2 data types
+
+
+class Writer:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def u8(self, value):
+        self.buffer += struct.pack("<B", value)
+        return self
+
+    def u16(self, value):
+        self.buffer += struct.pack("<H", value)
+        return self
+
+    def u32(self, value):
+        self.buffer += struct.pack("<I", value)
+        return self
+
+    def u64(self, value):
+        self.buffer += struct.pack("<Q", value)
+        return self
+
+    def f32(self, value):
+        self.buffer += struct.pack("<f", value)
+        return self
+
+    def boolean(self, value):
+        return self.u8(1 if value else 0)
+
+    def u256(self, value):
+        if len(value) != 32:
+            raise ValueError("U256 must be 32 bytes long")
+        self.buffer += value
+        return self
+
+    def str0_255(self, value):
+        if isinstance(value, str):
+            value = value.encode()
+        return self.b0_32(value, 255)
+
+    def b0_32(self, value, limit=32):
+        if len(value) > limit:
+            raise ValueError("value too long")
+        self.buffer += bytes([len(value)]) + value
+        return self
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def _unpack(self, fmt):
+        (value,) = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def u8(self):
+        return self._unpack("<B")
+
+    def u16(self):
+        return self._unpack("<H")
+
+    def u32(self):
+        return self._unpack("<I")
+
+    def u64(self):
+        return self._unpack("<Q")
+
+    def f32(self):
+        return self._unpack("<f")
+
+    def boolean(self):
+        return self.u8() != 0
+
+    def bytes(self, n):
+        value = bytes(self.data[self.offset : self.offset + n])
+        if len(value) != n:
+            raise StratumError("message too short")
+        self.offset += n
+        return value
+
+    def u256(self):
+        return self.bytes(32)
+
+    def b0_32(self):
+        return self.bytes(self.u8())
+
+    def str0_255(self):
+        return self.b0_32().decode()
+
+
+def parse_frame(data):
+    """Returns (msg_type, payload) of a decrypted Stratum V2 frame."""
+    if len(data) < 6:
+        raise StratumError("frame too short")
+    _, msg_type = struct.unpack_from("<HB", data)
+    length = int.from_bytes(data[3:6], "little")
+    payload = data[6 : 6 + length]
+    if len(payload) != length:
+        raise StratumError("frame length mismatch")
+    return msg_type, payload
+
+
+class NoiseConnection:
+    """A non-blocking socket with the reader/writer of a Noise session.
+
+    Until the handshake is finished the reader and writer have no cipher and
+    pass handshake messages through as they are.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.writer = FrameWriter()
+        self._loop = asyncio.get_running_loop()
+
+    def start_transport(self, send_cipherstate, receive_cipherstate):
+        self.writer.cipher = TransportCipher(send_cipherstate)
+        self.reader.cipher = TransportCipher(receive_cipherstate)
+
+    async def receive_message(self):
+        """The next whole message, a memoryview valid until the next receive."""
+        while True:
+            message = self.reader.next_message()
+            if message is not None:
+                return message
+            n = await self._loop.sock_recv_into(self.sock, self.reader.writable())
+            if not n:
+                raise ConnectionResetError("connection closed")
+            self.reader.written(n)
+
+    async def receive(self):
+        return parse_frame(await self.receive_message())
+
+    def queue(self, msg_type, payload):
+        """Add a frame to the batch that goes out with the next flush()."""
+        extension_type = CHANNEL_MSG_BIT if msg_type in CHANNEL_MESSAGES else 0
+        self.writer.add_frame(extension_type, msg_type, payload)
+
+    async def flush(self):
+        if self.writer.end:
+            await self._loop.sock_sendall(self.sock, self.writer.pending())
+            self.writer.clear()
+
+    async def send(self, msg_type, payload):
+        self.queue(msg_type, payload)
+        await self.flush()
+
+    async def send_message(self, data):
+        self.writer.add_message(data)
+        await self.flush()
+
+    def close(self):
+        self.sock.close()
+
+
+async def open_socket(host, port):
+    loop = asyncio.get_running_loop()
+    family, type, proto, _, address = (await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))[0]
+    sock = socket.socket(family, type, proto)
+    sock.setblocking(False)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def connect_noise(host, port, authority_pubkey=SLUSHPOOL_CA_PUBKEY, handshakes=None):
+    """Open a TCP connection, run the NX handshake and verify the pool's certificate."""
+    connection = NoiseConnection(await open_socket(host, port))
+    try:
+        await handshake_noise(connection, authority_pubkey, handshakes)
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+async def handshake_noise(connection, authority_pubkey=SLUSHPOOL_CA_PUBKEY, handshakes=None):
+    """Run the NX handshake on a connection, with a handshake from `handshakes`
+    (a HandshakePool) if given, and start its transport ciphers."""
+    our_handshakestate, message_buffer = HandshakePool.prepare() if handshakes is None else handshakes.take()
+    await connection.send_message(message_buffer)
+
+    #  <- e, ee, s, es, SIGNATURE_NOISE_MESSAGE
+    message_buffer = bytearray()
+    cipherstates = our_handshakestate.read_message(bytes(await connection.receive_message()), message_buffer)
+
+    pool_static_server_key = our_handshakestate.rs.data
+    signature = SignatureMessage(message_buffer, pool_static_server_key, authority_pubkey)
+    signature.verify()
+
+    # the initiator sends with the first CipherState and receives with the second
+    connection.start_transport(cipherstates[0], cipherstates[1])
+
+
+class MiningJob:
+    """A job ready for the FPGA, built from NewMiningJob + SetNewPrevHash."""
+
+    def __init__(self, channel_id, job_id, version, prev_hash, merkle_root, ntime, nbits, target):
+        self.channel_id = channel_id
+        self.job_id = job_id
+        self.version = version
+        self.prev_hash = prev_hash
+        self.merkle_root = merkle_root
+        self.ntime = ntime
+        self.nbits = nbits
+        self.target = target
+        self.header = struct.pack("<I", version) + prev_hash + merkle_root + struct.pack("<II", ntime, nbits)
+        self.midstate, self.tail = job_from_header(self.header)
+
+    def __repr__(self):
+        return "MiningJob(channel_id=%d, job_id=%d, ntime=%08x)" % (self.channel_id, self.job_id, self.ntime)
+
+
+class StratumV2Client:
+    """Keeps one standard mining channel open and streams its jobs.
+
+    Jobs come out of the `jobs` queue in the order they become minable. A
+    SetNewPrevHash makes every earlier job stale; `clean` is set on the first
+    job of the new block. Handshakes come from `handshakes`, a HandshakePool,
+    and the connect times go to `metrics`, a metrics.PoolMetrics.
+    """
+
+    def __init__(self, host=HOST, port=PORT, authority_pubkey=SLUSHPOOL_CA_PUBKEY, user_identity="fpga-bitcoin-miner", nominal_hash_rate=100.5e6 / 32, vendor="xtrinch", hardware_version="ecp5evn", firmware="fpga-bitcoin-miner", device_id="", handshakes=None, metrics=None):
+        self.host = host
+        self.port = port
+        self.authority_pubkey = authority_pubkey
+        self.user_identity = user_identity
+        self.nominal_hash_rate = nominal_hash_rate
+        self.vendor = vendor
+        self.hardware_version = hardware_version
+        self.firmware = firmware
+        self.device_id = device_id
+        self.handshakes = handshakes if handshakes is not None else HandshakePool()
+        self.metrics = metrics if metrics is not None else PoolMetrics(pool="%s:%s" % (host, port))
+
+        self.connection = None
+        self.channel_id = None
+        self.target = None
+        self.extranonce_prefix = b""
+        self.jobs = asyncio.Queue()
+        self.accepted = 0
+        self.rejected = collections.Counter()
+
+        self._future_jobs = {}
+        self._prev_hash = None
+        self._sequence_number = 0
+        # (connect started, channel open) until the first job of a connection
+        self._connecting = None
+
+    async def connect(self):
+        reconnect = self.metrics.reconnect
+        started = time.monotonic()
+        self.connection = NoiseConnection(await open_socket(self.host, self.port))
+        connected = time.monotonic()
+        reconnect["tcp"].observe(connected - started)
+        try:
+            await self._open_channel(started, connected)
+        except BaseException:
+            self.connection.close()
+            raise
+
+    async def _open_channel(self, started, connected):
+        """Handshake, SetupConnection and OpenStandardMiningChannel on a new connection."""
+        reconnect = self.metrics.reconnect
+        await handshake_noise(self.connection, self.authority_pubkey, self.handshakes)
+        handshaken = time.monotonic()
+        reconnect["handshake"].observe(handshaken - connected)
+
+        setup = (
+            Writer()
+            .u8(PROTOCOL_MINING)
+            .u16(2)  # min_version
+            .u16(2)  # max_version
+            .u32(0)  # flags, standard channels only
+            .str0_255(self.host)
+            .u16(self.port)
+            .str0_255(self.vendor)
+            .str0_255(self.hardware_version)
+            .str0_255(self.firmware)
+            .str0_255(self.device_id)
+        )
+        await self.connection.send(SETUP_CONNECTION, setup.buffer)
+        msg_type, payload = await self.connection.receive()
+        if msg_type == SETUP_CONNECTION_ERROR:
+            reader = Reader(payload)
+            reader.u32()
+            raise StratumError("SetupConnection failed: " + reader.str0_255())
+        if msg_type != SETUP_CONNECTION_SUCCESS:
+            raise StratumError("unexpected message %#x during setup" % msg_type)
+
+        request = Writer().u32(1).str0_255(self.user_identity).f32(self.nominal_hash_rate).u256(b"\xff" * 32)
+        await self.connection.send(OPEN_STANDARD_MINING_CHANNEL, request.buffer)
+        msg_type, payload = await self.connection.receive()
+        reader = Reader(payload)
+        if msg_type == OPEN_MINING_CHANNEL_ERROR:
+            reader.u32()
+            raise StratumError("OpenStandardMiningChannel failed: " + reader.str0_255())
+        if msg_type != OPEN_STANDARD_MINING_CHANNEL_SUCCESS:
+            raise StratumError("unexpected message %#x while opening the channel" % msg_type)
+        reader.u32()  # request_id
+        self.channel_id = reader.u32()
+        self.target = int.from_bytes(reader.u256(), "little")
+        self.extranonce_prefix = reader.b0_32()
+        now = time.monotonic()
+        reconnect["setup"].observe(now - handshaken)
+        self._connecting = (started, now)
+
+    async def reconnect(self):
+        """Drop the connection and open a new one, e.g. after a network blip.
+        Jobs of the old connection are gone."""
+        self.close()
+        self._future_jobs.clear()
+        self._prev_hash = None
+        await self.connect()
+
+    async def run(self):
+        """Read and handle pool messages until the connection closes."""
+        while True:
+            try:
+                msg_type, payload = await self.connection.receive()
+            except ConnectionError:
+                return
+            self.handle(msg_type, Reader(payload))
+
+    def handle(self, msg_type, reader):
+        if msg_type == NEW_MINING_JOB:
+            channel_id, job_id, future_job, version, merkle_root = reader.u32(), reader.u32(), reader.boolean(), reader.u32(), reader.u256()
+            if future_job or self._prev_hash is None:
+                self._future_jobs[job_id] = (channel_id, version, merkle_root)
+            else:
+                prev_hash, ntime, nbits = self._prev_hash
+                self._emit(MiningJob(channel_id, job_id, version, prev_hash, merkle_root, ntime, nbits, self.target), clean=False)
+        elif msg_type == SET_NEW_PREV_HASH:
+            channel_id, job_id, prev_hash, min_ntime, nbits = reader.u32(), reader.u32(), reader.u256(), reader.u32(), reader.u32()
+            self._prev_hash = (prev_hash, min_ntime, nbits)
+            future = self._future_jobs.pop(job_id, None)
+            self._future_jobs.clear()
+            if future is not None:
+                channel_id, version, merkle_root = future
+                self._emit(MiningJob(channel_id, job_id, version, prev_hash, merkle_root, min_ntime, nbits, self.target), clean=True)
+        elif msg_type == SET_TARGET:
+            reader.u32()
+            self.target = int.from_bytes(reader.u256(), "little")
+        elif msg_type == SUBMIT_SHARES_SUCCESS:
+            reader.u32()
+            reader.u32()
+            self.accepted += reader.u32()
+        elif msg_type == SUBMIT_SHARES_ERROR:
+            reader.u32()
+            reader.u32()
+            self.rejected[reader.str0_255()] += 1
+
+    def _emit(self, job, clean):
+        if self._connecting is not None:
+            started, ready = self._connecting
+            now = time.monotonic()
+            self.metrics.reconnect["first_job"].observe(now - ready)
+            self.metrics.reconnect["total"].observe(now - started)
+            self._connecting = None
+        job.clean = clean
+        self.jobs.put_nowait(job)
+
+    async def submit_share(self, job, nonce):
+        """Submit a golden nonce, as reported by the FPGA, for a job."""
+        self._sequence_number += 1
+        share = Writer().u32(job.channel_id).u32(self._sequence_number).u32(job.job_id).u32(header_nonce(nonce)).u32(job.ntime).u32(job.version)
+        await self.connection.send(SUBMIT_SHARES_STANDARD, share.buffer)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class MockPool:
+    """A local Stratum V2 pool that signs its own certificate and hands out the
+    genesis block as its only job. Shares are checked with hashlib."""
+
+    # the genesis block header without the nonce
+    GENESIS = bytes.fromhex("0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d")
+
+    def __init__(self, target=(1 << 224) - 1):
+        self.target = target
+        self.signing_key, verifying_key = ed25519.create_keypair()
+        self.authority_key = verifying_key.to_bytes()
+        self.authority_pubkey = base58.b58encode_check(self.authority_key).decode()
+        self.static_keypair = X25519DH().generate_keypair()
+        self._certificate = None
+        self.shares = []
+        self.connections = []
+        self._handlers = []
+        self._listener = None
+        self._accepting = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._listener = socket.create_server((host, port))
+        self._listener.setblocking(False)
+        self.port = self._listener.getsockname()[1]
+        self._accepting = asyncio.get_running_loop().create_task(self._accept())
+        return self
+
+    async def close(self):
+        self._accepting.cancel()
+        self._listener.close()
+        # a receive on a socket closed under it never returns
+        for handler in self._handlers:
+            handler.cancel()
+        for connection in self.connections:
+            connection.close()
+        await asyncio.gather(self._accepting, *self._handlers, return_exceptions=True)
+
+    async def _accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sock, _ = await loop.sock_accept(self._listener)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._handlers.append(loop.create_task(self._serve(NoiseConnection(sock))))
+
+    def certificate(self):
+        # signed once, like a pool's certificate
+        if self._certificate is not None:
+            return self._certificate
+        version, valid_from, not_valid_after = 0, int(time.time()) - 60, int(time.time()) + 3600
+        message = SignatureMessage.serialize_for_verification(version, valid_from, not_valid_after, self.static_keypair.public.data, self.authority_key)
+        signature = self.signing_key.sign(message)
+        self._certificate = struct.pack("<HIIH", version, valid_from, not_valid_after, len(signature)) + signature
+        return self._certificate
+
+    async def _serve(self, connection):
+        self.connections.append(connection)
+        try:
+            handshakestate = new_handshake_state()
+            handshakestate.initialize(NXHandshakePattern(), False, b"", s=self.static_keypair)
+            handshakestate.read_message(bytes(await connection.receive_message()), bytearray())
+            message_buffer = bytearray()
+            cipherstates = handshakestate.write_message(self.certificate(), message_buffer)
+            await connection.send_message(message_buffer)
+
+            # the responder sends with the second CipherState and receives with the first
+            connection.start_transport(cipherstates[1], cipherstates[0])
+            while True:
+                msg_type, payload = await connection.receive()
+                await self.handle(connection, msg_type, Reader(payload))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    async def handle(self, connection, msg_type, reader):
+        if msg_type == SETUP_CONNECTION:
+            await connection.send(SETUP_CONNECTION_SUCCESS, Writer().u16(2).u32(0).buffer)
+        elif msg_type == OPEN_STANDARD_MINING_CHANNEL:
+            request_id = reader.u32()
+            success = Writer().u32(request_id).u32(1).u256(self.target.to_bytes(32, "little")).b0_32(b"").u32(0)
+            await connection.send(OPEN_STANDARD_MINING_CHANNEL_SUCCESS, success.buffer)
+            await self.new_block(connection, job_id=1)
+        elif msg_type == SUBMIT_SHARES_STANDARD:
+            channel_id, sequence_number, job_id, nonce, ntime, version = (reader.u32() for _ in range(6))
+            header = struct.pack("<I", version) + self.GENESIS[4:68] + struct.pack("<I", ntime) + self.GENESIS[72:76] + struct.pack("<I", nonce)
+            block_hash = int.from_bytes(hashlib.sha256(hashlib.sha256(header).digest()).digest(), "little")
+            self.shares.append((job_id, nonce, block_hash <= self.target))
+            if block_hash <= self.target:
+                await connection.send(SUBMIT_SHARES_SUCCESS, Writer().u32(channel_id).u32(sequence_number).u32(1).u64(1).buffer)
+            else:
+                await connection.send(SUBMIT_SHARES_ERROR, Writer().u32(channel_id).u32(sequence_number).str0_255("difficulty-too-low").buffer)
+
+    async def new_block(self, connection, job_id):
+        version, = struct.unpack_from("<I", self.GENESIS)
+        ntime, nbits = struct.unpack_from("<II", self.GENESIS, 68)
+        # both messages go out in one send
+        connection.queue(NEW_MINING_JOB, Writer().u32(1).u32(job_id).boolean(True).u32(version).u256(self.GENESIS[36:68]).buffer)
+        connection.queue(SET_NEW_PREV_HASH, Writer().u32(1).u32(job_id).u256(self.GENESIS[4:36]).u32(ntime).u32(nbits).buffer)
+        await connection.flush()
+
+
+async def main():
+    pool = await MockPool().start()
+    client = StratumV2Client("127.0.0.1", pool.port, pool.authority_pubkey)
+    await client.connect()
+    session = asyncio.get_running_loop().create_task(client.run())
+
+    job = await client.jobs.get()
+    print(job, "midstate", job.midstate.hex(), "tail", job.tail.hex())
+    await client.submit_share(job, 0x1DAC2B7C)
+    while not pool.shares or not client.accepted:
+        await asyncio.sleep(0.01)
+    print("share accepted:", pool.shares[-1])
+    session.cancel()
+
+    # reconnects: certificate from the cache, handshake prepared in the background
+    for _ in range(20):
+        await asyncio.sleep(0.01)
+        await client.reconnect()
+        session = asyncio.get_running_loop().create_task(client.run())
+        await client.jobs.get()
+        session.cancel()
+    for phase, histogram in client.metrics.reconnect.items():
+        print("reconnect %-9s %d samples, p50 <= %g s, p99 <= %g s" % (phase, histogram.count, histogram.quantile(0.5), histogram.quantile(0.99)))
+
+    client.close()
+    await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Vectorized software model of the miner core (fpgaminer_top.v): one job
+# (midstate + 12 tail bytes) is hashed against a whole array of nonces at once,
+# running both SHA-256 passes on uint32 lanes instead of one Python int per nonce
+# like test_hasher.py does.
+#
+# Word conventions follow the PUSH_JOB payload in uart_comm.v: the midstate is
+# 8 little-endian words (a..h, as returned by midstate.calculateMidstate) and the
+# tail is 3 little-endian words (W0..W2 of the second block). The nonce is W3.
+
+import struct
+
+import numpy as np
+
+from difficulty import FPGA_TARGET
+from midstate import K, A0, B0, C0, D0, E0, F0, G0, H0
+
+K_ARRAY = np.array(K, dtype=np.uint32)
+INITIAL_STATE = (A0, B0, C0, D0, E0, F0, G0, H0)
+
+# padding words of the 2nd block (640 bit message) and of the outer hash (256 bit message)
+BLOCK2_PADDING = (0x80000000,) + (0,) * 10 + (0x00000280,)
+HASH2_PADDING = (0x80000000,) + (0,) * 6 + (0x00000100,)
+
+
+def rotr(x, n):
+    return (x >> n) | (x << (32 - n))
+
+
+def compress(state, w):
+    """Run the 64 SHA-256 rounds over lanes and add the initial state back in.
+
+    `state` and `w` are sequences of 8 and 16 words, each either a scalar or a
+    uint32 array; words that are the same for every lane can stay scalar.
+    """
+    w = list(w)
+    a, b, c, d, e, f, g, h = state
+
+    with np.errstate(over="ignore"):
+        for i in range(64):
+            if i >= 16:
+                w1, w14 = w[(i - 15) & 15], w[(i - 2) & 15]
+                s0 = rotr(w1, 7) ^ rotr(w1, 18) ^ (w1 >> 3)
+                s1 = rotr(w14, 17) ^ rotr(w14, 19) ^ (w14 >> 10)
+                w[i & 15] = w[i & 15] + s0 + w[(i - 7) & 15] + s1
+
+            e1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
+            ch = (e & f) ^ (~e & g)
+            t1 = h + e1 + ch + K_ARRAY[i] + w[i & 15]
+            e0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
+            maj = (a & b) ^ (a & c) ^ (b & c)
+            t2 = e0 + maj
+
+            a, b, c, d, e, f, g, h = t1 + t2, a, b, c, d + t1, e, f, g
+
+        return [x + s for x, s in zip((a, b, c, d, e, f, g, h), state)]
+
+
+def job_words(midstate, tail):
+    """Unpack the 32 midstate bytes and 12 tail bytes into uint32 words."""
+    if len(midstate) != 32:
+        raise ValueError("midstate must be 32 bytes long")
+    if len(tail) != 12:
+        raise ValueError("tail must be 12 bytes long")
+
+    state = [np.uint32(x) for x in struct.unpack("<8I", midstate)]
+    data = [np.uint32(x) for x in struct.unpack("<3I", tail)]
+    return state, data
+
+
+def hash_nonces(midstate, tail, nonces):
+    """Double SHA-256 of the block for every nonce, returns (hash1, hash2)
+    as lists of 8 uint32 arrays (a..h)."""
+    state, data = job_words(midstate, tail)
+    nonces = np.asarray(nonces, dtype=np.uint32)
+
+    padding = [np.uint32(x) for x in BLOCK2_PADDING]
+    hash1 = compress(state, data + [nonces] + padding)
+
+    initial = [np.uint32(x) for x in INITIAL_STATE]
+    hash2 = compress(initial, hash1 + [np.uint32(x) for x in HASH2_PADDING])
+    return hash1, hash2
+
+
+def hash_jobs(midstates, tails, nonces):
+    """Like hash_nonces, but every lane has its own job: `midstates` and `tails`
+    are arrays of shape (lanes, 32) and (lanes, 12) bytes, returns hash2."""
+    midstates = np.ascontiguousarray(midstates, dtype=np.uint8).view("<u4")
+    tails = np.ascontiguousarray(tails, dtype=np.uint8).view("<u4")
+    nonces = np.asarray(nonces, dtype=np.uint32)
+
+    state = [midstates[:, i].astype(np.uint32) for i in range(8)]
+    data = [tails[:, i].astype(np.uint32) for i in range(3)]
+    padding = [np.uint32(x) for x in BLOCK2_PADDING]
+    hash1 = compress(state, data + [nonces] + padding)
+
+    initial = [np.uint32(x) for x in INITIAL_STATE]
+    return compress(initial, hash1 + [np.uint32(x) for x in HASH2_PADDING])
+
+
+def meets_target(hash2, target):
+    """Mask of the lanes whose hash, read as a bitcoin number, is <= target.
+
+    The digest is H0..H7 big-endian and bitcoin compares it as a little-endian
+    number, so the most significant limb is byteswapped H7.
+    """
+    less = np.zeros(np.shape(hash2[7]), dtype=bool)
+    equal = np.ones(np.shape(hash2[7]), dtype=bool)
+
+    for i in range(7, -1, -1):
+        limb = np.uint32((target >> (32 * i)) & 0xFFFFFFFF)
+        value = np.asarray(hash2[i], dtype=np.uint32).byteswap()
+        less |= equal & (value < limb)
+        equal &= value == limb
+
+    return less | equal
+
+
+def sweep(midstate, tail, nonces, target=FPGA_TARGET):
+    """Return the nonces (in the given order) whose double hash meets the target."""
+    nonces = np.asarray(nonces, dtype=np.uint32)
+    _, hash2 = hash_nonces(midstate, tail, nonces)
+    return nonces[meets_target(hash2, target)]
+
+
+def sweep_range(midstate, tail, nonce_min=0, nonce_max=0xFFFFFFFF, target=FPGA_TARGET, batch_size=1 << 18):
+    """Sweep [nonce_min, nonce_max] in batches, yielding each nonce that meets the target.
+
+    Unlike the FPGA, the sweep does not stop at the first golden nonce.
+    """
+    start = nonce_min
+    while start <= nonce_max:
+        stop = min(start + batch_size, nonce_max + 1)
+        for nonce in sweep(midstate, tail, np.arange(start, stop, dtype=np.uint32), target):
+            yield int(nonce)
+        start = stop
+
+
+def words_to_int(words, lane=0):
+    """Pack a hash into an int the way test_hasher.py prints it (a in the lowest word)."""
+    return sum(int(np.atleast_1d(w)[lane]) << (32 * i) for i, w in enumerate(words))
+
+
+if __name__ == "__main__":
+    import time
+
+    # the block from test_data.txt, same vector as test_hasher.py
+    midstate = (0x228EA4732A3C9BA860C009CDA7252B9161A5E75EC8C582A5F106ABB3AF41F790).to_bytes(32, "little")
+    tail = bytes.fromhex("1571d1be4de695931a269421")
+    hash1, hash2 = hash_nonces(midstate, tail, [0x0E33337A])
+    print("%32X" % words_to_int(hash1))
+    print("%32X" % words_to_int(hash2))
+
+    # the genesis block, as pushed by test_top.v
+    midstate = bytes.fromhex("339a90bcf0bf58637daccc90a8ca591ee9d8c8c3c803014f3687b1961bf91947")
+    tail = bytes.fromhex("4a5e1e4b495fab291d00ffff")
+    count = 1 << 20
+    start = time.perf_counter()
+    found = list(sweep_range(midstate, tail, 0x1DAC2B7C - count // 2, 0x1DAC2B7C + count // 2 - 1))
+    elapsed = time.perf_counter() - start
+    print("golden nonces:", ", ".join("%08x" % n for n in found))
+    print("%.0f hashes/s" % (count / elapsed))
@@ -1,3 +1,18 @@
+# Bit-exact model of sha256_transform.v, printing the state after every round.
+#
+# hash(..., trace=...) records the rounds into a Trace instead: 64x8 uint32
+# per hash, a..h (tx_state `IDX(0) .. `IDX(7)) after each round, plus the 16
+# words of the block that identify the hash, memory-mapped when it gets large.
+# trace_diff.py compares a Trace with the pipeline registers dumped by the
+# Verilog simulation.
+#
+# Usage: python3 test_hasher.py [--trace FILE]
+
+import os
+import tempfile
+
+import numpy as np
+
 k = [0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,\
    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,\
    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,\
@@ -44,7 +59,67 @@ def round(a, b, c, d, e, f, g, h, data, k):
 	
 	return (a, b, c, d, e, f, g, h, data)
 
-def hash(state, data):
+# one traced hash: the block words W0..W15 and a..h after each round
+TRACE_DTYPE = np.dtype([("block", "<u4", 16), ("rounds", "<u4", (64, 8))])
+
+
+class Trace:
+	"""Up to `capacity` traced hashes; `rounds` has shape (capacity, 64, 8),
+	`blocks` (capacity, 16). Backed by a memmap at `path`, or at a temporary
+	file once it is larger than `memmap_bytes`, deleted by close() (or at the
+	end of a with block)."""
+
+	def __init__(self, capacity, path=None, memmap_bytes=64 << 20):
+		self.temporary = path is None and capacity * TRACE_DTYPE.itemsize > memmap_bytes
+		if self.temporary:
+			fd, path = tempfile.mkstemp(suffix=".trace")
+			os.close(fd)
+		if path is None:
+			self.records = np.zeros(capacity, dtype=TRACE_DTYPE)
+		else:
+			self.records = np.memmap(path, dtype=TRACE_DTYPE, mode="w+", shape=(capacity,))
+		self.rounds = self.records["rounds"]
+		self.blocks = self.records["block"]
+		self.path = path
+		self.count = 0
+
+	def next(self, data):
+		"""The (64, 8) round array for the next hash, of 512 bit `data`."""
+		if self.count == len(self.records):
+			raise IndexError("trace is full")
+		self.blocks[self.count] = [idx(data, i) for i in range(16)]
+		self.count += 1
+		return self.rounds[self.count - 1]
+
+	def __len__(self):
+		return self.count
+
+	def flush(self):
+		if isinstance(self.records, np.memmap):
+			self.records.flush()
+
+	def close(self):
+		self.flush()
+		self.records = self.rounds = self.blocks = None
+		if self.temporary:
+			os.unlink(self.path)
+			self.temporary = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def load_trace(path):
+	"""The records of a Trace written to `path`, read-only."""
+	return np.memmap(path, dtype=TRACE_DTYPE, mode="r")
+
+
+def hash(state, data, trace=None, verbose=False):
+	"""SHA-256 transform of 512 bit `data` from `state` (word 0 in the lowest bits).
+	With a Trace the round states are recorded, with `verbose` printed."""
 	a = idx(state, 0)
 	b = idx(state, 1)
 	c = idx(state, 2)
@@ -54,10 +129,14 @@ def hash(state, data):
 	g = idx(state, 6)
 	h = idx(state, 7)
 
+	rounds = trace.next(data) if trace is not None else None
 	for i in range(64):
 		(a, b, c, d, e, f, g, h, data) = round(a, b, c, d, e, f, g, h, data, k[i])
 
-		print ("\t[%d]\t\t%08x%08x%08x%08x%08x%08x%08x%08x" % (i, h, g, f, e, d, c, b, a))
+		if rounds is not None:
+			rounds[i] = (a, b, c, d, e, f, g, h)
+		if verbose:
+			print ("\t[%d]\t\t%08x%08x%08x%08x%08x%08x%08x%08x" % (i, h, g, f, e, d, c, b, a))
 	
 	a = (a + idx(state, 0)) & 0xFFFFFFFF
 	b = (b + idx(state, 1)) & 0xFFFFFFFF
@@ -71,15 +150,41 @@ def hash(state, data):
 	return (h << 224) | (g << 192) | (f << 160) | (e << 128) | (d << 96) | (c << 64) | (b << 32) | a
 
 
-midstate = 0x228ea4732a3c9ba860c009cda7252b9161a5e75ec8c582a5f106abb3af41f790
-# data with the nonce 0xh0e33337a
-data = 0x0000028000000000000000000000000000000000000000000000000000000000000000000000000000000000800000000e33337a2194261a9395e64dbed17115
+INITIAL_STATE = 0x5be0cd191f83d9ab9b05688c510e527fa54ff53a3c6ef372bb67ae856a09e667
+HASH2_PADDING = 0x0000010000000000000000000000000000000000000000000000000080000000
+
+
+def double_hash(midstate, data, trace=None, verbose=False):
+	"""(hash1, hash2) as fpgaminer_top.v computes them; a Trace gets both hashes."""
+	hash1 = hash(midstate, data, trace, verbose)
+	if verbose:
+		print ("-------------------------------------------------------------------------")
+		print ("%32X" % hash1)
+		print ("-------------------------------------------------------------------------")
+	hash2 = hash(INITIAL_STATE, (HASH2_PADDING << 256) | hash1, trace, verbose)
+	if verbose:
+		print ("-------------------------------------------------------------------------")
+		print ("%32X" % hash2)
+		print ("-------------------------------------------------------------------------")
+	return hash1, hash2
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Model of sha256_transform.v.")
+	parser.add_argument("--trace", help="record the round states to this file instead of printing them")
+	args = parser.parse_args()
+
+	midstate = 0x228ea4732a3c9ba860c009cda7252b9161a5e75ec8c582a5f106abb3af41f790
+	# data with the nonce 0xh0e33337a
+	data = 0x0000028000000000000000000000000000000000000000000000000000000000000000000000000000000000800000000e33337a2194261a9395e64dbed17115
 
-hash1 = hash(midstate, data)
-print ("-------------------------------------------------------------------------")
-print ("%32X" % hash1)
-print ("-------------------------------------------------------------------------")
-hash2 = hash(0x5be0cd191f83d9ab9b05688c510e527fa54ff53a3c6ef372bb67ae856a09e667, (0x0000010000000000000000000000000000000000000000000000000080000000 << 256) | hash1)
-print ("-------------------------------------------------------------------------")
-print ("%32X" % hash2)
-print ("-------------------------------------------------------------------------")
\ No newline at end of file
+	if args.trace:
+		with Trace(2, args.trace) as trace:
+			hash1, hash2 = double_hash(midstate, data, trace)
+		print ("%32X" % hash1)
+		print ("%32X" % hash2)
+		print ("%d hashes traced to %s" % (len(trace), args.trace))
+	else:
+		double_hash(midstate, data, verbose=True)
\ No newline at end of file
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# Lines up the per-stage register dump of sha256_transform.v (compiled with
+# -DTRACE, see `make trace-miner`) with round traces of test_hasher.py and
+# reports the first round and word where the pipeline and the model diverge.
+#
+# Every edge, stage i of a transform does round LOOP * i + cnt, so a hash that
+# enters stage 0 with cnt == 0 on edge t has its state after round r in stage
+# r // LOOP on edge t + r. The dump is read as a stream: each hash entering the
+# pipeline collects its 64 rounds from the following edges and is then
+# compared with the model hash of the same block. Stage 0's message window
+# after round 0 holds W1..W16 of the block, which identifies it; the pipeline
+# hashes whatever nonce it is at, hashes of blocks the model did not trace are
+# only counted.
+#
+# Usage:
+#   python3 trace_diff.py model OUT [--midstate HEX --work-data HEX --nonce HEX --count N]
+#   python3 trace_diff.py diff TRACE [DUMP]          DUMP defaults to standard input
+#   python3 trace_diff.py demo [--loop-log2 N]       dump of miner_model.RtlSimulation, with one word corrupted
+
+import argparse
+import collections
+import re
+import sys
+
+import numpy as np
+
+from miner_model import GENESIS_MIDSTATE, GENESIS_NONCE, GENESIS_WORK_DATA, RtlSimulation
+from test_hasher import Trace, double_hash, load_trace
+
+MASK = 0xFFFFFFFF
+WORD_NAMES = "abcdefgh"
+# {384 bits of padding, nonce, work_data}, as fpgaminer_top.v builds its `data`
+BLOCK2_PADDING = 0x000002800000000000000000000000000000000000000000000000000000000000000000000000000000000080000000
+
+DUMP_LINE = re.compile(r"^trace (\S+?)(?:\.HASHERS\[\d+\])? (\d+) (\d+) (\d+) ([0-9a-fA-F]{64}) ([0-9a-fA-F]{128})\s*$")
+
+# a hash in the pipeline: instance, edge it entered stage 0 on, W1..W15 of its block, its rounds so far
+PipelineHash = collections.namedtuple("PipelineHash", ["instance", "edge", "block", "rounds"])
+Divergence = collections.namedtuple("Divergence", ["instance", "edge", "model_hash", "round", "word", "rtl", "model"])
+
+
+def block_data(work_data, nonce):
+    """The 512 bit second block of the header, as test_hasher.hash takes it."""
+    return BLOCK2_PADDING << 128 | nonce << 96 | work_data
+
+
+def model_trace(midstate, work_data, nonces, path=None):
+    """Trace of hash1 and hash2 for every nonce, in that order; close it when done."""
+    trace = Trace(2 * len(nonces), path)
+    for nonce in nonces:
+        double_hash(midstate, block_data(work_data, nonce), trace)
+    trace.flush()
+    return trace
+
+
+def read_dump(lines):
+    """Yield (instance, edge, stage, cnt, 8 state words a..h, 16 message
+    words) from dump lines; edges are counted per instance from the $time of the lines."""
+    edges = {}
+    for line in lines:
+        match = DUMP_LINE.match(line)
+        if not match:
+            continue
+        instance, time, stage, cnt, state, w = match.groups()
+        last_time, edge = edges.get(instance, (None, -1))
+        if time != last_time:
+            edge += 1
+            edges[instance] = (time, edge)
+        state, w = int(state, 16), int(w, 16)
+        yield instance, edge, int(stage), int(cnt), [(state >> 32 * i) & MASK for i in range(8)], [(w >> 32 * i) & MASK for i in range(16)]
+
+
+def pipeline_hashes(records):
+    """Yield a PipelineHash with (64, 8) rounds for each hash that went through
+    all 64 rounds in the dump."""
+    # per instance: number of stages seen on the current edge, stages, LOOP
+    stages = collections.defaultdict(int)
+    loops = {}
+    current = {}
+    active = collections.defaultdict(list)
+
+    for instance, edge, stage, cnt, state, w in records:
+        if current.get(instance) != edge:
+            if instance in current and instance not in loops:
+                loops[instance] = 64 // stages[instance]
+            current[instance] = edge
+        stages[instance] = max(stages[instance], stage + 1)
+        loop = loops.get(instance)
+        if loop is None:
+            continue
+
+        if stage == 0 and cnt == 0:
+            active[instance].append(PipelineHash(instance, edge, tuple(w[:15]), np.zeros((64, 8), dtype=np.uint32)))
+
+        remaining = []
+        for h in active[instance]:
+            r = edge - h.edge
+            if stage == r // loop and cnt == r % loop:
+                h.rounds[r] = state
+                if r == 63:
+                    yield h
+                    continue
+            remaining.append(h)
+        active[instance] = remaining
+
+
+def first_divergence(rounds, model):
+    """(round, word) where `rounds` first differs from a model hash's (64, 8)
+    rounds, or None."""
+    differs = np.argwhere(rounds != model)
+    if not len(differs):
+        return None
+    return tuple(int(x) for x in differs[0])
+
+
+def diff(records, lines):
+    """Compare a dump with the records of a Trace. Returns (matched, unmatched,
+    divergences) with the divergences in the order the hashes entered the pipeline."""
+    models = {tuple(int(x) for x in block[1:]): i for i, block in enumerate(records["block"])}
+    matched = unmatched = 0
+    divergences = []
+    for h in pipeline_hashes(read_dump(lines)):
+        model_hash = models.get(h.block)
+        if model_hash is None:
+            unmatched += 1
+            continue
+        model = records["rounds"][model_hash]
+        divergence = first_divergence(h.rounds, model)
+        if divergence is None:
+            matched += 1
+        else:
+            r, word = divergence
+            divergences.append(Divergence(h.instance, h.edge, model_hash, r, word, int(h.rounds[r, word]), int(model[r, word])))
+    return matched, unmatched, divergences
+
+
+def simulate_dump(loop_log2, midstate, work_data, nonce_min, edges, corrupt=None):
+    """Dump lines of RtlSimulation in the format of sha256_transform.v with TRACE.
+    `corrupt` = (edge, stage, word) flips a bit of one register of uut in the dump."""
+    sim = RtlSimulation(loop_log2, midstate, work_data, nonce_min)
+    for edge in range(edges):
+        cnt = sim.cnt
+        sim.step(reset=edge == 0)
+        for name, transform in (("test_fpgaminer_top.uut.uut", sim.uut), ("test_fpgaminer_top.uut.uut2", sim.uut2)):
+            for stage, state in enumerate(transform.state):
+                state = list(state)
+                if transform is sim.uut and corrupt is not None and corrupt[:2] == (edge, stage):
+                    state[corrupt[2]] ^= 1
+                value = sum(word << 32 * i for i, word in enumerate(state))
+                w = sum(word << 32 * i for i, word in enumerate(transform.w[stage]))
+                yield "trace %s.HASHERS[%d] %d %d %d %064x %0128x" % (name, stage, 100 + 10 * edge, stage, cnt, value, w)
+
+
+def report(matched, unmatched, divergences, model_hashes):
+    print("%d pipeline hashes match the model, %d diverge, %d were not traced" % (matched, len(divergences), unmatched))
+    if divergences:
+        d = divergences[0]
+        print(
+            "first divergence: %s, hash entering on edge %d (model hash %d of %d): round %d, word %s: rtl %08x, model %08x"
+            % (d.instance, d.edge, d.model_hash, model_hashes, d.round, WORD_NAMES[d.word], d.rtl, d.model)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare pipeline dumps of sha256_transform.v with model traces.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("model", help="trace hash1 and hash2 for a range of nonces")
+    command.add_argument("path")
+    command.add_argument("--midstate", type=lambda x: int(x, 16), default=GENESIS_MIDSTATE, help="as fpgaminer_top.v takes it")
+    command.add_argument("--work-data", type=lambda x: int(x, 16), default=GENESIS_WORK_DATA)
+    command.add_argument("--nonce", type=lambda x: int(x, 16), default=GENESIS_NONCE - 2, help="first nonce")
+    command.add_argument("--count", type=int, default=3)
+
+    command = commands.add_parser("diff", help="compare a dump with a model trace")
+    command.add_argument("trace")
+    command.add_argument("dump", nargs="?", help="simulation output, standard input by default")
+
+    command = commands.add_parser("demo", help="diff a simulated dump with one corrupted register")
+    command.add_argument("--loop-log2", type=int, default=2)
+
+    args = parser.parse_args()
+
+    if args.command == "model":
+        with model_trace(args.midstate, args.work_data, [(args.nonce + i) & MASK for i in range(args.count)], args.path) as trace:
+            print("%d hashes traced to %s" % (len(trace), args.path))
+
+    elif args.command == "diff":
+        traces = load_trace(args.trace)
+        dump = open(args.dump) if args.dump else sys.stdin
+        with dump:
+            matched, unmatched, divergences = diff(traces, dump)
+        report(matched, unmatched, divergences, len(traces))
+        sys.exit(1 if divergences or not matched else 0)
+
+    elif args.command == "demo":
+        nonce_min = GENESIS_NONCE - 2
+        trace = model_trace(GENESIS_MIDSTATE, GENESIS_WORK_DATA, [nonce_min + i for i in range(1, 4)])
+        loop = 1 << args.loop_log2
+        edges = 200 + 4 * loop
+
+        print("clean dump:")
+        report(*diff(trace.records, simulate_dump(args.loop_log2, GENESIS_MIDSTATE, GENESIS_WORK_DATA, nonce_min, edges)), len(trace))
+
+        # stage 1 of uut while it does round LOOP + 1 of the first traced nonce
+        dump = simulate_dump(args.loop_log2, GENESIS_MIDSTATE, GENESIS_WORK_DATA, nonce_min, edges)
+        first = next(h for h in pipeline_hashes(read_dump(dump)) if h.instance.endswith(".uut") and first_divergence(h.rounds, trace.rounds[0]) is None)
+        corrupt = (first.edge + loop + 1, 1, 4)
+        print("uut stage 1, word e flipped on edge %d:" % corrupt[0])
+        report(*diff(trace.records, simulate_dump(args.loop_log2, GENESIS_MIDSTATE, GENESIS_WORK_DATA, nonce_min, edges, corrupt)), len(trace))
+        trace.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+
+# asyncio host driver for the serial protocol in src/uart_comm.v.
+#
+# Frames sent to the FPGA are [length, 0x00, 0x00, type, payload..., CRC32] where
+# length counts the whole frame and the CRC (crc32.CRC32_FPGA) is appended
+# big-endian so that the FPGA's running CRC ends up at 0. A single 0x00 byte is a
+# ping. The FPGA answers with:
+#   - 0x01 on its own: PONG or ACK (uart_comm.v sends both as a 1 byte message)
+#   - [length, 0x00, 0x00, type, body...] for INFO, INVALID, RESEND and NONCE,
+#     uart_comm.v does not append a CRC, the trailing bytes are filler.
+#
+# uart_comm.v handles one message at a time and answers in the order the
+# messages came in, so acks are matched to requests first-in first-out.
+#
+# Besides PUSH_JOB, which replaces the running job, QUEUE_JOB appends a job to
+# the board's FIFO of QUEUE_DEPTH jobs and CLEAR_QUEUE empties it. The miner
+# takes the next queued job by itself once it is done with the current one
+# (golden nonce found or nonce_max hashed), so no NONCE or ACK marks the switch.
+#
+# A priority frame (work of a clean job) goes ahead of everything queued, and
+# job frames that have not reached the FPGA yet are dropped for it: the queued
+# ones and the ones waiting in the write buffer behind the frame being written.
+# Job frames already on the wire are not retransmitted after a RESEND.
+#
+# Usage: python3 uart_host.py [/dev/ttyUSB2]
+# Without a port, the driver talks to PtyStandIn over a pseudo-terminal.
+
+import asyncio
+import collections
+import io
+import os
+import struct
+import termios
+import time
+import tty
+
+from crc32 import CRC32_FPGA
+from metrics import HostMetrics
+from midstate import calculateMidstate
+
+# Message Types
+MSG_INFO = 0
+MSG_INVALID = 1
+MSG_PUSH_JOB = 2
+MSG_NONCE = 3
+MSG_ACK = 4
+MSG_RESEND = 5
+MSG_QUEUE_JOB = 6
+MSG_CLEAR_QUEUE = 7
+
+HEADER_SIZE = 4
+CRC_SIZE = 4
+# 256 bits midstate hash, 96 bits time+merkleroot+difficulty, 32 bits min nonce, 32 bits max nonce
+JOB_SIZE = 52
+MSG_BUF_LEN = JOB_SIZE + HEADER_SIZE + CRC_SIZE
+# jobs the FIFO in uart_comm.v holds, 1 << QUEUE_LOG2
+QUEUE_DEPTH = 4
+
+PING = b"\x00"
+PONG = 0x01
+
+BAUD_RATES = {9600: termios.B9600, 19200: termios.B19200, 38400: termios.B38400, 57600: termios.B57600, 115200: termios.B115200}
+
+Message = collections.namedtuple("Message", ["type", "body"])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Preempted(ProtocolError):
+    """A job frame was dropped for a priority frame before it reached the FPGA."""
+
+
+def build_frame(msg_type, payload=b""):
+    """Frame a message the way uart_comm.v expects it: header, payload, CRC."""
+    length = HEADER_SIZE + len(payload) + CRC_SIZE
+    if length > MSG_BUF_LEN:
+        raise ValueError("message does not fit into the FPGA receive buffer")
+
+    frame = bytearray(length)
+    frame[0] = length
+    frame[3] = msg_type
+    frame[HEADER_SIZE : length - CRC_SIZE] = payload
+    frame[length - CRC_SIZE :] = CRC32_FPGA.new(memoryview(frame)[: length - CRC_SIZE]).digest()
+    return bytes(frame)
+
+
+def pack_job(midstate, tail, nonce_min=0, nonce_max=0xFFFFFFFF):
+    """PUSH_JOB payload: max nonce, min nonce, the 12 tail bytes and the midstate,
+    words little-endian (see the genesis block push in test_top.v)."""
+    if len(midstate) != 32:
+        raise ValueError("midstate must be 32 bytes long")
+    if len(tail) != 12:
+        raise ValueError("tail must be 12 bytes long")
+    return struct.pack("<II", nonce_max, nonce_min) + bytes(tail) + bytes(midstate)
+
+
+def unpack_job(payload):
+    """Inverse of pack_job, returns (midstate, tail, nonce_min, nonce_max)."""
+    nonce_max, nonce_min = struct.unpack_from("<II", payload)
+    return bytes(payload[20:52]), bytes(payload[8:20]), nonce_min, nonce_max
+
+
+def swap_words(data):
+    """Reverse the bytes of every 4-byte word, the byte order calculateMidstate
+    and the miner take block header data in."""
+    words = struct.unpack("<%dI" % (len(data) // 4), data)
+    return struct.pack(">%dI" % len(words), *words)
+
+
+def job_from_header(header):
+    """(midstate, tail) of the PUSH_JOB payload for an 80 (or 76) byte block header,
+    in the byte order the header is hashed in."""
+    if len(header) not in (76, 80):
+        raise ValueError("header must be 76 or 80 bytes long")
+    return calculateMidstate(swap_words(header[:64])), swap_words(header[64:76])
+
+
+def is_job_frame(frame):
+    """Whether a frame to the FPGA carries a job (PUSH_JOB or QUEUE_JOB)."""
+    return len(frame) == MSG_BUF_LEN and frame[3] in (MSG_PUSH_JOB, MSG_QUEUE_JOB)
+
+
+def header_nonce(nonce):
+    """The nonce as it goes into the block header, for a golden nonce from MSG_NONCE."""
+    return int.from_bytes(nonce.to_bytes(4, "big"), "little")
+
+
+class FrameParser:
+    """Splits the FPGA's byte stream into messages, over a reusable buffer."""
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def free(self):
+        """Writable view of the buffer's free space, compacting it first if needed."""
+        if self.start and len(self.buffer) - self.end < MSG_BUF_LEN:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start : self.end]
+            self.start, self.end = 0, pending
+        return memoryview(self.buffer)[self.end :]
+
+    def written(self, n):
+        self.end += n
+
+    def feed(self, data):
+        view = self.free()
+        view[: len(data)] = data
+        self.written(len(data))
+
+    def messages(self):
+        buffer = self.buffer
+        while self.start < self.end:
+            length = buffer[self.start]
+            if length == 1:
+                # uart_comm.v sends PONG and ACK as a lone length byte
+                self.start += 1
+                yield Message(MSG_ACK, b"")
+                continue
+            if length < HEADER_SIZE + CRC_SIZE:
+                # not a frame start, resynchronise on the next byte
+                self.start += 1
+                continue
+            if self.end - self.start < length:
+                return
+            frame = memoryview(buffer)[self.start : self.start + length]
+            self.start += length
+            yield Message(frame[3], bytes(frame[HEADER_SIZE:]))
+
+        self.start = self.end = 0
+
+
+def open_serial(port, baud=9600):
+    """Open a serial port (or pty) in raw, non-blocking 8N1 mode, like pc-comm.c."""
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    tty.setraw(fd)
+    attrs = termios.tcgetattr(fd)
+    attrs[2] &= ~(termios.PARENB | termios.CSTOPB | termios.CSIZE | termios.CRTSCTS)
+    attrs[2] |= termios.CS8 | termios.CREAD | termios.CLOCAL
+    attrs[4] = attrs[5] = BAUD_RATES[baud]
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    termios.tcflush(fd, termios.TCIFLUSH)
+    return fd
+
+
+class _Request:
+    __slots__ = ("frame", "future", "sent_at", "attempts", "priority", "stale")
+
+    def __init__(self, frame, future, priority=False):
+        self.frame = frame
+        self.future = future
+        self.sent_at = None
+        self.attempts = 0
+        self.priority = priority
+        # a job frame on the wire when a priority frame came, not worth a retransmit
+        self.stale = False
+
+
+class UartHost:
+    """Driver for one board.
+
+    Requests are written without waiting for the previous answer, up to `window`
+    frames in flight. uart_comm.v drops bytes that arrive while it is still
+    answering, so the default of 1 is the safe setting for the current RTL. A
+    RESEND answer or a missing answer after `timeout` seconds retransmits the
+    frame, up to `retries` times; with more than one frame in flight the
+    retransmitted frame lands after the ones sent behind it. Golden nonces are
+    put on the `nonces` queue. Counts go to `metrics`, a metrics.HostMetrics,
+    and the traffic to `recorder`, a session_log.SessionRecorder, if given.
+    """
+
+    def __init__(self, fd, window=1, timeout=1.0, retries=3, metrics=None, recorder=None):
+        self.fd = fd
+        self.file = io.FileIO(fd, "r+b", closefd=False)
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.parser = FrameParser()
+        self.nonces = asyncio.Queue()
+        # seconds between writing a request and receiving its answer
+        self.round_trips = collections.deque(maxlen=1024)
+        self.retransmits = 0
+        self.metrics = metrics if metrics is not None else HostMetrics()
+        self.recorder = recorder
+
+        self._loop = asyncio.get_running_loop()
+        self._queued = collections.deque()
+        self._in_flight = collections.deque()
+        self._write_buffer = bytearray()
+        # [request, bytes of its frame still in the write buffer], in buffer order
+        self._unsent = collections.deque()
+        self._loop.add_reader(fd, self._on_readable)
+        self._watchdog = self._loop.create_task(self._watch_timeouts())
+
+    @classmethod
+    async def open(cls, port, baud=9600, **kwargs):
+        return cls(open_serial(port, baud), **kwargs)
+
+    def close(self):
+        self._watchdog.cancel()
+        self._loop.remove_reader(self.fd)
+        self._loop.remove_writer(self.fd)
+        for request in list(self._queued) + list(self._in_flight):
+            if not request.future.done():
+                request.future.cancel()
+        os.close(self.fd)
+
+    # Requests
+
+    def submit(self, frame, priority=False):
+        """Queue a raw frame, returns a future for the FPGA's answer. A
+        `priority` frame preempts the job frames not sent yet, which fail with
+        Preempted, and goes out before anything else that is queued."""
+        request = _Request(frame, self._loop.create_future(), priority)
+        if is_job_frame(frame):
+            self.metrics.jobs_pushed.inc()
+        if priority:
+            self._preempt()
+            # behind the priority frames queued before it
+            position = 0
+            while position < len(self._queued) and self._queued[position].priority:
+                position += 1
+            self._queued.insert(position, request)
+        else:
+            self._queued.append(request)
+        self._send_queued()
+        return request.future
+
+    async def ping(self):
+        await self.submit(PING)
+
+    async def get_info(self):
+        message = await self.submit(build_frame(MSG_INFO))
+        if message.type != MSG_INFO:
+            raise ProtocolError("expected INFO, got message type %d" % message.type)
+        return message.body[:8]
+
+    def submit_job(self, midstate, tail, nonce_min=0, nonce_max=0xFFFFFFFF, priority=False):
+        """Push a job without waiting, returns a future that resolves on its ACK."""
+        return self.submit(build_frame(MSG_PUSH_JOB, pack_job(midstate, tail, nonce_min, nonce_max)), priority)
+
+    async def push_job(self, midstate, tail, nonce_min=0, nonce_max=0xFFFFFFFF, priority=False):
+        message = await self.submit_job(midstate, tail, nonce_min, nonce_max, priority)
+        if message.type != MSG_ACK:
+            raise ProtocolError("expected ACK, got message type %d" % message.type)
+
+    async def queue_job(self, midstate, tail, nonce_min=0, nonce_max=0xFFFFFFFF):
+        """Append a job to the board's FIFO; INVALID (a ProtocolError) when it is full."""
+        message = await self.submit(build_frame(MSG_QUEUE_JOB, pack_job(midstate, tail, nonce_min, nonce_max)))
+        if message.type != MSG_ACK:
+            raise ProtocolError("expected ACK, got message type %d" % message.type)
+
+    async def clear_queue(self, priority=False):
+        """Drop the queued jobs, the running one carries on."""
+        message = await self.submit(build_frame(MSG_CLEAR_QUEUE), priority)
+        if message.type != MSG_ACK:
+            raise ProtocolError("expected ACK, got message type %d" % message.type)
+
+    # Transmit
+
+    def _send_queued(self):
+        while self._queued and len(self._in_flight) < self.window:
+            request = self._queued.popleft()
+            if request.future.cancelled():
+                continue
+            self._in_flight.append(request)
+            self._transmit(request)
+
+    def _transmit(self, request):
+        request.sent_at = time.monotonic()
+        request.attempts += 1
+        if self.recorder is not None:
+            self.recorder.sent(request.frame)
+        self._write(request)
+
+    def _preempt(self):
+        for request in [request for request in self._queued if is_job_frame(request.frame)]:
+            self._queued.remove(request)
+            self._drop(request)
+
+        # whole frames in the write buffer, behind the one being written
+        kept = collections.deque()
+        for i, (request, remaining) in enumerate(self._unsent):
+            if i == 0 and remaining < len(request.frame) or not is_job_frame(request.frame):
+                kept.append([request, remaining])
+            else:
+                self._in_flight.remove(request)
+                self._drop(request)
+        if len(kept) != len(self._unsent):
+            self._unsent = kept
+            self._write_buffer = bytearray(b"".join(request.frame[-remaining:] for request, remaining in kept))
+            if not self._write_buffer:
+                self._loop.remove_writer(self.fd)
+
+        for request in self._in_flight:
+            if is_job_frame(request.frame):
+                request.stale = True
+
+    def _drop(self, request):
+        self.metrics.preempted.inc()
+        if not request.future.done():
+            request.future.set_exception(Preempted("job frame dropped for a priority frame"))
+
+    def _retransmit_oldest(self):
+        request = self._in_flight.popleft()
+        if request.stale:
+            self._drop(request)
+            self._send_queued()
+            return
+        # nobody waits for a cancelled request, it gives its place in the window up
+        if request.future.cancelled():
+            self._send_queued()
+            return
+        if request.attempts > self.retries:
+            if not request.future.done():
+                request.future.set_exception(ProtocolError("no valid answer after %d attempts" % request.attempts))
+            self._send_queued()
+            return
+        # frames sent after this one will be answered first, so it goes to the back
+        self.retransmits += 1
+        self.metrics.retransmits.inc()
+        self._in_flight.append(request)
+        self._transmit(request)
+
+    def _write(self, request):
+        data = request.frame
+        if not self._write_buffer:
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                written = 0
+            data = data[written:]
+            if not data:
+                return
+            self._loop.add_writer(self.fd, self._on_writable)
+        self._write_buffer += data
+        self._unsent.append([request, len(data)])
+
+    def _on_writable(self):
+        try:
+            written = os.write(self.fd, self._write_buffer)
+        except BlockingIOError:
+            return
+        del self._write_buffer[:written]
+        while written:
+            entry = self._unsent[0]
+            n = min(written, entry[1])
+            entry[1] -= n
+            written -= n
+            if not entry[1]:
+                self._unsent.popleft()
+        if not self._write_buffer:
+            self._loop.remove_writer(self.fd)
+
+    # Receive
+
+    def _on_readable(self):
+        try:
+            n = self.file.readinto(self.parser.free())
+        except OSError:
+            return
+        if not n:
+            return
+        self.parser.written(n)
+
+        for message in self.parser.messages():
+            self._dispatch(message)
+
+    def _dispatch(self, message):
+        if self.recorder is not None:
+            self.recorder.received(message)
+        if message.type == MSG_NONCE:
+            self.metrics.nonce()
+            self.nonces.put_nowait(int.from_bytes(message.body[:4], "big"))
+            return
+        if message.type == MSG_RESEND:
+            # frames to the FPGA carry the only CRC on the link
+            self.metrics.crc_failures.inc()
+        elif message.type == MSG_INVALID:
+            self.metrics.invalid.inc()
+
+        if not self._in_flight:
+            return  # an answer nobody waits for, e.g. to a frame that already timed out
+        if message.type == MSG_RESEND:
+            self._retransmit_oldest()
+            return
+
+        request = self._in_flight.popleft()
+        self.round_trips.append(time.monotonic() - request.sent_at)
+        self.metrics.round_trip.observe(self.round_trips[-1])
+        if message.type == MSG_ACK and is_job_frame(request.frame):
+            self.metrics.jobs_acked.inc()
+        if not request.future.done():
+            if message.type == MSG_INVALID:
+                request.future.set_exception(ProtocolError("FPGA rejected the message as invalid"))
+            else:
+                request.future.set_result(message)
+        self._send_queued()
+
+    async def _watch_timeouts(self):
+        while True:
+            await asyncio.sleep(self.timeout / 4)
+            if self._in_flight and time.monotonic() - self._in_flight[0].sent_at > self.timeout:
+                self._retransmit_oldest()
+
+
+class PtyStandIn:
+    """Answers like uart_comm.v from behind a pseudo-terminal, so the driver can
+    run without a board. Open `port` with the driver and call `send_nonce` to
+    make the stand-in report a golden nonce, `job_done` when the miner would
+    be done with its job and take the next queued one."""
+
+    system_info = bytes.fromhex("deadbeef13370d13")
+    queue_depth = QUEUE_DEPTH
+
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        os.set_blocking(self.master, False)
+        self.received = bytearray()
+        # every job the miner started, pushed or from the queue
+        self.jobs = []
+        self.queue = collections.deque()
+        self.idle = True
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.master, self._on_readable)
+
+    def close(self):
+        self._loop.remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def send(self, data):
+        os.write(self.master, data)
+
+    def send_nonce(self, nonce):
+        self.send(bytes([8, 0, 0, MSG_NONCE]) + nonce.to_bytes(4, "big"))
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            return
+        self.receive(data)
+
+    def receive(self, data):
+        self.received += data
+        while self.received:
+            length = self.received[0]
+            if length == 0:
+                del self.received[0]
+                self.send(bytes([PONG]))
+                continue
+            if length < HEADER_SIZE + CRC_SIZE:
+                del self.received[0]
+                self.send(bytes([8, 0, 0, MSG_INVALID, 0, 0, 0, 0]))
+                continue
+            if len(self.received) < length:
+                return
+            frame = bytes(self.received[:length])
+            del self.received[:length]
+            self.on_frame(frame)
+
+    def on_frame(self, frame):
+        msg_type = frame[3]
+        if CRC32_FPGA(frame) != 0:
+            self.send(bytes([8, 0, 0, MSG_RESEND, 0, 0, 0, 0]))
+        elif msg_type == MSG_INFO and len(frame) == 8:
+            self.send(bytes([16, 0, 0, MSG_INFO]) + self.system_info + bytes(4))
+        elif msg_type == MSG_PUSH_JOB and len(frame) == MSG_BUF_LEN:
+            self.send(bytes([PONG]))
+            self.start_job(unpack_job(frame[HEADER_SIZE:-CRC_SIZE]))
+        elif msg_type == MSG_QUEUE_JOB and len(frame) == MSG_BUF_LEN and len(self.queue) < self.queue_depth:
+            self.queue.append(unpack_job(frame[HEADER_SIZE:-CRC_SIZE]))
+            self.send(bytes([PONG]))
+            if self.idle:
+                self.job_done()
+        elif msg_type == MSG_CLEAR_QUEUE and len(frame) == 8:
+            self.queue.clear()
+            self.send(bytes([PONG]))
+        else:
+            self.send(bytes([8, 0, 0, MSG_INVALID, 0, 0, 0, 0]))
+
+    def start_job(self, job):
+        self.idle = False
+        self.jobs.append(job)
+        self.on_job(*job)
+
+    def job_done(self):
+        """The miner is done with its job: start the next queued one, if any."""
+        self.idle = True
+        if self.queue:
+            self.start_job(self.queue.popleft())
+
+    def on_job(self, midstate, tail, nonce_min, nonce_max):
+        """Called for every job the miner starts."""
+
+
+async def main(port=None):
+    stand_in = None
+    if port is None:
+        stand_in = PtyStandIn()
+        port = stand_in.port
+
+    host = await UartHost.open(port)
+    await host.ping()
+    print("PONG")
+    print("INFO:", (await host.get_info()).hex())
+
+    # the genesis block job from test_top.v
+    midstate = bytes.fromhex("339a90bcf0bf58637daccc90a8ca591ee9d8c8c3c803014f3687b1961bf91947")
+    tail = bytes.fromhex("4a5e1e4b495fab291d00ffff")
+    await host.push_job(midstate, tail, nonce_min=0x1DAC2B7B)
+    print("ACK, round trip %.1f ms" % (host.round_trips[-1] * 1000))
+
+    if stand_in is not None:
+        stand_in.send_nonce(0x1DAC2B7C)
+    print("NONCE: %08x" % await host.nonces.get())
+
+    # a queued job starts once the running one is done
+    await host.queue_job(midstate, tail, nonce_min=0x1DAC2B00)
+    if stand_in is not None:
+        stand_in.job_done()
+        assert stand_in.jobs[-1][2] == 0x1DAC2B00
+    await host.clear_queue()
+    print("ACK for QUEUE_JOB and CLEAR_QUEUE")
+
+    # a clean job: the jobs waiting behind the one in flight are dropped
+    pushed = [host.submit_job(midstate, tail, nonce_min) for nonce_min in (1, 2, 3)]
+    await host.push_job(midstate, tail, nonce_min=4, priority=True)
+    results = await asyncio.gather(*pushed, return_exceptions=True)
+    assert [isinstance(result, Preempted) for result in results] == [False, True, True]
+    if stand_in is not None:
+        assert [job[2] for job in stand_in.jobs[-2:]] == [1, 4]
+    print("priority PUSH_JOB, %d job frames preempted" % host.metrics.preempted.value)
+
+    host.close()
+    if stand_in is not None:
+        stand_in.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else None))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+# Bulk test vectors for the miner core, and a checker for the simulation log.
+#
+# Every vector is a job (midstate + work_data, as fpgaminer_top.v takes them),
+# a nonce_min and the golden nonce the core has to report for it: the first
+# nonce after nonce_min whose hash2[255:224] & GOLDEN_MASK is zero. With a low
+# difficulty mask (10 zero bits by default, one golden nonce in ~1000 hashes)
+# thousands of vectors are found in seconds with sweep.hash_jobs, which hashes
+# a batch of nonces for many jobs at once. The genesis block and the block from
+# test_data.txt come first, the rest are random jobs.
+#
+# The vectors are written as a $readmemh file for
+# testbenches/test_fpgaminer_vectors.v, one 416 bit line per vector:
+#   midstate (256) work_data (96) nonce_min (32) golden nonce (32)
+# The testbench holds reset for FLUSH_CYCLES per vector, so neither the last
+# vector's hashes in the pipeline nor the stale data_buf are checked, and
+# prints "vector <i>: nonce <golden_nonce>". nonce_min itself never meets the
+# mask, since the core does not reliably hash it (see miner_model.py).
+#
+# `check` reads the log line by line as the simulation writes it, so it can
+# sit at the end of a pipe, and reports wrong, missing and timed out vectors.
+# `simulate` runs vectors through miner_model.RtlSimulation instead of
+# iverilog and prints the same log.
+#
+# Usage:
+#   python3 vectors.py generate [--count N] [--zero-bits B] [--seed S] ../testbenches/vectors.hex
+#   ../testbenches/test-vectors.sim | python3 vectors.py check ../testbenches/vectors.hex
+#   python3 vectors.py simulate ../testbenches/vectors.hex --count 4 | python3 vectors.py check ../testbenches/vectors.hex --count 4
+
+import argparse
+import collections
+import re
+import sys
+
+import numpy as np
+
+from miner_model import RtlSimulation
+from sweep import hash_jobs
+
+NONCE_RANGE = 1 << 32
+# cycles test_fpgaminer_vectors.v holds reset before each vector
+FLUSH_CYCLES = 200
+
+# (midstate, work_data, golden nonce) of the blocks in genesis_block.txt and test_data.txt
+KNOWN_BLOCKS = [
+    (0x4719F91B96B187364F0103C8C3C8D8E91E59CAA890CCAC7D6358BFF0BC909A33, 0xFFFF001D29AB5F494B1E5E4A, 0x1DAC2B7C),
+    (0x228EA4732A3C9BA860C009CDA7252B9161A5E75EC8C582A5F106ABB3AF41F790, 0x2194261A9395E64DBED17115, 0x0E33337A),
+]
+
+Vector = collections.namedtuple("Vector", ["midstate", "work_data", "nonce_min", "golden_nonce"])
+
+LOG_MASK = re.compile(r"golden mask: ([0-9a-fA-F]{8})")
+LOG_VECTOR = re.compile(r"vector (\d+): (?:nonce ([0-9a-fA-F]{8})|(timeout))")
+LOG_FINISHED = re.compile(r"Finished (\d+) vectors")
+
+
+def golden_mask(zero_bits):
+    """GOLDEN_MASK for hashes with `zero_bits` leading zero bits as bitcoin
+    compares them; the most significant word of the hash is byteswapped H7."""
+    if not 0 < zero_bits <= 32:
+        raise ValueError("zero_bits must be in [1, 32]")
+    top = (0xFFFFFFFF << (32 - zero_bits)) & 0xFFFFFFFF
+    return int.from_bytes(top.to_bytes(4, "big"), "little")
+
+
+def _job_bytes(midstate, work_data):
+    return midstate.to_bytes(32, "little"), work_data.to_bytes(12, "little")
+
+
+def generate(count, mask, seed=None, max_lanes=1 << 20):
+    """`count` vectors for a golden mask, the known blocks first."""
+    # nonces hashed per vector and round, about twice the expected distance
+    chunk = min(max_lanes, 2 << bin(mask).count("1"))
+    rng = np.random.default_rng(seed)
+    pending = []
+    for i in range(count):
+        if i < len(KNOWN_BLOCKS):
+            midstate, work_data, golden = KNOWN_BLOCKS[i]
+            nonce_min = golden - 2
+        else:
+            midstate = int.from_bytes(rng.bytes(32), "little")
+            work_data = int.from_bytes(rng.bytes(12), "little")
+            nonce_min = int(rng.integers(0, NONCE_RANGE - (1 << 24)))
+        # [index, midstate, work_data, nonce_min, next offset to hash]
+        pending.append([i, midstate, work_data, nonce_min, 0])
+
+    vectors = [None] * count
+    while pending:
+        batch, pending = pending[: max_lanes // chunk], pending[max_lanes // chunk :]
+        midstates = np.empty((len(batch), 32), dtype=np.uint8)
+        tails = np.empty((len(batch), 12), dtype=np.uint8)
+        for row, (_, midstate, work_data, _, _) in enumerate(batch):
+            midstate, tail = _job_bytes(midstate, work_data)
+            midstates[row] = np.frombuffer(midstate, dtype=np.uint8)
+            tails[row] = np.frombuffer(tail, dtype=np.uint8)
+        offsets = np.arange(chunk, dtype=np.uint32)
+        nonces = np.array([v[3] + v[4] for v in batch], dtype=np.uint32)[:, None] + offsets
+
+        hash2 = hash_jobs(np.repeat(midstates, chunk, axis=0), np.repeat(tails, chunk, axis=0), nonces.ravel())
+        golden = ((hash2[7] & np.uint32(mask)) == 0).reshape(len(batch), chunk)
+
+        for row, vector in enumerate(batch):
+            index, midstate, work_data, nonce_min, offset = vector
+            hits = np.flatnonzero(golden[row]) + offset
+            if offset == 0 and hits.size and hits[0] == 0:
+                # nonce_min must not be golden, start over one nonce later
+                vector[3], vector[4] = nonce_min + 1, 0
+                pending.append(vector)
+            elif hits.size:
+                vectors[index] = Vector(midstate, work_data, nonce_min, nonce_min + int(hits[0]))
+            else:
+                vector[4] = offset + chunk
+                pending.append(vector)
+    return vectors
+
+
+def write_vectors(path, vectors, mask):
+    with open(path, "w") as f:
+        f.write("// %d vectors for test_fpgaminer_vectors.v, golden mask: %08x\n" % (len(vectors), mask))
+        f.write("// midstate work_data nonce_min golden_nonce\n")
+        for v in vectors:
+            f.write("%064x%024x%08x%08x\n" % v)
+
+
+def read_vectors(path):
+    """(golden mask, vectors) of a file written by write_vectors."""
+    mask = None
+    vectors = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("//"):
+                match = LOG_MASK.search(line)
+                if match:
+                    mask = int(match.group(1), 16)
+            elif line:
+                value = int(line, 16)
+                vectors.append(Vector(value >> 160, (value >> 64) & (1 << 96) - 1, (value >> 32) & 0xFFFFFFFF, value & 0xFFFFFFFF))
+    return mask, vectors
+
+
+def check_log(lines, vectors, mask=None):
+    """Compare `$display` lines of test_fpgaminer_vectors.v with the vectors as
+    they come in, yields a message per problem. Returns how many vectors passed."""
+    seen = set()
+    passed = 0
+    finished = False
+    for line in lines:
+        match = LOG_VECTOR.search(line)
+        if match:
+            index = int(match.group(1))
+            seen.add(index)
+            if index >= len(vectors):
+                yield "vector %d: not in the vector file" % index
+            elif match.group(3):
+                yield "vector %d: timeout, expected %08x" % (index, vectors[index].golden_nonce)
+            elif int(match.group(2), 16) != vectors[index].golden_nonce:
+                yield "vector %d: got %s, expected %08x (nonce_min %08x)" % (index, match.group(2), vectors[index].golden_nonce, vectors[index].nonce_min)
+            else:
+                passed += 1
+            continue
+
+        match = LOG_MASK.search(line)
+        if match and mask is not None and int(match.group(1), 16) != mask:
+            yield "simulation uses golden mask %s, the vectors were generated for %08x" % (match.group(1), mask)
+        elif LOG_FINISHED.search(line):
+            finished = True
+
+    missing = [i for i in range(len(vectors)) if i not in seen]
+    if missing:
+        yield "%d vectors without result, first: %d" % (len(missing), missing[0])
+    if not finished:
+        yield "the simulation did not finish"
+    return passed
+
+
+def simulate(vectors, mask, loop_log2=0, timeout=1 << 20):
+    """Run vectors through RtlSimulation like test_fpgaminer_vectors.v, yields its log lines."""
+    sim = RtlSimulation(loop_log2, 0, 0, 0, golden_mask=mask)
+    yield "golden mask: %08x" % mask
+    for i, v in enumerate(vectors):
+        sim.midstate = [(v.midstate >> 32 * j) & 0xFFFFFFFF for j in range(8)]
+        sim.work_data = [(v.work_data >> 32 * j) & 0xFFFFFFFF for j in range(3)]
+        sim.nonce_min = v.nonce_min
+        for _ in range(FLUSH_CYCLES):
+            sim.step(reset=True)
+        for _ in range(timeout):
+            sim.step()
+            if sim.new_golden_nonce:
+                yield "vector %d: nonce %08x" % (i, sim.golden_nonce)
+                break
+        else:
+            yield "vector %d: timeout" % i
+    yield "Finished %d vectors" % len(vectors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test vectors for fpgaminer_top.v.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("generate", help="write a vector file")
+    command.add_argument("path")
+    command.add_argument("--count", type=int, default=1000)
+    command.add_argument("--zero-bits", type=int, default=10, help="leading zero bits of a golden hash")
+    command.add_argument("--seed", type=int)
+
+    command = commands.add_parser("check", help="compare a simulation log with a vector file")
+    command.add_argument("path")
+    command.add_argument("log", nargs="?", help="log file, standard input by default")
+    command.add_argument("--count", type=int, help="only the first COUNT vectors were simulated")
+
+    command = commands.add_parser("simulate", help="print the log of RtlSimulation for the first vectors")
+    command.add_argument("path")
+    command.add_argument("--count", type=int, default=4)
+    command.add_argument("--loop-log2", type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        mask = golden_mask(args.zero_bits)
+        vectors = generate(args.count, mask, args.seed)
+        write_vectors(args.path, vectors, mask)
+        mean = sum(v.golden_nonce - v.nonce_min for v in vectors) / len(vectors)
+        print("%d vectors, golden mask %08x, %.0f nonces to the golden nonce on average" % (len(vectors), mask, mean))
+        print("run with: make test-vectors VECTOR_MASK=%08x" % mask)
+
+    elif args.command == "check":
+        mask, vectors = read_vectors(args.path)
+        vectors = vectors[: args.count]
+        log = open(args.log) if args.log else sys.stdin
+        with log:
+            problems = check_log(log, vectors, mask)
+            failures = 0
+            while True:
+                try:
+                    print(next(problems))
+                    failures += 1
+                except StopIteration as stop:
+                    passed = stop.value
+                    break
+        print("%d of %d vectors passed" % (passed, len(vectors)))
+        sys.exit(1 if failures else 0)
+
+    elif args.command == "simulate":
+        mask, vectors = read_vectors(args.path)
+        for line in simulate(vectors[: args.count], mask, args.loop_log2):
+            print(line, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -44,12 +44,36 @@
 #       );
 #
 #
+# the dividers are solved here rather than by forking trellis' `ecppll`, so
+# the frontend works without the Trellis tools installed. solutions are cached
+# on disk (see CACHE_PATH), keyed on IN_MHZ and the OUTn_MHZ values.
+#
+# to just print a module:
+#
+#     python3 ./ecp5pll.py --clkin 12 --clkout0 50
+#
 # [TODO] (aseipp):
 #   - phase settings
 #   - help message?
 #   - tighten up error handling
 
-import json, sys, subprocess
+import json, math, os, sys
+from fractions import Fraction
+
+# EHXPLLL limits, in MHz (same as ecppll)
+INPUT_MIN, INPUT_MAX = 8, 400
+PFD_MIN, PFD_MAX = Fraction(3125, 1000), 400
+VCO_MIN, VCO_MAX = 400, 800
+# ecppll prefers a VCO in the middle of its range
+VCO_TARGET = 600
+CLKI_DIV_MAX = 128
+CLKFB_DIV_MAX = 80
+OUTPUT_DIV_MAX = 128
+
+# secondary outputs clkout1..3 are CLKOS, CLKOS2, CLKOS3
+SECONDARY_NAMES = { 1: "S", 2: "S2", 3: "S3" }
+
+CACHE_PATH = os.environ.get("ECP5PLL_CACHE", os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ecp5pll.json"))
 
 def onoes(s):
     print(json.dumps({ "error": s }))
@@ -75,6 +99,165 @@ def check_output(params, n):
     else:
         return None
 
+def nearest_divider(fvco, freq):
+    """the output divider that brings fvco closest to freq"""
+    lower = min(max(math.floor(fvco / freq), 1), OUTPUT_DIV_MAX)
+    upper = min(lower + 1, OUTPUT_DIV_MAX)
+    return min((lower, upper), key=lambda div: abs(fvco / div - freq))
+
+def solve_pll(infreq, outputs):
+    """find CLKI_DIV, CLKFB_DIV and the output dividers for the requested
+    outputs ({ n: MHz }, n = 0..3, 0 required).
+
+    CLKOP is the feedback path, so clkout0 = infreq / CLKI_DIV * CLKFB_DIV; the
+    closest clkout0 wins, then the closest secondary outputs, then the VCO
+    closest to VCO_TARGET. exact fractions are used, where ecppll uses floats.
+    """
+    infreq = Fraction(str(infreq))
+    targets = { n: Fraction(str(f)) for (n, f) in outputs.items() }
+    if not INPUT_MIN <= infreq <= INPUT_MAX:
+        raise ValueError(f"input frequency {float(infreq):g} MHz is out of range")
+
+    # best clkout0 first, it does not depend on the output divider
+    primary = []
+    best_error = None
+    for refclk_div in range(1, CLKI_DIV_MAX + 1):
+        fpfd = infreq / refclk_div
+        if not PFD_MIN <= fpfd <= PFD_MAX:
+            continue
+        for feedback_div in range(1, CLKFB_DIV_MAX + 1):
+            fout = fpfd * feedback_div
+            if math.ceil(VCO_MIN / fout) > min(OUTPUT_DIV_MAX, math.floor(VCO_MAX / fout)):
+                continue
+            error = abs(fout - targets[0])
+            if best_error is None or error < best_error:
+                best_error, primary = error, []
+            if error == best_error:
+                primary.append((refclk_div, feedback_div, fout))
+    if not primary:
+        raise ValueError("no PLL configuration reaches the VCO range")
+
+    best = None
+    for (refclk_div, feedback_div, fout) in primary:
+        for output_div in range(math.ceil(VCO_MIN / fout), min(OUTPUT_DIV_MAX, math.floor(VCO_MAX / fout)) + 1):
+            fvco = fout * output_div
+            secondary = { n: nearest_divider(fvco, f) for (n, f) in targets.items() if n != 0 }
+            key = (sum(abs(fvco / div - targets[n]) for (n, div) in secondary.items()), abs(fvco - VCO_TARGET))
+            if best is None or key < best[0]:
+                best = (key, { "refclk_div": refclk_div, "feedback_div": feedback_div, "output_div": output_div, "secondary": secondary })
+    return best[1]
+
+def pll_frequencies(infreq, solution):
+    """{ n: achieved MHz } and the VCO frequency of a solution"""
+    fvco = Fraction(str(infreq)) / solution["refclk_div"] * solution["feedback_div"] * solution["output_div"]
+    freqs = { 0: fvco / solution["output_div"] }
+    for (n, div) in solution["secondary"].items():
+        freqs[n] = fvco / div
+    return (freqs, fvco)
+
+def cache_key(infreq, outputs):
+    # 12 from yosys and 12.0 from the command line are the same key
+    return "|".join(str(Fraction(str(f))) if f != None else "" for f in [ infreq ] + [ outputs.get(n) for n in range(4) ])
+
+def cached_solve_pll(infreq, outputs, path=CACHE_PATH):
+    """solve_pll, memoized in a JSON file"""
+    key = cache_key(infreq, outputs)
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    if key in cache:
+        solution = cache[key]
+        solution["secondary"] = { int(n): div for (n, div) in solution["secondary"].items() }
+        return solution
+
+    solution = solve_pll(infreq, outputs)
+    cache[key] = solution
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        sys.stderr.write(f"ecp5pll: cannot write cache {path}: {e}\n")
+    return solution
+
+def mhz(f):
+    # like printing a float with std::ostream, as ecppll does
+    return f"{float(f):g}"
+
+def pll_module_text(infreq, outputs, solution, name="pll", reset=True, standby=True):
+    """the module `ecppll --reset --standby` writes for the solution"""
+    (freqs, fvco) = pll_frequencies(infreq, solution)
+    # CLKOP is shifted by 180 degrees, like Lattice's tools do
+    primary_cphase = solution["output_div"] // 2
+
+    text = "// diamond 3.7 accepts this PLL\n"
+    text += "// diamond 3.8-3.9 is untested\n"
+    text += "// diamond 3.10 or higher is likely to abort with error about unable to use feedback signal\n"
+    text += "// cause of this could be from wrong CPHASE/FPHASE parameters\n"
+    for n in sorted(freqs):
+        error = freqs[n] - Fraction(str(outputs[n]))
+        text += f"// clkout{n}: requested {mhz(outputs[n])} MHz, achieved {mhz(freqs[n])} MHz, error {mhz(error)} MHz ({mhz(error / Fraction(str(outputs[n])) * 1000000)} ppm)\n"
+    text += f"module {name}\n(\n"
+    if reset: text += "    input reset, // 0:inactive, 1:reset\n"
+    if standby: text += "    input standby, // 0:inactive, 1:standby\n"
+    text += f"    input clkin, // {mhz(infreq)} MHz, 0 deg\n"
+    text += f"    output clkout0, // {mhz(freqs[0])} MHz, 0 deg\n"
+    for n in solution["secondary"]:
+        text += f"    output clkout{n}, // {mhz(freqs[n])} MHz, 0 deg\n"
+    text += "    output locked\n"
+    text += ");\n"
+    text += f"(* FREQUENCY_PIN_CLKI=\"{mhz(infreq)}\" *)\n"
+    text += f"(* FREQUENCY_PIN_CLKOP=\"{mhz(freqs[0])}\" *)\n"
+    for n in solution["secondary"]:
+        text += f"(* FREQUENCY_PIN_CLKO{SECONDARY_NAMES[n]}=\"{mhz(freqs[n])}\" *)\n"
+    text += "(* ICP_CURRENT=\"12\" *) (* LPF_RESISTOR=\"8\" *) (* MFG_ENABLE_FILTEROPAMP=\"1\" *) (* MFG_GMCREF_SEL=\"2\" *)\n"
+    text += "EHXPLLL #(\n"
+    text += f"        .PLLRST_ENA(\"{'ENABLED' if reset else 'DISABLED'}\"),\n"
+    text += "        .INTFB_WAKE(\"DISABLED\"),\n"
+    text += f"        .STDBY_ENABLE(\"{'ENABLED' if standby else 'DISABLED'}\"),\n"
+    text += "        .DPHASE_SOURCE(\"DISABLED\"),\n"
+    text += "        .OUTDIVIDER_MUXA(\"DIVA\"),\n"
+    text += "        .OUTDIVIDER_MUXB(\"DIVB\"),\n"
+    text += "        .OUTDIVIDER_MUXC(\"DIVC\"),\n"
+    text += "        .OUTDIVIDER_MUXD(\"DIVD\"),\n"
+    text += f"        .CLKI_DIV({solution['refclk_div']}),\n"
+    text += "        .CLKOP_ENABLE(\"ENABLED\"),\n"
+    text += f"        .CLKOP_DIV({solution['output_div']}),\n"
+    text += f"        .CLKOP_CPHASE({primary_cphase}),\n"
+    text += "        .CLKOP_FPHASE(0),\n"
+    for (n, div) in solution["secondary"].items():
+        sec = SECONDARY_NAMES[n]
+        text += f"        .CLKO{sec}_ENABLE(\"ENABLED\"),\n"
+        text += f"        .CLKO{sec}_DIV({div}),\n"
+        text += f"        .CLKO{sec}_CPHASE({primary_cphase}),\n"
+        text += f"        .CLKO{sec}_FPHASE(0),\n"
+    text += "        .FEEDBK_PATH(\"CLKOP\"),\n"
+    text += f"        .CLKFB_DIV({solution['feedback_div']})\n"
+    text += "    ) pll_i (\n"
+    text += "        .RST(" + ("reset" if reset else "1'b0") + "),\n"
+    text += "        .STDBY(" + ("standby" if standby else "1'b0") + "),\n"
+    text += "        .CLKI(clkin),\n"
+    text += "        .CLKOP(clkout0),\n"
+    for n in solution["secondary"]:
+        text += f"        .CLKO{SECONDARY_NAMES[n]}(clkout{n}),\n"
+    text += "        .CLKFB(clkout0),\n"
+    text += "        .CLKINTFB(),\n"
+    text += "        .PHASESEL0(1'b0),\n"
+    text += "        .PHASESEL1(1'b0),\n"
+    text += "        .PHASEDIR(1'b1),\n"
+    text += "        .PHASESTEP(1'b1),\n"
+    text += "        .PHASELOADREG(1'b1),\n"
+    text += "        .PLLWAKESYNC(1'b0),\n"
+    text += "        .ENCLKOP(1'b0),\n"
+    text += "        .LOCK(locked)\n"
+    text += "\t);\n"
+    text += "endmodule\n"
+    return text
+
 def ecppll(modname, params):
     out0 = check_output(params, 0)
     out1 = check_output(params, 1)
@@ -89,24 +272,19 @@ def ecppll(modname, params):
         onoes(f"must specify at least one output PLL clock line")
         return
 
-    infreq = map_parameter(params["\\IN_MHZ"])
-
-    clkargs = [ "--clkin", str(infreq) ]
-    if out0 != None: clkargs = clkargs + [ "--clkout0", str(out0) ]
-    if out1 != None: clkargs = clkargs + [ "--clkout1", str(out1) ]
-    if out2 != None: clkargs = clkargs + [ "--clkout2", str(out2) ]
-    if out3 != None: clkargs = clkargs + [ "--clkout3", str(out3) ]
+    if out0 == None:
+        onoes(f"OUT0_MHZ parameter for {modname} must be specified, clkout0 is the feedback clock")
+        return
 
-    cmd = [
-        "ecppll",
-        "-f", "/dev/stderr",
-        "--reset", "--standby"
-    ] + clkargs
-    # sys.stderr.write(json.dumps(cmd))
+    infreq = map_parameter(params["\\IN_MHZ"])
+    outputs = { n: x for (n, x) in [ (0, out0), (1, out1), (2, out2), (3, out3) ] if x != None }
 
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    _, stderr = proc.communicate()
-    pll_module = stderr.decode('utf-8')
+    try:
+        solution = cached_solve_pll(infreq, outputs)
+    except ValueError as e:
+        onoes(f"{modname}: {e}")
+        return
+    pll_module = pll_module_text(infreq, outputs, solution)
 
     params = ""
     ports0 = ""
@@ -155,6 +333,8 @@ def derive(obj, cmdname):
 
     params = obj["parameters"]
     source = ecppll(modname, params)
+    if source is None:
+        return # the error has been reported
 
     if False: # [NOTE] (aseipp): debugging
         sys.stderr.write(json.dumps(params))
@@ -180,6 +360,17 @@ def main(modname):
         sys.stdout.flush()
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1].startswith("--"):
+        import argparse
+        parser = argparse.ArgumentParser(description="print the EHXPLLL module for the given frequencies")
+        parser.add_argument("--clkin", type=float, required=True)
+        for n in range(4):
+            parser.add_argument(f"--clkout{n}", type=float, required=(n == 0))
+        args = parser.parse_args()
+        outputs = { n: getattr(args, f"clkout{n}") for n in range(4) if getattr(args, f"clkout{n}") is not None }
+        print(pll_module_text(args.clkin, outputs, cached_solve_pll(args.clkin, outputs)), end="")
+        sys.exit()
+
     if len(sys.argv) > 1:
         modname = sys.argv[1]
     else:
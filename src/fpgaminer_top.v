@@ -9,6 +9,7 @@ module fpgaminer_top (
 	input wire reset,
 	output reg [31:0] golden_nonce = 32'd0,
 	output reg new_golden_nonce = 1'd0, // whether we found a hash
+	output wire idle, // done with the job: golden nonce found or nonce_max hashed
 	output wire [7:0] leds
 );
 	// determines how unrolled the SHA-256 calculations are. 
@@ -19,6 +20,10 @@ module fpgaminer_top (
 	// Valid range: [0, 5]
 	parameter LOOP_LOG2 = 5;
 
+	// bits of hash2[255:224] that have to be zero for a golden nonce; the
+	// testbenches lower it to find nonces every few thousand hashes
+	parameter [31:0] GOLDEN_MASK = 32'hFFFFFFFF;
+
 	// to make sure we always get exponents of number two;
     // values can be 1, 2, 4, 8, 16, 32
 	localparam [5:0] LOOP = (6'd1 << LOOP_LOG2);
@@ -29,6 +34,7 @@ module fpgaminer_top (
 	// hash (except when LOOP_LOG2 == 0 or 1, where the offset is 131 or
 	// 66 respectively).
 	localparam [31:0] GOLDEN_NONCE_OFFSET = (32'd1 << (7 - LOOP_LOG2)) + 32'd1;
+	localparam [31:0] NONCE_OFFSET = (LOOP == 1) ? 32'd131 : (LOOP == 2) ? 32'd66 : GOLDEN_NONCE_OFFSET;
 
 	reg [511:0] data = 512'd0; // a block header is 640 bits
     reg [31:0] nonce = 32'd0;
@@ -90,6 +96,11 @@ module fpgaminer_top (
 
     // if we're inside the feedback loop, do not increment the nonce
 	assign nonce_next = reset ? nonce_min : (feedback_next ? nonce : (nonce + 32'd1));
+
+	// the nonce whose hash2 the golden check looks at this cycle
+	wire [31:0] checked_nonce = nonce_next - NONCE_OFFSET;
+
+	assign idle = wait_for_work;
 	
 	// just to know our program is running
     assign leds[0] = !wait_for_work; // if we negate it, we'll get the true value out
@@ -125,7 +136,10 @@ module fpgaminer_top (
 		nonce <= nonce_next;
 
 		// Check to see if the last hash generated is valid.
-		golden_nonce_found <= (hash2[255:224] == 32'h00000000) && !feedback_d1 && !wait_for_work;
+		golden_nonce_found <= ((hash2[255:224] & GOLDEN_MASK) == 32'h00000000) && !feedback_d1 && !wait_for_work;
+		// the range is done once the hash of nonce_max is checked; a golden nonce found in it is still reported
+		if (!reset && !feedback_d1 && !wait_for_work && checked_nonce == nonce_max)
+			wait_for_work <= 1'b1;
 		if(golden_nonce_found)
 		begin
 			wait_for_work <= 1'b1;
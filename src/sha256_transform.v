@@ -42,6 +42,13 @@ module sha256_transform #(
 		32'h748f82ee, 32'h78a5636f, 32'h84c87814, 32'h8cc70208,
 		32'h90befffa, 32'ha4506ceb, 32'hbef9a3f7, 32'hc67178f2};
 
+`ifdef TRACE
+	// cnt of the last edge, so the dump below shows which round each stage did
+	reg [5:0] trace_cnt = 6'd0;
+	always @ (posedge clk)
+		trace_cnt <= cnt;
+`endif
+
 	// generate the message schedule pipeline - 64 words (word is 32 bytes)
 	genvar i;
 	generate
@@ -61,6 +68,13 @@ module sha256_transform #(
 				.tx_w(W),
 				.tx_state(state) // output state
 			);
+
+`ifdef TRACE
+			// state after round LOOP*i + trace_cnt and the message window, once the edge
+			// has updated them (see helpers/trace_diff.py)
+			always @ (posedge clk)
+				$strobe ("trace %m %0t %0d %0d %x %x", $time, i, trace_cnt, state, W);
+`endif
 		end
 	endgenerate
 	
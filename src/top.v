@@ -17,6 +17,7 @@ module top (
     wire rx_new_work; // Indicate new work on midstate, data.
     wire new_golden_nonce;
     wire [31:0] golden_nonce;
+    wire miner_idle; // the miner is done with its job, the next queued one can go in
 
     // PLL to get 100.5MHz clock						
 	wire hash_clk;
@@ -38,6 +39,7 @@ module top (
 	    .new_golden_nonce(new_golden_nonce), // whether we found a hash
         .nonce_min(nonce_min), // minimum nonce for job
 	    .nonce_max(nonce_max), // maximum nonce for job
+        .idle(miner_idle),
         .leds(led)
     );
 
@@ -48,6 +50,7 @@ module top (
 		.comm_clk (CLK),
         .golden_nonce(golden_nonce),
 	    .new_golden_nonce(new_golden_nonce), // whether we found a hash
+        .miner_idle(miner_idle),
         .hash_clk (hash_clk),
 		.rx_serial (RX),
 		.tx_serial (TX),
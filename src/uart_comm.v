@@ -6,7 +6,13 @@
 // tx_serial:	UART TX (outgoing)
 
 // Implemented incoming messages:
-// PING, GET_INFO, MSG_PUSH_JOB
+// PING, GET_INFO, MSG_PUSH_JOB, MSG_QUEUE_JOB, MSG_CLEAR_QUEUE
+//
+// PUSH_JOB replaces the running job. QUEUE_JOB appends a job to a FIFO of
+// QUEUE_DEPTH jobs (INVALID when it is full); the miner takes the next one as
+// soon as it goes idle (golden nonce found or nonce_max hashed), so it does
+// not wait for the host between jobs. CLEAR_QUEUE empties the FIFO, for
+// clean jobs.
 //
 // Implemented outgoing messages:
 // PONG, INFO, INVALID, MSG_NONCE
@@ -17,6 +23,7 @@ module uart_comm (
 	input wire rx_serial,
 	input wire [31:0] golden_nonce,
 	input wire new_golden_nonce, // whether we found a hash, is hash_clk synchronized
+	input wire miner_idle, // the miner is done with its job, is hash_clk synchronized
 	output wire tx_serial,
     output wire error_led, // error led
     output wire status_led1,
@@ -44,6 +51,8 @@ module uart_comm (
 	localparam MSG_NONCE = 3;
 	localparam MSG_ACK = 4;
 	localparam MSG_RESEND = 5;
+	localparam MSG_QUEUE_JOB = 6;
+	localparam MSG_CLEAR_QUEUE = 7;
 
 	// 256 bits midstate hash, 96 bits time+merkleroot+difficulty, 32 bits min nonce, 32 bits max nonce
 	localparam JOB_SIZE = 256 + 96 + 32 + 32; // 52 bytes or 416 bits
@@ -51,6 +60,19 @@ module uart_comm (
 	reg [JOB_SIZE-1:0] current_job = {JOB_SIZE{1'b0}};
 	reg new_work_flag = 1'b0;
 
+	// Job FIFO
+	parameter QUEUE_LOG2 = 2;
+	localparam QUEUE_DEPTH = 1 << QUEUE_LOG2;
+
+	reg [JOB_SIZE-1:0] job_queue [0:QUEUE_DEPTH-1];
+	reg [QUEUE_LOG2-1:0] queue_head = 0;
+	reg [QUEUE_LOG2:0] queue_count = 0;
+	wire [QUEUE_LOG2-1:0] queue_tail = queue_head + queue_count[QUEUE_LOG2-1:0];
+	// a job went to the miner and the miner has not left idle for it yet
+	reg job_pending = 1'b0;
+	// miner_idle stepped down to comm_clk
+	reg [1:0] meta_idle = 2'b00;
+
 	reg [63:0] system_info = 64'hDEADBEEF13370D13;
 
 	wire reset = 0;
@@ -111,6 +133,19 @@ module uart_comm (
 	);
 
 	always @(posedge comm_clk) begin
+		// hand the next queued job to the miner once it is idle; not while
+		// parsing, which may push, queue or clear jobs itself
+		meta_idle <= {miner_idle, meta_idle[1]}; // right shift
+		if (!meta_idle[0])
+			job_pending <= 1'b0;
+		else if (state != STATE_PARSE && !job_pending && queue_count != 0) begin
+			current_job <= job_queue[queue_head];
+			new_work_flag <= ~new_work_flag;
+			job_pending <= 1'b1;
+			queue_head <= queue_head + 1'b1;
+			queue_count <= queue_count - 1'b1;
+		end
+
         case (state)
         	// Waiting for new packet
 			STATE_IDLE: begin
@@ -189,6 +224,22 @@ module uart_comm (
 					begin
 						current_job <= msg_data[8*4 +: JOB_SIZE]; // header is in the beginning, so the job is on the left
 						new_work_flag <= ~new_work_flag;
+						job_pending <= 1'b1;
+
+						msg_type <= MSG_ACK;
+						msg_length <= 8'd1;
+					end
+					else if (msg_type == MSG_QUEUE_JOB && msg_length == (JOB_SIZE/8 + 8) && queue_count != QUEUE_DEPTH)
+					begin
+						job_queue[queue_tail] <= msg_data[8*4 +: JOB_SIZE];
+						queue_count <= queue_count + 1'b1;
+
+						msg_type <= MSG_ACK;
+						msg_length <= 8'd1;
+					end
+					else if (msg_type == MSG_CLEAR_QUEUE && msg_length == 8)
+					begin
+						queue_count <= 0;
 
 						msg_type <= MSG_ACK;
 						msg_length <= 8'd1;
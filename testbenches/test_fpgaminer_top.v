@@ -27,6 +27,7 @@ module test_fpgaminer_top ();
         .midstate(256'h4719F91B96B187364F0103C8C3C8D8E91E59CAA890CCAC7D6358BFF0BC909A33),
         .work_data(96'hFFFF001D29AB5F494B1E5E4A),
         .nonce_min(32'h1DAC2B7C - 2), // Minus a little so we can exercise the code a bit
+        .nonce_max(32'hFFFFFFFF),
         .reset(reset),
 		.new_golden_nonce(new_golden_nonce),
 		.golden_nonce(golden_nonce)
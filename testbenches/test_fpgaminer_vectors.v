@@ -0,0 +1,75 @@
+// Testbench for fpgaminer_top.v over many generated vectors
+// generate them with `python3 helpers/vectors.py generate testbenches/vectors.hex`
+// run `make test-vectors` to compile, run and check the output with vectors.py
+
+`timescale 1ns/1ps
+
+module test_fpgaminer_vectors ();
+	parameter LOOP_LOG2 = 0;
+	// has to match the golden mask in the header of the vector file
+	parameter [31:0] GOLDEN_MASK = 32'h0000c0ff;
+	parameter MAX_VECTORS = 65536;
+	// reset is held this long per vector to flush the pipeline (FLUSH_CYCLES in vectors.py)
+	parameter FLUSH_CYCLES = 200;
+	parameter TIMEOUT_CYCLES = 1 << 20;
+
+	reg clk = 1'b0;
+	reg reset = 1'b1;
+	reg [255:0] midstate = 256'd0;
+	reg [95:0] work_data = 96'd0;
+	reg [31:0] nonce_min = 32'd0;
+	wire new_golden_nonce;
+	wire [31:0] golden_nonce;
+
+	// { midstate, work_data, nonce_min, golden nonce }, an all zero entry ends the list
+	reg [415:0] vectors [0:MAX_VECTORS-1];
+	reg [8*256-1:0] path;
+	integer i, cycles;
+
+	fpgaminer_top # (.LOOP_LOG2(LOOP_LOG2), .GOLDEN_MASK(GOLDEN_MASK)) uut (
+		.hash_clk(clk),
+		.midstate(midstate),
+		.work_data(work_data),
+		.nonce_min(nonce_min),
+		.nonce_max(32'hFFFFFFFF),
+		.reset(reset),
+		.new_golden_nonce(new_golden_nonce),
+		.golden_nonce(golden_nonce)
+	);
+
+	always #5 clk = !clk;
+
+	initial begin
+		for (i = 0; i < MAX_VECTORS; i = i + 1)
+			vectors[i] = 416'd0;
+		if (!$value$plusargs("vectors=%s", path))
+			path = "./testbenches/vectors.hex";
+		$readmemh(path, vectors);
+		$display ("golden mask: %08x", GOLDEN_MASK);
+
+		for (i = 0; i < MAX_VECTORS && vectors[i] != 416'd0; i = i + 1)
+		begin
+			// inputs change on the falling edge, away from the posedge the core samples on
+			@ (negedge clk);
+			{midstate, work_data, nonce_min} = vectors[i][415:32];
+			reset = 1;
+			repeat (FLUSH_CYCLES) @ (negedge clk);
+			reset = 0;
+
+			cycles = 0;
+			while (!new_golden_nonce && cycles < TIMEOUT_CYCLES)
+			begin
+				@ (negedge clk);
+				cycles = cycles + 1;
+			end
+
+			if (new_golden_nonce)
+				$display ("vector %0d: nonce %08x", i, golden_nonce);
+			else
+				$display ("vector %0d: timeout", i);
+		end
+
+		$display ("Finished %0d vectors", i);
+		$finish;
+	end
+endmodule
@@ -90,6 +90,26 @@ module test_top ();
 		uart_send_word (32'h4719F91B); // midstate hash
         uart_send_word (32'h814f1577); // crc 77154f81 
 
+		uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay;
+
+		// QUEUE_JOB: the same job from one nonce earlier; the miner is idle after the golden nonce,
+		// so it takes the queued job on its own and finds the golden nonce again
+		uart_send_word (32'h0600003C); // length 60, type 6
+		uart_send_word (32'hFFFFFFFF); // max nonce
+		uart_send_word (32'h1DAC2B7A); // min nonce
+		uart_send_word (32'h4B1E5E4A);
+		uart_send_word (32'h29AB5F49);
+		uart_send_word (32'hFFFF001D);
+		uart_send_word (32'hBC909A33);
+		uart_send_word (32'h6358BFF0);
+		uart_send_word (32'h90CCAC7D);
+		uart_send_word (32'h1E59CAA8);
+		uart_send_word (32'hC3C8D8E9);
+		uart_send_word (32'h4F0103C8);
+		uart_send_word (32'h96B18736);
+		uart_send_word (32'h4719F91B);
+		uart_send_word (32'hc19849a8); // crc a84998c1
+
 		uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay;
 		
 		#10000;
@@ -173,6 +193,21 @@ module test_top ();
 		uart_expect_byte (8'h7c);
 		$display ("PASSED: MSG_NONCE\n");
 
+		$display ("Expecting ACK for queue job...");
+		uart_expect_byte (8'h01);
+		$display ("PASSED: ACK\n");
+
+		$display ("Expecting MSG_NONCE of the queued job...");
+		uart_expect_byte (8'd8);
+		uart_expect_byte (8'd00);
+		uart_expect_byte (8'd00);
+		uart_expect_byte (8'd03);
+		uart_expect_byte (8'h1d);
+		uart_expect_byte (8'hac);
+		uart_expect_byte (8'h2b);
+		uart_expect_byte (8'h7c);
+		$display ("PASSED: MSG_NONCE\n");
+
 		test_passed = 1;
 	end
 
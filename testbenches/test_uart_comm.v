@@ -16,7 +16,10 @@ module uart_comm_tb;
 	reg uut_rx = 1'b1;
 	reg uut_need_work = 1'b0;
 	reg uut_new_nonce = 1'b0;
+	reg uut_miner_idle = 1'b0;
 	reg [31:0] uut_golden_nonce = 32'd0;
+	// how far the output checks got, the queue tests wait for them
+	integer step = 0;
 
 	wire uut_tx;
 	wire uut_new_work;
@@ -42,6 +45,7 @@ module uart_comm_tb;
 		.tx_serial (uut_tx),
 		.new_work (uut_new_work),
 		.new_golden_nonce (uut_new_nonce),
+		.miner_idle (uut_miner_idle),
 		.golden_nonce (uut_golden_nonce)
 		// .rx_need_work (uut_need_work),
 	);
@@ -104,31 +108,32 @@ module uart_comm_tb;
 		// uart_send_byte (8'b00001010);
 		// uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay;
 
-		// // QUEUE_JOB
-		// uart_send_byte (8'd60);
-		// uart_send_byte (8'h00);
-		// uart_send_byte (8'h00);
-		// uart_send_byte (8'h05);
-		// uart_send_word (32'h00000000);
-		// uart_send_word (32'hFFFFFFFF);
-		// uart_send_word (32'h0b0a0908);
-		// uart_send_word (32'h0f0e0d0c);
-		// uart_send_word (32'h13121110);
-		// uart_send_word (32'h17161514);
-		// uart_send_word (32'h1b1a1918);
-		// uart_send_word (32'h1f1e1d1c);
-		// uart_send_word (32'h23222120);
-		// uart_send_word (32'h27262524);
-		// uart_send_word (32'h2b2a2928);
-		// uart_send_word (32'h2f2e2d2c);
-		// uart_send_word (32'h33323130);
-		// uart_send_word (32'h38b9b05a);
-		// uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay; uart_delay;
-
 		// signal to the uart module that a valid hash has been found
 		uut_golden_nonce <= 32'h38b9b05a;
 		uut_new_nonce <= 1;
 
+		// QUEUE_JOB while the miner is busy with the pushed job
+		wait (step == 1);
+		uart_send_queue_job (32'h22222222, 32'h11111111, 32'h4f5808e9);
+
+		// the miner goes idle and takes the queued job
+		wait (step == 2);
+		uut_miner_idle = 1;
+		wait (step == 3);
+		uut_miner_idle = 0;
+
+		// queue another job, then drop it with CLEAR_QUEUE
+		#1000;
+		uart_send_queue_job (32'h44444444, 32'h33333333, 32'hfa00bb6a);
+		wait (step == 4);
+		uart_send_byte (8'h08);
+		uart_send_byte (8'h00);
+		uart_send_byte (8'h00);
+		uart_send_byte (8'h07);
+		uart_send_word (32'h0fc8ade7); // crc e7adc80f
+		wait (step == 5);
+		uut_miner_idle = 1;
+
 		#30000;
 		if (test_passed)
 			$display ("\n*** TEST PASSED ***\n");
@@ -230,6 +235,34 @@ module uart_comm_tb;
 			$display ("noncemin: %4X\nnoncemax: %4X\ndata: %24X\nmidstate: %64X\n", uut_noncemin, uut_noncemax, uut_data, uut_midstate);
 			$finish;
 		end
+		step = 1;
+
+		$display ("Expecting ACK for queue job...");
+		uart_expect_byte (8'h01);
+		#2000;
+		expect_nonce_min (32'hFFFFFFFF); // still busy, the pushed job keeps running
+		$display ("PASSED: ACK, job queued\n");
+		step = 2;
+
+		$display ("Expecting the queued job once the miner is idle...");
+		#2000;
+		expect_nonce_min (32'h11111111);
+		if (uut_noncemax != 32'h22222222 || uut_midstate != 256'h333231302f2e2d2c2b2a292827262524232221201f1e1d1c1b1a191817161514)
+		begin
+			$display ("TEST FAILED: Incorrect queued job.\n");
+			$finish;
+		end
+		$display ("PASSED: queued job started\n");
+		step = 3;
+
+		$display ("Expecting ACK for queue job and CLEAR_QUEUE...");
+		uart_expect_byte (8'h01);
+		step = 4;
+		uart_expect_byte (8'h01);
+		step = 5;
+		#4000;
+		expect_nonce_min (32'h11111111); // the miner went idle, but the queue is empty
+		$display ("PASSED: CLEAR_QUEUE\n");
 
 		test_passed = 1;
 	end
@@ -282,6 +315,36 @@ module uart_comm_tb;
 	end
 	endtask
 
+	// QUEUE_JOB with the data and midstate of the PUSH_JOB above
+	task uart_send_queue_job;
+	input [31:0] nonce_max;
+	input [31:0] nonce_min;
+	input [31:0] crc;
+	integer i;
+	begin
+		uart_send_byte (8'd60);
+		uart_send_byte (8'h00);
+		uart_send_byte (8'h00);
+		uart_send_byte (8'h06);
+		uart_send_word (nonce_max);
+		uart_send_word (nonce_min);
+		for (i = 8; i < 52; i = i + 4)
+			uart_send_word ({i[7:0] + 8'd3, i[7:0] + 8'd2, i[7:0] + 8'd1, i[7:0]});
+		uart_send_word (crc);
+	end
+	endtask
+
+	task expect_nonce_min;
+	input [31:0] nonce_min;
+	begin
+		if (uut_noncemin != nonce_min)
+		begin
+			$display ("TEST FAILED: Expected nonce_min %08X got %08X.", nonce_min, uut_noncemin);
+			$finish;
+		end
+	end
+	endtask
+
 	task uart_recv_byte;
 	output [7:0] byte;
 	begin